@@ -0,0 +1,373 @@
+# ============================================================================ #
+# Benchmarks of every stage of the pipeline on synthetic sessions (see
+# synthetic_data.py): grid making (files and in memory), the imexam cleanup,
+# sky estimation, photometry on one and many grids, reading polyphot logs,
+# detection, rendering, the inventory and stacking. Each stage is timed, and
+# its peak memory traced in a separate run, across numbers of images and
+# grid sizes, and the results are saved as JSON so runs can be compared
+# before and after a change.
+# ============================================================================ #
+
+# grid sizes that divide the 1280x960 frames exactly
+BENCH_GRIDS = ('10x10', '32x24', '40x40', '64x64', '80x80')
+BENCH_COUNTS = (10, 50)
+BENCH_DIR = 'benchmarks'
+
+
+def _measure(func, repeat=3):
+    """
+    :param func: function of no arguments to time
+    :param repeat: number of timed runs
+
+    :returns (fastest time in seconds, peak of memory allocated during a run
+             in bytes). The time comes from runs without tracemalloc, which
+             slows allocation down a lot; the memory from one more, traced
+             run.
+    """
+
+    import gc
+    import time
+    import tracemalloc
+
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def _session(workdir, nimages, seed=0):
+    """
+    Synthetic session of nimages frames (one filter and exposure), with its
+    imexam results folder.
+
+    :returns dictionary with the top directory, the frames and the imexam
+             results folder
+    """
+
+    import os
+    from synthetic_data import make_session, write_imexam_session
+
+    top = os.path.join(workdir, 'session_{}'.format(nimages))
+    paths = make_session(top, nframes=nimages, filters=(('15', 'none'),),
+                         exposures=('300microsec',), seed=seed)
+    imexam = os.path.join(top, 'imexam')
+    write_imexam_session(paths, imexam, seed=seed)
+
+    return {'top': top, 'paths': paths, 'imexam': imexam}
+
+
+def _image_stages(session, workdir):
+    """
+    :returns list of (stage, function) of the stages that don't depend on
+             the grid size, for one session
+    """
+
+    import os
+    from box_stats import batch_box_stats
+    from frames import frame_cache, read_frame
+    from inventory import build_inventory
+    from sky_estimate import estimate_sky
+    from stacking import build_cube, coadd
+    from tidy_stats import tidy_list_skyvals
+
+    paths = session['paths']
+
+    def read():
+        for path in paths:
+            read_frame(path).sum()
+
+    def cached_read():
+        from frames import get_frame
+        frame_cache().clear()
+        for path in paths:
+            get_frame(path)
+        for path in paths:
+            get_frame(path)
+
+    def boxes():
+        for path in paths:
+            batch_box_stats(read_frame(path), [100, 400, 700, 1000],
+                            [100, 300, 500, 700], 25)
+
+    def tidy():
+        tidy_list_skyvals(session['imexam'],
+                          os.path.join(workdir, 'files_and_params.txt'),
+                          processes=1)
+
+    def sky():
+        for path in paths:
+            estimate_sky(read_frame(path))
+
+    def inventory():
+        build_inventory(session['top'], threads=1)
+
+    def stack():
+        cube = build_cube(paths, os.path.join(workdir, 'cube.npy'))
+        coadd(cube)
+        del cube
+
+    return [('read_frames', read), ('frame_cache', cached_read),
+            ('box_stats', boxes), ('tidy_stats', tidy), ('estimate_sky', sky),
+            ('inventory', inventory), ('stacking', stack)]
+
+
+def _grid_stages(session, workdir, grid, skyval=1000.0, sigma=20.0):
+    """
+    :returns list of (stage, function) of the stages run for one grid size
+    """
+
+    import os
+    import numpy as np
+    from detection import detect_frame
+    from frames import read_frame
+    from grid_photometry import grid_photometry
+    from make_grid import Grid, get_grid, make_grid
+    from polyphot_batch import parse_gsize
+    from polyphot_io import read_polyphot
+    from render import render_overlay
+    from synthetic_data import write_polyphot_log
+
+    paths = session['paths']
+    nx, ny = parse_gsize(grid)
+    logdir = os.path.join(workdir, 'logs_{}'.format(grid))
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+    logs = []
+    for path in paths:
+        data = read_frame(path)
+        log = os.path.join(logdir, os.path.basename(path) + '_photometry')
+        write_polyphot_log(log, os.path.basename(path),
+                           grid_photometry(data, nx, ny, skyval, sigma),
+                           nx, ny, skyval, sigma, 1.0, '15', 'none',
+                           shape=data.shape)
+        logs.append(log)
+
+    def grid_files():
+        make_grid(nx, ny, (1280, 960), vertices=True, directory=workdir)
+
+    # a fresh Grid each run, not the one get_grid keeps
+    detected = np.random.RandomState(0).rand(ny, nx) > 0.9
+
+    def geometry():
+        grid = Grid(nx, ny, (1280, 960))
+        grid.vertices[detected.ravel()]
+        grid.boxes(detected)
+
+    def photometry():
+        for path in paths:
+            grid_photometry(read_frame(path), nx, ny, skyval, sigma)
+
+    def polyphot_logs():
+        for log in logs:
+            read_polyphot(log)
+
+    def detection():
+        for path in paths:
+            detect_frame(read_frame(path), grids=(grid,))
+
+    vertices = get_grid(nx, ny, (1280, 960)).vertices
+
+    def render():
+        # one image is enough to see how rendering scales with the grid
+        render_overlay(read_frame(paths[0]), vertices,
+                       os.path.join(workdir, 'render.png'), title=grid)
+
+    return [('make_grid', grid_files), ('grid_geometry', geometry),
+            ('grid_photometry', photometry),
+            ('read_polyphot', polyphot_logs), ('detection', detection),
+            ('render', render)]
+
+
+def _environment():
+    """
+    :returns dictionary describing the machine and library versions
+    """
+
+    import os
+    import platform
+    import numpy as np
+
+    try:
+        import astropy
+        astropy_version = astropy.__version__
+    except ImportError:
+        astropy_version = None
+
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'astropy': astropy_version, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def run_benchmark(counts=BENCH_COUNTS, grids=BENCH_GRIDS, repeat=3,
+                  output=None, workdir=None, stages=None):
+    """
+    Run every stage on synthetic sessions of each number of images, and the
+    grid dependent ones at each grid size.
+
+    :param counts: numbers of images to benchmark with
+    :param grids: grid size strings, e.g. '64x64'
+    :param repeat: runs of each stage; the fastest is kept
+    :param output: JSON file to write, defaults to a time stamped file in
+                   BENCH_DIR
+    :param workdir: directory for the synthetic data, defaults to a
+                    temporary one that is removed afterwards
+    :param stages: names of the stages to run, or None for all of them
+
+    :returns the results dictionary that was saved
+    """
+
+    import json
+    import os
+    import shutil
+    import tempfile
+    import time
+    from grid_photometry import multi_grid_photometry
+    from frames import read_frame
+    from polyphot_batch import parse_gsize
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='cirrus_bench_')
+
+    if output is None:
+        if not os.path.isdir(BENCH_DIR):
+            os.makedirs(BENCH_DIR)
+        output = os.path.join(BENCH_DIR, 'bench_{}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S')))
+
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'environment': _environment(),
+               'config': {'counts': list(counts), 'grids': list(grids),
+                          'repeat': repeat},
+               'results': []}
+
+    def record(stage, nimages, grid, func):
+        if stages is not None and stage not in stages:
+            return
+        seconds, peak = _measure(func, repeat=repeat)
+        results['results'].append({
+            'stage': stage, 'nimages': nimages, 'grid': grid,
+            'seconds': seconds, 'per_image': seconds / nimages,
+            'peak_bytes': peak})
+        print('{:16s} {:5d} images {:>6s}  {:9.4f} s  {:8.1f} MB'.format(
+            stage, nimages, grid or '', seconds, peak / 2. ** 20))
+
+    try:
+        for nimages in counts:
+            print('Making a synthetic session of {} images...'.format(
+                nimages))
+            session = _session(workdir, nimages)
+            for stage, func in _image_stages(session, workdir):
+                record(stage, nimages, None, func)
+
+            sizes = [parse_gsize(grid) for grid in grids]
+
+            def multi():
+                for path in session['paths']:
+                    multi_grid_photometry(read_frame(path), sizes, 1000.0,
+                                          20.0)
+
+            record('multi_grid', nimages, ','.join(grids), multi)
+
+            for grid in grids:
+                for stage, func in _grid_stages(session, workdir, grid):
+                    record(stage, nimages, grid, func)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results saved to {}'.format(output))
+
+    return results
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Print how the stages of two benchmark runs compare.
+
+    :param old, new: results dictionaries or the JSON files they were saved
+                     to
+    :param threshold: relative change in time worth pointing out
+
+    :returns list of (stage, nimages, grid, old seconds, new seconds) of the
+             stages in both runs
+    """
+
+    import json
+
+    runs = []
+    for run in (old, new):
+        if not isinstance(run, dict):
+            with open(run, 'r') as f:
+                run = json.load(f)
+        runs.append(dict(((r['stage'], r['nimages'], r['grid']), r)
+                         for r in run['results']))
+
+    rows = []
+    for key in sorted(set(runs[0]) & set(runs[1]),
+                      key=lambda k: (k[0], k[1], k[2] or '')):
+        before = runs[0][key]['seconds']
+        after = runs[1][key]['seconds']
+        change = (after - before) / before if before > 0 else 0.
+        flag = ''
+        if change > threshold:
+            flag = 'slower'
+        elif change < -threshold:
+            flag = 'faster'
+        print('{:16s} {:5d} images {:>6s}  {:9.4f} -> {:9.4f} s  {:+6.1%} '
+              '{}'.format(key[0], key[1], key[2] or '', before, after,
+                          change, flag))
+        rows.append(key + (before, after))
+
+    return rows
+
+
+def latest_results(directory=BENCH_DIR):
+    """
+    :returns the most recent benchmark JSON file in a directory, or None
+    """
+
+    import glob
+    import os
+
+    files = sorted(glob.glob(os.path.join(directory, 'bench_*.json')))
+
+    return files[-1] if files else None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=list(BENCH_COUNTS))
+    parser.add_argument('--grids', nargs='+', default=list(BENCH_GRIDS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=None)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', action='store_true',
+                        help='compare with the previous run in benchmarks/')
+    args = parser.parse_args()
+
+    previous = latest_results()
+    new = run_benchmark(counts=args.counts, grids=args.grids,
+                        repeat=args.repeat, output=args.output,
+                        stages=args.stages)
+    if args.compare and previous is not None:
+        compare(previous, new)
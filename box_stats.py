@@ -10,35 +10,116 @@ def real_m_stats(self, x, y, data=None):
     data: numpy array
         The data array to work on
     """
-    import numpy as np 
-    import logging 
+    import logging
 
     if data is None:
         data = self._data
 
     region_size = self.report_stat_pars["region_size"][0]
 
-    dist = region_size / 2
-    xmin = int(x - dist)
-    xmax = int(x + dist)
-    ymin = int(y - dist)
-    ymax = int(y + dist)
-
-    stat = getattr(np, 'mean')
-    stat2 = getattr(np, 'std')
-    stat3 = getattr(np, 'median')
-    stat4 = getattr(np, 'min')
-    stat5 = getattr(np, 'max')
+    stats = batch_box_stats(data, [x], [y], region_size)[0]
 
     cols = "SLICE   NPIX   MEAN   STD   MEDIAN   MIN   MAX\n"
-    box = "[{}:{},{}:{}]  ".format(xmin, xmax, ymin, ymax)
+    box = "[{}:{},{}:{}]  ".format(stats['XMIN'], stats['XMAX'],
+                                   stats['YMIN'], stats['YMAX'])
     area = "{}  ".format(region_size)
-    sr1 = " {}  ".format(stat(data[ymin:ymax, xmin:xmax]))
-    sr2 = "{}  ".format(stat2(data[ymin:ymax, xmin:xmax]))
-    sr3 = "{}  ".format(stat3(data[ymin:ymax, xmin:xmax]))
-    sr4 = "{}  ".format(stat4(data[ymin:ymax, xmin:xmax]))
-    sr5 = "{}".format(stat5(data[ymin:ymax, xmin:xmax]))
+    sr1 = " {}  ".format(stats['MEAN'])
+    sr2 = "{}  ".format(stats['STD'])
+    sr3 = "{}  ".format(stats['MEDIAN'])
+    sr4 = "{}  ".format(stats['MIN'])
+    sr5 = "{}".format(stats['MAX'])
     pstr = cols + box + area + sr1 + sr2 + sr3 + sr4 + sr5
 
     print(pstr)
-    logging.info(pstr)
\ No newline at end of file
+    logging.info(pstr)
+
+
+def batch_box_stats(data, x, y, region_size):
+    """report the statistics of values in many boxes at once.
+    Boxes are placed the same way as in real_m_stats, and clipped to the
+    edges of the image.
+    Parameters
+    ----------
+    data: numpy array
+        The data array to work on
+    x: array-like of int
+        The x locations of the box centers
+    y: array-like of int
+        The y locations of the box centers
+    region_size: int or array-like of int
+        Side of the boxes, either one for all of them or one per box
+
+    Returns
+    -------
+    Structured array with one row per box and the fields XMIN, XMAX, YMIN,
+    YMAX (the slice of data used), NPIX, MEAN, STD, MEDIAN, MIN, MAX.
+    """
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+    size = np.broadcast_to(np.asarray(region_size, dtype=np.float64), x.shape)
+
+    dist = size / 2
+    height, width = data.shape
+    xmin = np.clip((x - dist).astype(np.int64), 0, width)
+    xmax = np.clip((x + dist).astype(np.int64), 0, width)
+    ymin = np.clip((y - dist).astype(np.int64), 0, height)
+    ymax = np.clip((y + dist).astype(np.int64), 0, height)
+
+    # MIN and MAX keep the type of the data, like np.min/np.max do
+    if np.issubdtype(data.dtype, np.integer):
+        extreme = data.dtype
+    else:
+        extreme = np.float64
+    stats = np.zeros(len(x), dtype=[('XMIN', np.int64), ('XMAX', np.int64),
+                                    ('YMIN', np.int64), ('YMAX', np.int64),
+                                    ('NPIX', np.int64), ('MEAN', np.float64),
+                                    ('STD', np.float64),
+                                    ('MEDIAN', np.float64), ('MIN', extreme),
+                                    ('MAX', extreme)])
+    stats['XMIN'], stats['XMAX'] = xmin, xmax
+    stats['YMIN'], stats['YMAX'] = ymin, ymax
+
+    # boxes of the same shape are gathered into one (nboxes, npix) array
+    # through a strided view of the image, then reduced together
+    w = xmax - xmin
+    h = ymax - ymin
+    stats['NPIX'] = w * h
+    for bh, bw in set(zip(h.tolist(), w.tolist())):
+        idx = np.nonzero((h == bh) & (w == bw))[0]
+        if bh == 0 or bw == 0:
+            stats['MEAN'][idx] = np.nan
+            stats['STD'][idx] = np.nan
+            stats['MEDIAN'][idx] = np.nan
+            continue
+
+        windows = sliding_window_view(data, (bh, bw))
+        pixels = windows[ymin[idx], xmin[idx]].reshape(len(idx), -1)
+        npix = bh * bw
+
+        # moments in one pass over the pixels. Shifting by the first pixel of
+        # each box keeps the sum of squares from losing precision.
+        shifted = pixels.astype(np.float64) - pixels[:, :1]
+        s1 = shifted.sum(axis=1)
+        s2 = np.einsum('ij,ij->i', shifted, shifted)
+        mean = s1 / npix
+        stats['MEAN'][idx] = mean + pixels[:, 0]
+        stats['STD'][idx] = np.sqrt(np.maximum(s2 / npix - mean ** 2, 0.))
+
+        # median by partitioning around the middle element(s) instead of a
+        # full sort
+        half = npix // 2
+        if npix % 2:
+            part = np.partition(pixels, half, axis=1)
+            median = part[:, half].astype(np.float64)
+        else:
+            part = np.partition(pixels, [half - 1, half], axis=1)
+            median = 0.5 * (part[:, half - 1].astype(np.float64)
+                            + part[:, half])
+        stats['MEDIAN'][idx] = median
+        stats['MIN'][idx] = pixels.min(axis=1)
+        stats['MAX'][idx] = pixels.max(axis=1)
+
+    return stats
@@ -0,0 +1,300 @@
+# ============================================================================ #
+# Bias and dark calibration. Master frames are combined from many exposures
+# in bounded memory (a strip of rows of every frame at a time for a median, a
+# running sum for a mean), cached on disk keyed by date and exposure, and
+# subtracted from each frame in memory on its way into photometry. No
+# calibrated copies of the frames are ever written.
+# ============================================================================ #
+
+MASTER_DIR = 'calibration'
+
+
+def _open_raw(paths):
+    """
+    :returns list of (memory-mapped stored array, BSCALE, BZERO) of the
+             primary images of FITS files. The files stay open for as long as
+             the arrays are referenced.
+    """
+
+    from astropy.io import fits
+
+    raws = []
+    for path in paths:
+        with fits.open(path, memmap=True, do_not_scale_image_data=True) as h:
+            raws.append((h[0].data, h[0].header.get('BSCALE', 1),
+                         h[0].header.get('BZERO', 0)))
+
+    return raws
+
+
+def combine_frames(paths, method='median', max_bytes=256 * 2 ** 20):
+    """
+    Combine many frames of the same shape into one.
+
+    :param paths: FITS files to combine
+    :param method: 'median' or 'mean'
+    :param max_bytes: most memory to use for the frames being combined. A
+                      median is taken over strips of rows small enough for
+                      every frame's strip to fit; a mean only ever holds one
+                      frame besides the running sum.
+
+    :returns float64 array of the combined frame
+    """
+
+    import numpy as np
+    from frames import decode_raw
+
+    if not paths:
+        raise ValueError('No frames to combine')
+
+    raws = _open_raw(paths)
+    shape = raws[0][0].shape
+    for path, (raw, bscale, bzero) in zip(paths, raws):
+        if raw.shape != shape:
+            raise ValueError('{} has shape {}, expected {}'.format(
+                path, raw.shape, shape))
+
+    if method == 'mean':
+        total = np.zeros(shape, dtype=np.float64)
+        for raw, bscale, bzero in raws:
+            total += decode_raw(raw, bscale, bzero)
+        return total / len(raws)
+
+    if method != 'median':
+        raise ValueError("method must be 'median' or 'mean'")
+
+    rows = max(1, int(max_bytes // (8 * len(raws) * shape[1])))
+    master = np.empty(shape, dtype=np.float64)
+    for start in range(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+        strip = np.empty((len(raws), stop - start, shape[1]),
+                         dtype=np.float64)
+        for k, (raw, bscale, bzero) in enumerate(raws):
+            strip[k] = decode_raw(raw[start:stop], bscale, bzero)
+        master[start:stop] = np.median(strip, axis=0)
+
+    return master
+
+
+def master_name(kind, date=None, exposure=None):
+    """
+    :param kind: 'bias' or 'dark'
+    :param date: 'YYYY-MM-DD' the calibration frames were taken, or None
+    :param exposure: exposure time in seconds (darks), or None
+
+    :returns file name of the master, e.g. 'dark_2016-10-09_0.0003.npy'
+    """
+
+    parts = [kind, date or 'undated']
+    if exposure is not None:
+        parts.append(repr(round(float(exposure), 9)))
+
+    return '_'.join(parts) + '.npy'
+
+
+def _sources(paths):
+    """
+    :returns what the master depends on: the size and modification time of
+             every frame that went into it
+    """
+
+    import os
+
+    sources = []
+    for path in sorted(paths):
+        st = os.stat(path)
+        sources.append([os.path.abspath(path), st.st_size, st.st_mtime])
+
+    return sources
+
+
+def build_master(paths, kind, cache_dir=MASTER_DIR, date=None, exposure=None,
+                 method='median', bias=None, max_bytes=256 * 2 ** 20):
+    """
+    Build a master bias or dark, or load it from the cache if it was built
+    from the same frames before.
+
+    :param paths: bias or dark frames to combine
+    :param kind: 'bias' or 'dark'
+    :param cache_dir: directory the masters are kept in
+    :param date: 'YYYY-MM-DD' the frames were taken, or None
+    :param exposure: exposure time of darks in seconds
+    :param method: 'median' or 'mean', see combine_frames
+    :param bias: for darks, an optional master bias to subtract, so the dark
+                 holds only the dark current
+    :param max_bytes: memory limit of the combine, see combine_frames
+
+    :returns the master frame
+    """
+
+    import json
+    import os
+    import numpy as np
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    filename = os.path.join(cache_dir, master_name(kind, date, exposure))
+    sidecar = filename[:-4] + '.json'
+    sources = {'frames': _sources(paths), 'method': method,
+               'bias': bias is not None}
+
+    if os.path.exists(filename) and os.path.exists(sidecar):
+        with open(sidecar, 'r') as f:
+            if json.load(f) == sources:
+                return np.load(filename)
+
+    print('Building master {} from {} frames...'.format(
+        master_name(kind, date, exposure)[:-4], len(paths)))
+    master = combine_frames(paths, method=method, max_bytes=max_bytes)
+    if bias is not None:
+        master -= bias
+
+    np.save(filename, master)
+    with open(sidecar, 'w') as f:
+        json.dump(sources, f)
+
+    return master
+
+
+class Calibration(object):
+    """
+    The masters of a cache directory, applied to frames in memory. Masters
+    are looked up by the date of the frame (from its dated directory) and,
+    for darks, its exposure; an undated master is used when there is none
+    for the date. Loaded masters are kept for the next frame, and loaded
+    again if build_master rebuilds them.
+
+    Can be sent to worker processes; each loads the masters it needs.
+
+    :param cache_dir: directory the masters were built in, see build_master
+    """
+
+    def __init__(self, cache_dir=MASTER_DIR):
+        self.cache_dir = cache_dir
+        self._masters = {}
+
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.cache_dir = state['cache_dir']
+        self._masters = {}
+
+    def master(self, kind, date=None, exposure=None):
+        """
+        :returns the master for a date and exposure, or None if there is
+                 none
+        """
+
+        return self._lookup(kind, date, exposure)[1]
+
+    def _lookup(self, kind, date, exposure):
+        """
+        :returns (file name, master, whether it is a dark with the bias
+                 taken out), or (None, None, False)
+        """
+
+        import hashlib
+        import json
+        import os
+        import numpy as np
+
+        for name in (master_name(kind, date, exposure),
+                     master_name(kind, None, exposure)):
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            stamp = (st.st_size, st.st_mtime_ns)
+
+            entry = self._masters.get(name)
+            if entry is None or entry[0] != stamp:
+                with open(filename[:-4] + '.json', 'rb') as f:
+                    sidecar = f.read()
+                # the frames the master was built from, and when it was
+                # written, identify it; see fingerprint
+                digest = hashlib.sha1(sidecar)
+                digest.update('{} {}'.format(*stamp).encode())
+                entry = (stamp, np.load(filename),
+                         json.loads(sidecar.decode())['bias'],
+                         digest.hexdigest())
+                self._masters[name] = entry
+
+            return name, entry[1], entry[2]
+
+        return None, None, False
+
+    def _applied(self, path, exposure):
+        """
+        :returns list of (file name, master) of the masters subtracted from
+                 a frame. A dark that still holds the bias (built without
+                 one) is subtracted on its own.
+        """
+
+        from tidy_stats import parse_date
+
+        date = parse_date(path)
+        bias_name, bias = self._lookup('bias', date, None)[:2]
+        dark_name, dark, debiased = self._lookup('dark', date, exposure)
+
+        applied = []
+        if dark is not None:
+            applied.append((dark_name, dark))
+        if bias is not None and (dark is None or debiased):
+            applied.append((bias_name, bias))
+
+        return applied
+
+    def fingerprint(self, path, exposure=None):
+        """
+        What the calibration of a frame depends on, for the parameters of
+        results measured on it (see manifest.Manifest and
+        result_cache.ResultCache): the name of every master subtracted from
+        it, and a hash of the frames it was built from (its sidecar) and of
+        when it was written. Rebuilding or adding a master changes it.
+
+        :param path: FITS file of the frame
+        :param exposure: its exposure time in seconds
+
+        :returns list of [master file name, hex digest]
+        """
+
+        return [[name, self._masters[name][3]]
+                for name, master in self._applied(path, exposure)]
+
+    def apply(self, data, path, exposure=None, out=None):
+        """
+        Subtract the bias and dark from a frame. A dark that still holds the
+        bias (built without one) is subtracted on its own.
+
+        The frame itself can't be calibrated in place: frames come from the
+        frame cache read-only (memory maps or decoded uint16 shared by every
+        stage), and the result needs floats anyway. The first subtraction
+        writes straight into the float64 result, so there is no separate
+        copy of the frame; pass out= to reuse a buffer between frames.
+
+        :param data: the frame, as from frames.get_frame. It isn't changed.
+        :param path: its FITS file, for the date
+        :param exposure: its exposure time in seconds, for the dark
+        :param out: optional float64 array of the frame's shape to write the
+                    result to
+
+        :returns the calibrated frame as float64 (out, if given)
+        """
+
+        import numpy as np
+
+        masters = [master for name, master in self._applied(path, exposure)]
+        if out is None:
+            out = np.empty(np.shape(data), dtype=np.float64)
+        if not masters:
+            out[...] = data
+            return out
+
+        np.subtract(data, masters[0], out=out)
+        for master in masters[1:]:
+            out -= master
+
+        return out
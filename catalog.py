@@ -0,0 +1,291 @@
+# ============================================================================ #
+# SQLite catalog of a session (or a whole season): images with their filters,
+# exposure and sky statistics, and per grid size summaries of the photometry.
+# Replaces files_and_params.txt: every stage can read and write it, and
+# subsets are selected with indexed queries instead of re-parsing text files.
+# ============================================================================ #
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    image TEXT NOT NULL,
+    path TEXT NOT NULL,
+    date TEXT,
+    time TEXT,
+    exposure REAL,
+    filter1 TEXT,
+    filter2 TEXT,
+    skyval REAL,
+    sigma REAL,
+    skyerr REAL,
+    UNIQUE (path, image)
+);
+CREATE INDEX IF NOT EXISTS images_filters ON images (filter1, filter2);
+CREATE INDEX IF NOT EXISTS images_exposure ON images (exposure);
+CREATE INDEX IF NOT EXISTS images_date ON images (date, time);
+
+CREATE TABLE IF NOT EXISTS photometry (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    grid TEXT NOT NULL,
+    cell_area REAL,
+    min_counts REAL,
+    max_counts REAL,
+    threshold REAL,
+    max_snr REAL,
+    threshold_multiple REAL,
+    ndetected INTEGER,
+    PRIMARY KEY (image_id, grid)
+);
+CREATE INDEX IF NOT EXISTS photometry_snr ON photometry (grid, max_snr);
+'''
+
+IMAGE_FIELDS = ['image', 'path', 'date', 'time', 'exposure', 'filter1',
+                'filter2', 'skyval', 'sigma', 'skyerr']
+
+SUMMARY_FIELDS = ['cell_area', 'min_counts', 'max_counts', 'threshold',
+                  'max_snr', 'threshold_multiple', 'ndetected']
+
+
+def is_catalog(path):
+    """
+    :returns True if path names a catalog rather than a text file
+    """
+
+    return path.endswith('.db') or path.endswith('.sqlite')
+
+
+def connect(path):
+    """
+    Open a catalog, creating the tables and indexes if they aren't there.
+
+    :param path: catalog file, e.g. 'session.db'
+
+    :returns sqlite3 connection
+    """
+
+    import sqlite3
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def image_row(record):
+    """
+    :param record: one line of files_and_params.txt as a list or tuple:
+                   [IMAGE, SKYVAL, SIGMA, SKYVAL ERR, EXPOSURE, FILTER 1,
+                   FILTER 2, PATH]
+
+    :returns dictionary with the columns of the images table
+    """
+
+    from tidy_stats import parse_date, parse_time
+
+    image, skyval, sigma, skyerr, exposure, filter1, filter2, path = record[:8]
+    return {'image': image, 'path': path,
+            'date': parse_date(path + image), 'time': parse_time(image),
+            'exposure': float(exposure), 'filter1': filter1,
+            'filter2': filter2, 'skyval': float(skyval),
+            'sigma': float(sigma), 'skyerr': float(skyerr)}
+
+
+def add_images(conn, rows):
+    """
+    Insert or update images in the catalog. An image already in the catalog
+    (same path and name) has its values replaced, its photometry summaries
+    are kept.
+
+    :param conn: connection from connect
+    :param rows: iterable of dictionaries with (some of) the IMAGE_FIELDS.
+                 image and path are required.
+    """
+
+    sql = ('INSERT INTO images ({0}) VALUES ({1}) '
+           'ON CONFLICT (path, image) DO UPDATE SET {2}').format(
+        ', '.join(IMAGE_FIELDS), ', '.join(['?'] * len(IMAGE_FIELDS)),
+        ', '.join('{0} = COALESCE(excluded.{0}, {0})'.format(f)
+                  for f in IMAGE_FIELDS[2:]))
+
+    with conn:
+        conn.executemany(sql, ([row.get(f) for f in IMAGE_FIELDS]
+                               for row in rows))
+
+
+def import_params_file(conn, param_file):
+    """
+    Load a files_and_params.txt into the catalog.
+
+    :param conn: connection from connect
+    :param param_file: path to the files_and_params.txt file
+    """
+
+    from polyphot_batch import read_params
+
+    image_data, logs = read_params(param_file)
+    add_images(conn, (image_row(record) for record in image_data))
+
+
+def add_summaries(conn, grid, rows):
+    """
+    Store per-image photometry summaries for one grid size.
+
+    :param conn: connection from connect
+    :param grid: grid size string, e.g. '64x64'
+    :param rows: iterable of dictionaries with image, path and (some of) the
+                 SUMMARY_FIELDS
+    """
+
+    sql = ('INSERT OR REPLACE INTO photometry (image_id, grid, {0}) '
+           'SELECT id, ?, {1} FROM images WHERE path = ? AND image = ?'
+           ).format(', '.join(SUMMARY_FIELDS),
+                    ', '.join(['?'] * len(SUMMARY_FIELDS)))
+
+    with conn:
+        conn.executemany(sql, ([grid] + [row.get(f) for f in SUMMARY_FIELDS]
+                               + [row['path'], row['image']]
+                               for row in rows))
+
+
+def _where(filter1=None, filter2=None, exposure=None, min_exposure=None,
+           max_exposure=None, date=None, grid=None, min_snr=None):
+    """
+    SQL conditions and parameters for the selections used by query_images.
+    """
+
+    conditions = []
+    params = []
+    for sql, value in [('i.filter1 = ?', filter1), ('i.filter2 = ?', filter2),
+                       ('abs(i.exposure - ?) < 1e-9', exposure),
+                       ('i.exposure >= ?', min_exposure),
+                       ('i.exposure <= ?', max_exposure),
+                       ('i.date = ?', date), ('p.grid = ?', grid),
+                       ('p.max_snr > ?', min_snr)]:
+        if value is not None:
+            conditions.append(sql)
+            params.append(value)
+
+    if not conditions:
+        return '', params
+
+    return ' WHERE ' + ' AND '.join(conditions), params
+
+
+def query_images(conn, filter1=None, filter2=None, exposure=None,
+                 min_exposure=None, max_exposure=None, date=None, grid=None,
+                 min_snr=None, as_frame=True):
+    """
+    Select images from the catalog. All selections are optional and are
+    combined with AND. Selecting on grid or min_snr joins in the photometry
+    summaries (so only images with photometry on that grid are returned);
+    otherwise one row per image is returned.
+
+    For example, all Orion82aBlue-Celestron47Purple frames under 1 ms with
+    SNR above 2 on the 64x64 grid:
+        query_images(conn, 'Orion82aBlue', 'Celestron47Purple',
+                     max_exposure=0.001, grid='64x64', min_snr=2)
+
+    :param conn: connection from connect
+    :param filter1, filter2: filter names
+    :param exposure: exact exposure time in seconds
+    :param min_exposure, max_exposure: exposure range in seconds
+    :param date: 'YYYY-MM-DD'
+    :param grid: grid size string of the photometry summary to join in
+    :param min_snr: only images whose largest cell SNR is above this
+    :param as_frame: return a pandas DataFrame if True, otherwise a NumPy
+                     structured array
+
+    :returns the selected rows
+    """
+
+    import numpy as np
+
+    columns = ['i.' + f for f in IMAGE_FIELDS]
+    join = ''
+    if grid is not None or min_snr is not None:
+        columns += ['p.grid'] + ['p.' + f for f in SUMMARY_FIELDS]
+        join = ' JOIN photometry p ON p.image_id = i.id'
+
+    where, params = _where(filter1, filter2, exposure, min_exposure,
+                           max_exposure, date, grid, min_snr)
+    sql = 'SELECT {} FROM images i{}{} ORDER BY i.date, i.time, ' \
+          'i.image'.format(', '.join(columns), join, where)
+    rows = conn.execute(sql, params).fetchall()
+    names = [c.split('.')[1] for c in columns]
+
+    if as_frame:
+        from pandas import DataFrame
+        return DataFrame(rows, columns=names)
+
+    text = ('image', 'path', 'date', 'time', 'filter1', 'filter2', 'grid')
+    dtype = []
+    for k, name in enumerate(names):
+        if name in text:
+            width = max([len(r[k]) for r in rows if r[k] is not None] + [1])
+            dtype.append((name, 'U{}'.format(width)))
+        else:
+            dtype.append((name, np.float64))
+
+    # missing values become '' for text and nan for numbers
+    return np.array([tuple(('' if v is None else v) if name in text
+                           else (np.nan if v is None else v)
+                           for v, name in zip(r, names)) for r in rows],
+                    dtype=dtype)
+
+
+def image_data(conn, **selection):
+    """
+    Images of the catalog in the same form polyphot_batch.read_params returns
+    them, so the photometry stages can run straight from the catalog.
+
+    :param conn: connection from connect
+    :param selection: any of the selections of query_images
+
+    :returns list of [IMAGE, SKYVAL, SIGMA, SKYVAL ERR, EXPOSURE, FILTER 1,
+             FILTER 2, PATH] lists of strings
+    """
+
+    df = query_images(conn, as_frame=True, **selection)
+
+    return [[r.image, str(r.skyval), str(r.sigma), str(r.skyerr),
+             str(r.exposure), r.filter1, r.filter2, r.path]
+            for r in df.itertuples()]
+
+
+def write_params(output, records):
+    """
+    Write image parameters either to a files_and_params.txt style text file
+    or, if output is a catalog, into its images table.
+
+    :param output: text file or catalog ('.db' or '.sqlite') to write
+    :param records: iterable of [IMAGE, SKYVAL, SIGMA, SKYVAL ERR, EXPOSURE,
+                    FILTER 1, FILTER 2, PATH] sequences. It is consumed as it
+                    is written, so it may be a generator.
+    """
+
+    if is_catalog(output):
+        conn = connect(output)
+        add_images(conn, (image_row(record) for record in records))
+        conn.close()
+        return
+
+    wstr = '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'
+    with open(output, 'w') as f:
+        f.write('# IMAGE \t SKY VAL \t SIGMA \t SKYVAL ERR \t EXPOSURE \t '
+                'FILTER 1 \t FILTER 2 \t PATH\n')
+        for record in records:
+            f.write(wstr.format(*record))
+
+
+def export_params_file(conn, output='files_and_params.txt', **selection):
+    """
+    Write (a selection of) the catalog out as a files_and_params.txt for
+    tools that still want the text file.
+
+    :param conn: connection from connect
+    :param output: file to write
+    :param selection: any of the selections of query_images
+    """
+
+    write_params(output, image_data(conn, **selection))
@@ -0,0 +1,458 @@
+# ============================================================================ #
+# Batch cirrus detection. Works on the photometry of a whole session at once:
+# the detection threshold of every cell comes from its real area and the sky
+# values of its image, every cell gets a signal to noise ratio, and each image
+# gets a grid-shaped SNR map and one summary row, all in one vectorized pass
+# over the photometry store.
+# ============================================================================ #
+
+SUMMARY_DTYPE = [('cell_area', 'f8'), ('min_counts', 'f8'),
+                 ('max_counts', 'f8'), ('threshold', 'f8'), ('max_snr', 'f8'),
+                 ('threshold_multiple', 'f8'), ('ndetected', 'i8')]
+
+
+def background_per_cell(skyval, sigma, area):
+    """
+    :param skyval: sky value per pixel (SKYVAL or polyphot's MSKY)
+    :param sigma: sigma of the sky per pixel
+    :param area: cell area in pixels
+
+    :returns the sky counts expected in a cell and their error. Scalars or
+             arrays, which broadcast together.
+    """
+
+    bg_per_cell = skyval * area
+    bg_err_per_px = sigma / 25
+    bg_err_per_cell = bg_err_per_px * area
+
+    return bg_per_cell, bg_err_per_cell
+
+
+def detection_threshold(skyval, sigma, area, nsigma=3.0):
+    """
+    :param skyval: sky value per pixel
+    :param sigma: sigma of the sky per pixel
+    :param area: cell area in pixels
+    :param nsigma: how many errors above the background a detection has to be
+
+    :returns the counts a cell needs to count as a detection
+    """
+
+    bg_per_cell, bg_err_per_cell = background_per_cell(skyval, sigma, area)
+
+    return bg_per_cell + nsigma * bg_err_per_cell
+
+
+def cell_snr(counts, area, skyval, sigma):
+    """
+    :param counts: summed counts of each cell
+    :param area: cell areas in pixels
+    :param skyval: sky value per pixel
+    :param sigma: sigma of the sky per pixel
+
+    :returns signal to noise ratio of each cell above the sky: the counts in
+             excess of the background in units of the background error. A
+             cell is detected at nsigma when its SNR reaches nsigma.
+    """
+
+    bg_per_cell, bg_err_per_cell = background_per_cell(skyval, sigma, area)
+
+    return (counts - bg_per_cell) / bg_err_per_cell
+
+
+def _segments(image, path):
+    """
+    :returns start of each run of cells belonging to one image, for the
+             per-cell arrays of a photometry store
+    """
+
+    import numpy as np
+
+    if not len(image):
+        return np.zeros(0, dtype=np.int64)
+
+    change = (image[1:] != image[:-1]) | (path[1:] != path[:-1])
+
+    return np.concatenate([[0], np.nonzero(change)[0] + 1])
+
+
+def summarize_cells(counts, area, skyval, sigma, starts, nsigma=3.0):
+    """
+    Detection summary of many images at once.
+
+    :param counts, area, skyval, sigma: per-cell arrays of all the images,
+                                        one image after the other
+    :param starts: index of the first cell of each image
+    :param nsigma: detection level, see detection_threshold
+
+    :returns (per-cell SNR array, structured array with one SUMMARY_DTYPE
+             row per image). threshold is the threshold of the cell with the
+             most counts and threshold_multiple is that cell's counts in
+             multiples of it.
+    """
+
+    import numpy as np
+
+    counts = np.asarray(counts, dtype=np.float64)
+    area = np.asarray(area, dtype=np.float64)
+    snr = cell_snr(counts, area, skyval, sigma)
+    threshold = detection_threshold(skyval, sigma, area, nsigma)
+    ncells = np.diff(np.append(starts, len(counts)))
+
+    summary = np.zeros(len(starts), dtype=SUMMARY_DTYPE)
+    if not len(starts):
+        return snr, summary
+
+    summary['cell_area'] = np.add.reduceat(area, starts) / ncells
+    summary['min_counts'] = np.minimum.reduceat(counts, starts)
+    summary['max_counts'] = np.maximum.reduceat(counts, starts)
+    summary['max_snr'] = np.maximum.reduceat(snr, starts)
+    summary['ndetected'] = np.add.reduceat(snr >= nsigma, starts)
+
+    # cell with the most counts of every image: first cell in its segment
+    # holding the maximum
+    image_of_cell = np.repeat(np.arange(len(starts)), ncells)
+    is_max = counts == summary['max_counts'][image_of_cell]
+    brightest = np.minimum.reduceat(np.where(is_max, np.arange(len(counts)),
+                                             len(counts)), starts)
+    summary['threshold'] = threshold[brightest]
+    summary['threshold_multiple'] = counts[brightest] / threshold[brightest]
+
+    return snr, summary
+
+
+def save_snr_map(snr_map, filename):
+    """
+    :param snr_map: (ny, nx) SNR array of one image
+    :param filename: '.fits' files are written with astropy, anything else
+                     with np.save
+    """
+
+    import numpy as np
+
+    if filename.endswith('.fits'):
+        from astropy.io import fits
+        fits.PrimaryHDU(snr_map).writeto(filename, overwrite=True)
+    else:
+        np.save(filename, snr_map)
+
+
+def load_snr_map(filename):
+    """
+    :returns the SNR map saved by save_snr_map
+    """
+
+    import numpy as np
+
+    if filename.endswith('.fits'):
+        from astropy.io import fits
+        return fits.getdata(filename)
+
+    return np.load(filename)
+
+
+def _snr_map_file(path, image, grid, maps):
+    """
+    :returns the SNR map file of an image, '<image>_snr_<grid>.<maps>'. With
+             maps None, whichever of the '.fits' and '.npy' maps exists, or
+             None.
+    """
+
+    import os
+
+    if maps is not None:
+        return '{}{}_snr_{}.{}'.format(path, image[:-4], grid, maps)
+
+    for ext in ('fits', 'npy'):
+        filename = _snr_map_file(path, image, grid, ext)
+        if os.path.exists(filename):
+            return filename
+
+    return None
+
+
+def _detection_params(cells, start, ncells, grid, nsigma):
+    """
+    Parameters the detection of one image depends on, as recorded in the
+    manifest: the grid, the detection level, the sky and a hash of the
+    photometry of its cells.
+    """
+
+    import hashlib
+    import numpy as np
+
+    cut = slice(start, start + ncells)
+    digest = hashlib.sha1(np.ascontiguousarray(cells['counts'][cut],
+                                               dtype=np.float64))
+    digest.update(np.ascontiguousarray(cells['area'][cut], dtype=np.float64))
+
+    return {'grid': grid, 'nsigma': float(nsigma),
+            'skyval': float(cells['skyval'][start]),
+            'sigma': float(cells['sigma'][start]),
+            'photometry': digest.hexdigest()}
+
+
+def detect_store(store, grid, nsigma=3.0, catalog=None, maps='fits',
+                 manifest=None, **selection):
+    """
+    Run detection on every image of a photometry store for one grid size.
+
+    :param store: photometry store written by the batch photometry stage
+    :param grid: grid size string, e.g. '64x64'
+    :param nsigma: detection level, see detection_threshold
+    :param catalog: optional session catalog ('.db' or '.sqlite') to store
+                    the summaries in, see catalog.add_summaries
+    :param maps: 'fits' or 'npy' to write the SNR map of each image to
+                 '<image>_snr_<grid>.<maps>' in the image's directory, or
+                 None to not write them
+    :param manifest: optional manifest.Manifest of the session. Images
+                     detected before from the same file, photometry and
+                     nsigma, whose SNR map is on disk, are taken from it
+                     instead of detected again (stage 'detection <grid>').
+    :param selection: filter1, filter2, exposure, min_exposure, max_exposure
+                      or images selections of photometry_store.read_store
+
+    :returns (structured array with image, path, grid and the SUMMARY_DTYPE
+             fields, one row per image; dictionary of the (ny, nx) SNR maps
+             keyed by (path, image))
+    """
+
+    import os
+    import numpy as np
+    from photometry_store import read_store
+    from polyphot_batch import parse_gsize
+
+    nx, ny = parse_gsize(grid)
+    ncells = nx * ny
+    stage = 'detection ' + grid
+    cells = read_store(store, columns=['image', 'path', 'skyval', 'sigma',
+                                       'counts', 'area'],
+                       grid=grid, **selection)
+    image = np.asarray(cells['image']).astype(str)
+    path = np.asarray(cells['path']).astype(str)
+    starts = _segments(image, path)
+    names = list(zip(path[starts].tolist(), image[starts].tolist()))
+
+    # images with an up to date detection and SNR map are not detected again
+    params = [None] * len(starts)
+    reused = {}
+    if manifest is not None:
+        for k, (p, im) in enumerate(names):
+            params[k] = _detection_params(cells, starts[k], ncells, grid,
+                                          nsigma)
+            mapfile = _snr_map_file(p, im, grid, maps)
+            if mapfile is not None and os.path.exists(mapfile) and \
+                    manifest.is_done(stage, p + im, params[k]):
+                reused[k] = (manifest.result(stage, p + im),
+                             load_snr_map(mapfile))
+    todo = np.array([k for k in range(len(starts)) if k not in reused],
+                    dtype=np.intp)
+
+    # cells are stored x fastest from the first row, one image after another
+    if len(todo) < len(starts):
+        index = (starts[todo][:, None] + np.arange(ncells)).ravel()
+        offsets = np.arange(len(todo)) * ncells
+        snr, stats = summarize_cells(
+            cells['counts'][index], cells['area'][index],
+            cells['skyval'][index], cells['sigma'][index], offsets,
+            nsigma=nsigma)
+    else:
+        offsets = starts
+        snr, stats = summarize_cells(cells['counts'], cells['area'],
+                                     cells['skyval'], cells['sigma'], starts,
+                                     nsigma=nsigma)
+
+    summary = np.zeros(len(starts), dtype=[('image', image.dtype),
+                                           ('path', path.dtype),
+                                           ('grid', 'U{}'.format(len(grid)))]
+                       + SUMMARY_DTYPE)
+    summary['image'] = image[starts]
+    summary['path'] = path[starts]
+    summary['grid'] = grid
+    for name, dtype in SUMMARY_DTYPE:
+        summary[name][todo] = stats[name]
+        for k, (result, snr_map) in reused.items():
+            summary[name][k] = result[name]
+
+    snr_maps = {}
+    for j, k in enumerate(todo.tolist()):
+        p, im = names[k]
+        snr_maps[(p, im)] = snr[offsets[j]:offsets[j] + ncells].reshape(ny,
+                                                                       nx)
+        if maps is not None:
+            save_snr_map(snr_maps[(p, im)], _snr_map_file(p, im, grid, maps))
+        if manifest is not None:
+            manifest.mark_done(stage, p + im, params[k], result=dict(
+                (name, summary[name][k].item())
+                for name, dtype in SUMMARY_DTYPE))
+    for k, (result, snr_map) in reused.items():
+        snr_maps[names[k]] = snr_map
+
+    if manifest is not None:
+        print('Detection on {} images ({} already done)'.format(
+            len(todo), len(reused)))
+        manifest.save()
+
+    if catalog is not None:
+        from catalog import connect, add_summaries
+        conn = connect(catalog)
+        add_summaries(conn, grid, (dict(zip(summary.dtype.names, row))
+                                   for row in summary.tolist()))
+        conn.close()
+
+    return summary, snr_maps
+
+
+def write_summary(summary, filename):
+    """
+    Write detection summaries as one tab separated table, replacing the
+    '<name> SNR stats.txt' file that was written for every image.
+
+    :param summary: structured array returned by detect_store
+    :param filename: file to write
+    """
+
+    names = summary.dtype.names
+    with open(filename, 'w') as f:
+        f.write('# ' + ' \t '.join(n.upper() for n in names) + '\n')
+        for row in summary.tolist():
+            f.write('\t'.join(str(v) for v in row) + '\n')
+
+
+def _loader(data):
+    """
+    :param data: image array, or a function of no arguments returning it
+
+    :returns function returning the image, calling data at most once
+    """
+
+    frame = []
+
+    def load():
+        if not frame:
+            frame.append(data() if callable(data) else data)
+        return frame[0]
+
+    return load
+
+
+def measure_sky(data, cache=None, path=None, params=None):
+    """
+    :param data: 2D image array, or a function of no arguments returning it,
+                 only called if the sky isn't cached
+    :param cache, path, params: see detect_frame
+
+    :returns the sky of a frame, see sky_estimate.estimate_sky
+    """
+
+    from sky_estimate import estimate_sky
+
+    load = _loader(data)
+    if cache is None:
+        return estimate_sky(load())
+
+    return cache.memoize('sky', path, params, lambda: estimate_sky(load()))
+
+
+def measure_grids(data, grids, sky, itime=1.0, cache=None, path=None,
+                  params=None):
+    """
+    Grid photometry of a frame on several grid sizes, from a single pass
+    over the image for all the grids that aren't cached.
+
+    :param data: 2D image array, or a function of no arguments returning it,
+                 only called if some grid isn't cached
+    :param grids: grid size strings, e.g. ('10x10', '64x64')
+    :param sky: the frame's sky, as from measure_sky
+    :param itime: exposure time in seconds, for the magnitudes
+    :param cache, path, params: see detect_frame
+
+    :returns dictionary of photometry results keyed by grid, see
+             grid_photometry.grid_photometry
+    """
+
+    from grid_photometry import multi_grid_photometry
+    from polyphot_batch import parse_gsize
+
+    load = _loader(data)
+
+    # same keys as polyphot_batch.photometer_image uses
+    def key(grid):
+        return dict(params or {}, gsize=grid, exposure=itime,
+                    **dict((k, sky[k]) for k in ('skyval', 'sigma',
+                                                 'skyerr')))
+
+    phot = {}
+    if cache is not None:
+        for grid in grids:
+            result = cache.get('photometry', path, key(grid))
+            if result is not None:
+                phot[grid] = result
+
+    missing = [g for g in grids if g not in phot]
+    if missing:
+        measured = multi_grid_photometry(
+            load(), [parse_gsize(g) for g in missing], sky['skyval'],
+            sky['sigma'], itime=itime, skyerr=sky['skyerr'])
+        for grid in missing:
+            phot[grid] = measured[parse_gsize(grid)]
+            if cache is not None:
+                cache.put('photometry', path, key(grid), phot[grid])
+
+    return phot
+
+
+def detect_grids(phot, sky, nsigma=3.0):
+    """
+    :param phot: photometry keyed by grid, as from measure_grids
+    :param sky: the frame's sky
+    :param nsigma: detection level, see detection_threshold
+
+    :returns dictionary keyed by grid of (ny, nx) SNR map and summary
+             dictionary with the SUMMARY_DTYPE fields
+    """
+
+    from polyphot_batch import parse_gsize
+
+    results = {}
+    for grid, cells in phot.items():
+        nx, ny = parse_gsize(grid)
+        snr, summary = summarize_cells(cells['counts'], cells['area'],
+                                       sky['skyval'], sky['sigma'], [0],
+                                       nsigma=nsigma)
+        results[grid] = (snr.reshape(ny, nx),
+                         dict(zip(summary.dtype.names, summary[0].tolist())))
+
+    return results
+
+
+def detect_frame(data, grids=('64x64',), nsigma=3.0, itime=1.0, cache=None,
+                 path=None, params=None):
+    """
+    Sky estimation, grid photometry and detection for one frame (or co-add)
+    held in memory.
+
+    :param data: 2D image array, or a function of no arguments returning it.
+                 A function is only called if something has to be measured.
+    :param grids: grid size strings to measure, e.g. ('10x10', '64x64')
+    :param nsigma: detection level, see detection_threshold
+    :param itime: exposure time in seconds, for the magnitudes
+    :param cache: optional result_cache.ResultCache. The sky and the
+                  photometry of every grid are loaded from it when the frame
+                  was measured before with the same parameters, so changing
+                  only nsigma or adding a grid size measures nothing else.
+    :param path: FITS file the frame came from, needed with a cache
+    :param params: anything else the frame depends on (e.g. the calibration
+                   directory), part of the cache keys
+
+    :returns (sky dictionary as from sky_estimate.estimate_sky, dictionary
+             keyed by grid of (ny, nx) SNR map and summary dictionary with
+             the SUMMARY_DTYPE fields)
+    """
+
+    load = _loader(data)
+    sky = measure_sky(load, cache=cache, path=path, params=params)
+    phot = measure_grids(load, grids, sky, itime=itime, cache=cache,
+                         path=path, params=params)
+
+    return sky, detect_grids(phot, sky, nsigma=nsigma)
@@ -0,0 +1,308 @@
+# ============================================================================ #
+# Shared access to the FITS frames. Files are opened memory-mapped and kept in
+# their native integer type (the camera's unsigned 16 bit counts come back as
+# uint16 rather than float), and decoded frames are held in a size-bounded
+# least-recently-used cache, so the stages run in one process (sky, photometry,
+# detection, plotting) read each frame from disk only once.
+#
+# The limit is per process. Worker processes of parallel.parallel_map and
+# shared_frames.fan_out touch each frame once, so they are set to the much
+# smaller WORKER_CACHE_BYTES: enough for the stages of one job to share a
+# frame, without every worker holding DEFAULT_CACHE_BYTES of frames it will
+# never read again. Frames with BZERO are decoded copies, not file pages.
+# ============================================================================ #
+
+DEFAULT_CACHE_BYTES = 512 * 2 ** 20
+
+# a few 1280x960 frames (about 2.5 MB as uint16, 10 MB as float64)
+WORKER_CACHE_BYTES = 32 * 2 ** 20
+
+
+def read_frame(path):
+    """
+    Read the primary image of a FITS file.
+
+    :param path: FITS file
+
+    :returns read-only 2D array, see decode_raw
+    """
+
+    from astropy.io import fits
+
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        data = decode_raw(hdul[0].data, hdul[0].header.get('BSCALE', 1),
+                          hdul[0].header.get('BZERO', 0))
+
+    data.flags.writeable = False
+
+    return data
+
+
+def decode_raw(raw, bscale=1, bzero=0):
+    """
+    Turn (part of) the stored array of a FITS image into counts.
+
+    Unscaled data is returned as it is, so a memory map stays a memory map.
+    Unsigned 16 bit data (BITPIX 16 with BZERO 32768) is decoded to native
+    uint16 by flipping the sign bit, anything else with BSCALE/BZERO is
+    scaled to float64.
+
+    :param raw: array as stored in the file, e.g. opened with
+                do_not_scale_image_data=True
+    :param bscale, bzero: the scaling keywords of the header
+    """
+
+    import numpy as np
+
+    if bscale == 1 and bzero == 0:
+        return raw
+
+    if bscale == 1 and bzero == 32768 and raw.dtype.itemsize == 2 \
+            and raw.dtype.kind == 'i':
+        data = raw.astype(np.uint16)
+        data ^= np.uint16(0x8000)
+        return data
+
+    return raw * np.float64(bscale) + bzero
+
+
+def _stamp(path):
+    """
+    :returns the absolute path of a file and its (size, mtime), which tell
+             whether a cached frame is still current
+    """
+
+    import os
+
+    key = os.path.abspath(path)
+    st = os.stat(key)
+
+    return key, (st.st_size, st.st_mtime)
+
+
+class FrameCache(object):
+    """
+    Least-recently-used cache of decoded frames, bounded by their total size.
+    A frame is read again if its file changed since it was cached.
+
+    Frames are returned read-only since they are shared; copy one before
+    changing it.
+
+    :param max_bytes: most bytes of frame data to keep. The most recently
+                      used frame is always kept, even if it is bigger.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        from collections import OrderedDict
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+
+    def get(self, path):
+        """
+        :param path: FITS file
+
+        :returns the frame's data, see read_frame
+        """
+
+        key, stamp = _stamp(path)
+        entry = self._frames.get(key)
+        if entry is not None and entry[0] == stamp:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        from instrument import stage
+
+        self.misses += 1
+        with stage('read_frame', key):
+            data = read_frame(key)
+        self.put(key, stamp, data)
+
+        return data
+
+    def is_current(self, path):
+        """
+        :returns True if the cache holds the frame as it is on disk now
+        """
+
+        key, stamp = _stamp(path)
+        entry = self._frames.get(key)
+
+        return entry is not None and entry[0] == stamp
+
+    def put(self, path, stamp, data):
+        """
+        Add a frame that was read elsewhere, e.g. by prefetch.
+
+        :param path: FITS file
+        :param stamp: (size, mtime) of the file when it was read
+        :param data: the frame's data
+        """
+
+        import os
+
+        key = os.path.abspath(path)
+        if key in self._frames:
+            self._discard(key)
+
+        self._frames[key] = (stamp, data)
+        self.nbytes += data.nbytes
+        self.resize(self.max_bytes)
+
+    def resize(self, max_bytes):
+        """
+        Change the size limit, dropping the least recently used frames until
+        the cache fits.
+
+        :param max_bytes: most bytes of frame data to keep
+        """
+
+        self.max_bytes = max_bytes
+        while self.nbytes > max_bytes and len(self._frames) > 1:
+            self._discard(next(iter(self._frames)))
+
+    def _discard(self, key):
+        stamp, data = self._frames.pop(key)
+        self.nbytes -= data.nbytes
+
+    def clear(self):
+        """
+        Drop every frame (the hit and miss counters are kept).
+        """
+
+        self._frames.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """
+        :returns dictionary with the hits, misses, number of frames held,
+                 their size in bytes and the size limit
+        """
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'frames': len(self._frames), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, path):
+        import os
+        return os.path.abspath(path) in self._frames
+
+
+# one cache per process, shared by all the stages
+_cache = FrameCache()
+
+
+def get_frame(path):
+    """
+    :param path: FITS file
+
+    :returns the frame's data from the process wide cache, see read_frame
+    """
+
+    return _cache.get(path)
+
+
+def frame_cache():
+    """
+    :returns the process wide FrameCache, e.g. to look at its info()
+    """
+
+    return _cache
+
+
+def set_cache_size(max_bytes):
+    """
+    Change the size limit of the process wide cache.
+
+    :param max_bytes: most bytes of frame data to keep
+    """
+
+    _cache.resize(max_bytes)
+
+
+def prefetch(items, path=None, depth=4, threads=2, memmap=False):
+    """
+    Read frames ahead on background threads while the current one is being
+    worked on. Items are handed back in order once their frame is in the
+    process wide cache, so a get_frame on them doesn't touch the disk.
+
+    At most depth frames are read ahead of the item being worked on; reading
+    stops until the consumer catches up, which keeps memory bounded.
+
+    :param items: iterable of items. It is consumed lazily.
+    :param path: function giving the FITS file of an item, defaults to the
+                 item itself
+    :param depth: how many frames to read ahead
+    :param threads: number of reading threads
+    :param memmap: if False the pages of memory-mapped frames are read in
+                   by the background threads too; if True only the headers
+                   are read ahead
+
+    :returns generator of the items. A frame that can't be read is skipped
+             here and fails again, with its error, when it is asked for.
+    """
+
+    import numpy as np
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    if path is None:
+        def path(item):
+            return item
+
+    def load(filename):
+        from instrument import stage
+
+        key, stamp = _stamp(filename)
+        with stage('read_frame', key):
+            data = read_frame(key)
+            if not memmap and isinstance(data, np.memmap):
+                data = np.array(data)
+                data.flags.writeable = False
+
+        return key, stamp, data
+
+    def current(filename):
+        try:
+            return _cache.is_current(filename)
+        except OSError:
+            return False
+
+    pending = deque()
+    with ThreadPoolExecutor(threads) as pool:
+        for item in items:
+            # frames already in the cache don't need reading
+            filename = path(item)
+            future = None if current(filename) else pool.submit(load,
+                                                                filename)
+            pending.append((item, future))
+            if len(pending) > depth:
+                yield _cached(*pending.popleft())
+
+        while pending:
+            yield _cached(*pending.popleft())
+
+
+def _cached(item, future):
+    """
+    Put a frame read by prefetch into the cache and hand back its item.
+    """
+
+    if future is None:
+        return item
+
+    try:
+        key, stamp, data = future.result()
+    except (IOError, OSError, ValueError):
+        return item
+
+    _cache.put(key, stamp, data)
+
+    return item
@@ -2,12 +2,17 @@
 # Create a 20 x 16 grid 
 #============================================================================#
 
-dx = 20
-dy = 16
-make_grid(dx, dy, (1280, 960), True)
-vertices = np.loadtxt('{}x{}grid_real_vertices.txt'.format(dx,dy))
-centers = np.loadtxt('{}x{}grid_centers.txt'.format(dx,dy))
-fig = plt.figure(figsize=(12,9))
-plt.scatter(vertices[:,0], vertices[:,1], s=7, marker='o')
-plt.scatter(centers[:,0], centers[:,1], s=2, marker='+')
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from make_grid import get_grid
+
+    dx = 20
+    dy = 16
+    # the grid is plotted straight from memory; make_grid writes the files
+    grid = get_grid(dx, dy, (1280, 960))
+    vertices = grid.corners
+    centers = grid.centers
+    fig = plt.figure(figsize=(12,9))
+    plt.scatter(vertices[:,0], vertices[:,1], s=7, marker='o')
+    plt.scatter(centers[:,0], centers[:,1], s=2, marker='+')
+    plt.show()
@@ -0,0 +1,553 @@
+# ============================================================================ #
+# Instrumentation of the pipeline stages. Each stage run on an image (or
+# results file, or log) records its wall time, CPU time, bytes read and
+# written, page faults and the peak resident memory while it ran. Optionally
+# the stages are profiled with cProfile or a sampling profiler as well.
+# Records made in worker processes are handed back with the results (see
+# parallel.parallel_map), and the whole run is written out as a JSON or CSV
+# report with a summary of the slowest stages and images.
+#
+# Recording is off until enable() is called, and costs next to nothing then.
+# ============================================================================ #
+
+from contextlib import contextmanager
+
+RECORD_FIELDS = ['stage', 'item', 'pid', 'depth', 'start', 'wall', 'cpu',
+                 'read_bytes', 'write_bytes', 'faults', 'peak_rss',
+                 'rss_growth']
+PROFILERS = (None, 'cprofile', 'sample')
+
+
+def _io_counters():
+    """
+    :returns (bytes read, bytes written) by this process through read and
+             write calls so far, or (0, 0) where /proc isn't available.
+             Memory-mapped reads don't show here, they are page faults.
+    """
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f)
+    except (IOError, OSError, ValueError):
+        return 0, 0
+
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def _usage():
+    """
+    :returns (page faults so far, peak resident memory in bytes)
+    """
+
+    import resource
+    import sys
+
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return ru.ru_minflt + ru.ru_majflt, ru.ru_maxrss * scale
+
+
+def _memory():
+    """
+    :returns (resident memory now, its high-water mark) in bytes, or None
+             where /proc isn't available
+    """
+
+    try:
+        with open('/proc/self/status', 'r') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return (int(status['VmRSS'].split()[0]) * 1024,
+                int(status['VmHWM'].split()[0]) * 1024)
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak():
+    """
+    Bring the high-water mark of the resident memory down to the resident
+    memory now, so it gives the peak from here on (Linux 4.0 and later).
+
+    :returns whether it could be reset
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+class _Stats(object):
+    """
+    Profile statistics in the form pstats.Stats can load and add up.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Recorder(object):
+    """
+    Collects the stage records (and profiles) of one process.
+
+    :param enabled: whether stages are recorded
+    :param profile: None, 'cprofile' to profile every function called in a
+                    stage, or 'sample' to sample the stack of the main thread
+                    every interval seconds of CPU time while in a stage
+    :param interval: sampling interval in seconds
+    """
+
+    def __init__(self, enabled=False, profile=None, interval=0.005):
+        self._reset()
+        self.configure(enabled, profile, interval)
+
+    def _reset(self):
+        import os
+        import threading
+
+        self.records = []
+        self.samples = {}
+        self._profiles = []
+        # stage nesting and the cProfile profiler are kept per thread (e.g.
+        # the frames.prefetch readers); every profiler made is listed so
+        # take can collect them all
+        self._local = threading.local()
+        self._profilers = []
+        self._lock = threading.Lock()
+        # [peak so far] of every stage running, on any thread, while the
+        # high-water mark of the memory is reset by the stages started
+        # inside them
+        self._peaks = []
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        # a worker process forked from this one starts out with a copy of
+        # its records; they are the parent's to report, not the worker's
+        import os
+
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def configure(self, enabled=True, profile=None, interval=0.005):
+        """
+        Turn recording and profiling on or off.
+        """
+
+        if profile not in PROFILERS:
+            raise ValueError('profile must be one of {}'.format(PROFILERS))
+
+        self.enabled = enabled
+        self.profile = profile if enabled else None
+        self.interval = interval
+
+    def settings(self):
+        """
+        :returns (enabled, profile, interval), for configure in a worker
+        """
+
+        return self.enabled, self.profile, self.interval
+
+    @contextmanager
+    def stage(self, name, item=None):
+        """
+        Record a stage run on an item, e.g.
+        with recorder.stage('sky', path): ...
+
+        Stages may be nested; the time of a nested stage is also part of
+        the time of the stage around it. Stages may run on several threads
+        at once; the CPU time, I/O, page faults and memory are those of the
+        whole process, so they then include the other threads' work.
+
+        peak_rss is the most resident memory of the process while the stage
+        ran and rss_growth how far that is above where it started. Where
+        the high-water mark can't be reset (no /proc/self/clear_refs) they
+        fall back to the high-water mark of the whole process so far and
+        how much the stage raised it.
+
+        :param name: name of the stage
+        :param item: what it ran on, e.g. a FITS file, or None
+        """
+
+        import os
+        import time
+
+        if not self.enabled:
+            yield
+            return
+
+        self._check_process()
+        local = self._local
+        depth = getattr(local, 'depth', 0)
+        if depth == 0:
+            self._start_profile()
+        local.depth = depth + 1
+
+        read0, written0 = _io_counters()
+        faults0, peak0 = _usage()
+        peak = self._start_peak()
+        start = time.time()
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield
+        finally:
+            cpu = time.process_time() - cpu0
+            wall = time.perf_counter() - wall0
+            read1, written1 = _io_counters()
+            faults1, peak1 = _usage()
+            if peak is None:
+                rss0, peak = peak0, peak1
+            else:
+                rss0, peak = self._stop_peak(peak)
+
+            local.depth = depth
+            if depth == 0:
+                self._stop_profile()
+
+            self.records.append({
+                'stage': name, 'item': None if item is None else str(item),
+                'pid': os.getpid(), 'depth': depth, 'start': start,
+                'wall': wall,
+                'cpu': cpu, 'read_bytes': read1 - read0,
+                'write_bytes': written1 - written0,
+                'faults': faults1 - faults0, 'peak_rss': peak,
+                'rss_growth': max(0, peak - rss0)})
+
+    def _start_peak(self):
+        """
+        Reset the memory high-water mark for a stage starting, after handing
+        the peak so far to the stages already running.
+
+        :returns [resident memory at the start, peak so far] of the stage,
+                 or None if the high-water mark can't be reset
+        """
+
+        with self._lock:
+            memory = _memory()
+            if memory is None or not _reset_peak():
+                return None
+            for peak in self._peaks:
+                peak[1] = max(peak[1], memory[1])
+            peak = [memory[0], memory[0]]
+            self._peaks.append(peak)
+
+        return peak
+
+    def _stop_peak(self, peak):
+        """
+        :returns (resident memory at the start, peak memory) of a stage
+                 ending
+        """
+
+        with self._lock:
+            self._peaks = [p for p in self._peaks if p is not peak]
+            memory = _memory()
+            if memory is not None:
+                peak[1] = max(peak[1], memory[1])
+
+        return peak[0], peak[1]
+
+    def _start_profile(self):
+        import threading
+
+        if self.profile == 'cprofile':
+            import cProfile
+            profiler = getattr(self._local, 'profiler', None)
+            if profiler is None:
+                profiler = self._local.profiler = cProfile.Profile()
+                with self._lock:
+                    self._profilers.append(profiler)
+            try:
+                profiler.enable()
+                self._local.profiling = True
+            except ValueError:
+                # newer Pythons allow one running profiler per process;
+                # this thread's stage goes unprofiled
+                self._local.profiling = False
+        elif self.profile == 'sample' and \
+                threading.current_thread() is threading.main_thread():
+            import signal
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval,
+                             self.interval)
+
+    def _stop_profile(self):
+        import threading
+
+        if self.profile == 'cprofile' and \
+                getattr(self._local, 'profiling', False):
+            self._local.profiler.disable()
+            self._local.profiling = False
+        elif self.profile == 'sample' and \
+                threading.current_thread() is threading.main_thread():
+            import signal
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+    def _sample(self, signum, frame):
+        """
+        Signal handler of the sampling profiler: count the function running
+        and every function below it on the stack.
+        """
+
+        seen = set()
+        leaf = True
+        while frame is not None:
+            code = frame.f_code
+            name = '{}:{}({})'.format(code.co_filename, code.co_firstlineno,
+                                      code.co_name)
+            if name not in seen:
+                counts = self.samples.setdefault(name, [0, 0])
+                counts[0] += leaf
+                counts[1] += 1
+                seen.add(name)
+            leaf = False
+            frame = frame.f_back
+
+    def _profile_stats(self, clear=False):
+        """
+        :returns list of the statistics of the cProfile profilers of every
+                 thread, and optionally clears them
+        """
+
+        with self._lock:
+            profilers = list(self._profilers)
+
+        stats = []
+        for profiler in profilers:
+            profiler.create_stats()
+            if profiler.stats:
+                stats.append(profiler.stats)
+            if clear:
+                profiler.clear()
+
+        return stats
+
+    def take(self):
+        """
+        Hand over everything recorded so far, and start afresh. Used to send
+        the records of a worker process back with its results.
+
+        :returns picklable dictionary of records, profile statistics and
+                 samples, for merge
+        """
+
+        self._check_process()
+        taken = {'records': self.records,
+                 'profile': self._profile_stats(clear=True),
+                 'samples': self.samples}
+        self.records = []
+        self.samples = {}
+
+        return taken
+
+    def merge(self, taken):
+        """
+        Add what another recorder took.
+        """
+
+        if not taken:
+            return
+
+        self.records.extend(taken['records'])
+        self._profiles.extend(taken['profile'])
+        for name, (own, total) in taken['samples'].items():
+            counts = self.samples.setdefault(name, [0, 0])
+            counts[0] += own
+            counts[1] += total
+
+    def top_functions(self, n=20):
+        """
+        :returns list of dictionaries of the n functions that took the most
+                 time in the profiles (own time with cProfile, samples in
+                 the function itself when sampling)
+        """
+
+        if self.profile == 'sample' or self.samples:
+            nsamples = float(sum(own for own, total in
+                                 self.samples.values())) or 1.
+            order = sorted(self.samples.items(), key=lambda s: -s[1][0])
+            return [{'function': name, 'own': own / nsamples,
+                     'cumulative': total / nsamples, 'samples': own}
+                    for name, (own, total) in order[:n]]
+
+        import pstats
+
+        profiles = self._profiles + self._profile_stats()
+        if not profiles:
+            return []
+
+        stats = pstats.Stats(_Stats(profiles[0]))
+        for profile in profiles[1:]:
+            stats.add(_Stats(profile))
+
+        rows = []
+        for (filename, line, func), (cc, nc, tt, ct, callers) in \
+                stats.stats.items():
+            rows.append({'function': '{}:{}({})'.format(filename, line, func),
+                         'own': tt, 'cumulative': ct, 'calls': nc})
+        rows.sort(key=lambda r: -r['own'])
+
+        return rows[:n]
+
+    def summary(self, n=10):
+        """
+        :param n: number of slowest images and records to list
+
+        :returns dictionary with totals per stage (count, wall, cpu, mean
+                 and largest wall time, bytes read and written, largest
+                 peak memory and growth of it),
+                 the n items that took longest over all their outermost
+                 stages (with the time of every stage on them), and the n
+                 slowest single records
+        """
+
+        stages = {}
+        items = {}
+        for r in self.records:
+            s = stages.setdefault(r['stage'], {
+                'stage': r['stage'], 'count': 0, 'wall': 0., 'cpu': 0.,
+                'max_wall': 0., 'read_bytes': 0, 'write_bytes': 0,
+                'peak_rss': 0, 'rss_growth': 0})
+            s['count'] += 1
+            s['wall'] += r['wall']
+            s['cpu'] += r['cpu']
+            s['max_wall'] = max(s['max_wall'], r['wall'])
+            s['read_bytes'] += r['read_bytes']
+            s['write_bytes'] += r['write_bytes']
+            s['peak_rss'] = max(s['peak_rss'], r['peak_rss'])
+            s['rss_growth'] = max(s['rss_growth'], r['rss_growth'])
+            if r['item'] is not None:
+                i = items.setdefault(r['item'], {'item': r['item'],
+                                                 'wall': None, 'stages': {}})
+                if r['depth'] == 0:
+                    i['wall'] = (i['wall'] or 0.) + r['wall']
+                i['stages'][r['stage']] = i['stages'].get(r['stage'], 0.) \
+                    + r['wall']
+
+        for s in stages.values():
+            s['mean_wall'] = s['wall'] / s['count']
+        # items only seen inside other stages (e.g. the PNG of a render)
+        # are part of those
+        items = [i for i in items.values() if i['wall'] is not None]
+
+        return {'stages': sorted(stages.values(), key=lambda s: -s['wall']),
+                'slowest_items': sorted(items, key=lambda i: -i['wall'])[:n],
+                'slowest_records': sorted(self.records,
+                                          key=lambda r: -r['wall'])[:n]}
+
+    def print_summary(self, n=10):
+        """
+        Print the time per stage and the slowest items.
+        """
+
+        import os
+
+        summary = self.summary(n)
+        print('{:20s} {:>7s} {:>10s} {:>10s} {:>9s} {:>9s} {:>9s} '
+              '{:>9s}'.format('stage', 'count', 'wall s', 'cpu s', 'mean ms',
+                              'max ms', 'MB read', 'MB grown'))
+        for s in summary['stages']:
+            print('{:20s} {:7d} {:10.3f} {:10.3f} {:9.2f} {:9.2f} '
+                  '{:9.1f} {:9.1f}'.format(s['stage'], s['count'], s['wall'],
+                                           s['cpu'], 1e3 * s['mean_wall'],
+                                           1e3 * s['max_wall'],
+                                           s['read_bytes'] / 2. ** 20,
+                                           s['rss_growth'] / 2. ** 20))
+
+        if summary['slowest_items']:
+            print('\nSlowest items:')
+            for i in summary['slowest_items']:
+                worst = max(i['stages'], key=i['stages'].get)
+                print('  {:8.3f} s  {}  (most in {})'.format(
+                    i['wall'], os.path.basename(i['item']) or i['item'],
+                    worst))
+
+        functions = self.top_functions(n)
+        if functions:
+            print('\nMost time spent in:')
+            for f in functions:
+                # share of the samples, or seconds with cProfile
+                own = '{:7.1%}' if 'samples' in f else '{:8.3f}'
+                print('  ' + own.format(f['own']) + '  ' + f['function'])
+
+    def write_report(self, filename, n=20):
+        """
+        Write the records as a report: '.csv' gives one row per record,
+        anything else JSON with the records, the summary and the top
+        functions of the profile.
+
+        :param filename: report file
+        :param n: number of slowest items and functions in the JSON report
+        """
+
+        if filename.endswith('.csv'):
+            import csv
+            with open(filename, 'w') as f:
+                writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+            return
+
+        import json
+
+        report = self.summary(n)
+        report['profile'] = self.profile
+        report['functions'] = self.top_functions(n)
+        report['records'] = self.records
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    def clear(self):
+        """
+        Drop all records and profiles.
+        """
+
+        self.take()
+        self._profiles = []
+
+
+# one recorder per process
+_recorder = Recorder()
+
+
+def recorder():
+    """
+    :returns the process wide Recorder
+    """
+
+    return _recorder
+
+
+def enable(profile=None, interval=0.005):
+    """
+    Start recording stages in this process (and the worker processes that
+    parallel_map starts from now on).
+
+    :param profile: None, 'cprofile' or 'sample', see Recorder
+    :param interval: sampling interval in seconds
+    """
+
+    _recorder.configure(True, profile, interval)
+
+
+def disable():
+    """
+    Stop recording. What was recorded is kept.
+    """
+
+    _recorder.configure(False)
+
+
+def stage(name, item=None):
+    """
+    Record a stage with the process wide recorder, see Recorder.stage.
+    """
+
+    return _recorder.stage(name, item)
@@ -0,0 +1,307 @@
+# ============================================================================ #
+# Inventory of the SkyPhotos tree. Walks the directories with scandir across
+# a pool of threads and reads only the FITS headers, never the pixel data.
+# The <filters>/<exposure> directory names are parsed once per directory and
+# the time of each exposure comes from its AstroCap file name, giving one
+# typed table of every frame that all the stages can share.
+# ============================================================================ #
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+# the path column is as wide as the longest path of each inventory
+INVENTORY_DTYPE = [('path', 'U1'), ('image', 'U32'), ('size', 'i8'),
+                   ('mtime', 'f8'), ('height', 'i4'), ('width', 'i4'),
+                   ('bitpix', 'i2'), ('exposure', 'f8'), ('filter1', 'U32'),
+                   ('filter2', 'U32'), ('date', 'U10'), ('time', 'U12'),
+                   ('timestamp', 'datetime64[ms]')]
+
+
+def read_fits_header(path, keys=('BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2')):
+    """
+    Read the primary header of a FITS file, 2880 byte blocks at a time up to
+    the END card, without touching the data that follows.
+
+    :param path: FITS file
+    :param keys: header keywords to return
+
+    :returns dictionary of the requested keywords that are present. Integer
+             and float values are converted, strings are stripped of quotes.
+    """
+
+    return _read_header(path, keys)[0]
+
+
+def _read_header(path, keys):
+    """
+    :returns (header dictionary as for read_fits_header, length of the header
+             in bytes)
+    """
+
+    wanted = set(keys)
+    header = {}
+    nbytes = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError('{} ends before its header does'.format(path))
+            nbytes += FITS_BLOCK
+
+            for i in range(0, FITS_BLOCK, FITS_CARD):
+                card = block[i:i + FITS_CARD].decode('ascii', 'replace')
+                key = card[:8].strip()
+                if key == 'END':
+                    return header, nbytes
+                if key not in wanted or card[8:10] != '= ':
+                    continue
+
+                value = card[10:].split('/')[0].strip()
+                if value.startswith("'"):
+                    header[key] = value.strip("'").strip()
+                    continue
+                try:
+                    header[key] = int(value)
+                except ValueError:
+                    try:
+                        header[key] = float(value)
+                    except ValueError:
+                        header[key] = value
+
+
+def fits_size(path):
+    """
+    :param path: FITS file
+
+    :returns the size in bytes the file has once it is completely written:
+             the primary header plus its data padded to whole 2880 byte
+             blocks
+    """
+
+    axes = ['NAXIS{}'.format(n) for n in range(1, 10)]
+    header, nbytes = _read_header(path, ['BITPIX', 'NAXIS'] + axes)
+
+    naxis = header.get('NAXIS', 0)
+    npix = 0
+    if naxis:
+        npix = 1
+        for axis in axes[:naxis]:
+            npix *= header[axis]
+    data = npix * abs(header['BITPIX']) // 8
+
+    return nbytes + -(-data // FITS_BLOCK) * FITS_BLOCK
+
+
+def _scan_dir(path):
+    """
+    List one directory.
+
+    :returns (FITS files as (path, name, size, mtime) tuples, subdirectories)
+    """
+
+    import os
+
+    fitsfiles = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name[-4:] == '.FIT' and entry.is_file():
+                st = entry.stat()
+                fitsfiles.append((entry.path, entry.name, st.st_size,
+                                  st.st_mtime))
+
+    return fitsfiles, subdirs
+
+
+def find_fits(top, threads=None):
+    """
+    Find every .FIT file below a directory. Directories are listed
+    concurrently, one level of the tree at a time.
+
+    :param top: top level directory
+    :param threads: number of threads, defaults to 4 per CPU
+
+    :returns list of (path, name, size, mtime) tuples
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    from parallel import default_processes
+
+    if threads is None:
+        threads = 4 * default_processes()
+
+    found = []
+    level = [top]
+    with ThreadPoolExecutor(threads) as pool:
+        while level:
+            nextlevel = []
+            for fitsfiles, subdirs in pool.map(_scan_dir, level):
+                found.extend(fitsfiles)
+                nextlevel.extend(subdirs)
+            level = nextlevel
+
+    return found
+
+
+def directory_params(dirpath):
+    """
+    Parse the directory convention of the tree,
+    .../<date>/<filters>/<exposure>/, once for a directory.
+
+    :param dirpath: directory holding the images
+
+    :returns (exposure in seconds, filter 1, filter 2, date). Parts that
+             can't be found are nan for the exposure and '' for the rest.
+    """
+
+    from tidy_stats import parse_date, parse_exposure, parse_filters
+
+    try:
+        filter1, filter2 = parse_filters(dirpath + '/')
+        exposure = parse_exposure(dirpath + '/')
+    except (ValueError, AttributeError):
+        filter1, filter2, exposure = '', '', float('nan')
+
+    return exposure, filter1, filter2, parse_date(dirpath) or ''
+
+
+def _header_shape(path):
+    """
+    :returns (height, width, bitpix) from the header of a FITS file, or
+             (0, 0, 0) if the header can't be read
+    """
+
+    try:
+        header = read_fits_header(path)
+    except (IOError, ValueError) as e:
+        print('Could not read the header of {}: {}'.format(path, e))
+        return 0, 0, 0
+
+    if header.get('NAXIS', 0) < 2:
+        return 0, 0, header.get('BITPIX', 0)
+
+    return header['NAXIS2'], header['NAXIS1'], header['BITPIX']
+
+
+def build_inventory(top, threads=None, previous=None):
+    """
+    Index every frame below a directory.
+
+    :param top: top level directory of the images, laid out as
+                <date>/<filters>/<exposure>/<image>.FIT
+    :param threads: number of threads, defaults to 4 per CPU
+    :param previous: an earlier inventory of the same tree. Frames whose
+                     size and modification time are unchanged keep their
+                     entry, so only new or changed headers are read.
+
+    :returns NumPy structured array with the fields of INVENTORY_DTYPE, one
+             row per frame, sorted by path
+    """
+
+    import os
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from parallel import default_processes
+    from tidy_stats import parse_time
+
+    if threads is None:
+        threads = 4 * default_processes()
+
+    found = sorted(find_fits(top, threads=threads))
+    width = max([len(f[0]) for f in found] + [1])
+    inv = np.zeros(len(found), dtype=[('path', 'U{}'.format(width))]
+                   + INVENTORY_DTYPE[1:])
+    if not found:
+        return inv
+
+    paths, names, sizes, mtimes = zip(*found)
+    inv['path'] = paths
+    inv['image'] = names
+    inv['size'] = sizes
+    inv['mtime'] = mtimes
+
+    # headers: reuse what an earlier inventory already read
+    known = {}
+    if previous is not None:
+        known = dict((p, (s, m, h, w, b)) for p, s, m, h, w, b in
+                     zip(previous['path'].tolist(), previous['size'].tolist(),
+                         previous['mtime'].tolist(),
+                         previous['height'].tolist(),
+                         previous['width'].tolist(),
+                         previous['bitpix'].tolist()))
+    shapes = [None] * len(found)
+    todo = []
+    for k, (path, name, size, mtime) in enumerate(found):
+        old = known.get(path)
+        if old is not None and old[0] == size and old[1] == mtime:
+            shapes[k] = old[2:]
+        else:
+            todo.append(k)
+
+    with ThreadPoolExecutor(threads) as pool:
+        for k, shape in zip(todo, pool.map(_header_shape,
+                                           [paths[k] for k in todo])):
+            shapes[k] = shape
+    inv['height'], inv['width'], inv['bitpix'] = zip(*shapes)
+
+    # the directory convention only needs parsing once per directory
+    dirs = {}
+    for k, path in enumerate(paths):
+        dirpath = os.path.dirname(path)
+        if dirpath not in dirs:
+            dirs[dirpath] = directory_params(dirpath)
+        (inv['exposure'][k], inv['filter1'][k], inv['filter2'][k],
+         inv['date'][k]) = dirs[dirpath]
+
+    inv['time'] = [parse_time(name) or '' for name in names]
+    inv['timestamp'] = [np.datetime64('{}T{}'.format(d, t)) if d and t
+                        else np.datetime64('NaT')
+                        for d, t in zip(inv['date'], inv['time'])]
+
+    return inv
+
+
+def save_inventory(inv, filename):
+    """
+    Save an inventory so later stages (and later runs of build_inventory)
+    can reuse it.
+
+    :param inv: inventory from build_inventory
+    :param filename: .npy file to write
+    """
+
+    import numpy as np
+
+    np.save(filename, inv, allow_pickle=False)
+
+
+def load_inventory(filename):
+    """
+    :param filename: .npy file written by save_inventory
+
+    :returns the inventory
+    """
+
+    import numpy as np
+
+    return np.load(filename, allow_pickle=False)
+
+
+def by_directory(inv):
+    """
+    Group an inventory by directory, in the form the interactive scripts use.
+
+    :param inv: inventory from build_inventory
+
+    :returns sorted list of [directory, [image names]] lists
+    """
+
+    import os
+
+    groups = {}
+    for path, name in zip(inv['path'].tolist(), inv['image'].tolist()):
+        groups.setdefault(os.path.dirname(path), []).append(name)
+
+    return sorted([d, names] for d, names in groups.items())
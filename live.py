@@ -0,0 +1,234 @@
+# ============================================================================ #
+# Live mode for an observing session. Watches the session directory for new
+# frames as AstroCap writes them into <filters>/<exposure> folders, waits for
+# each file to be complete, and runs sky estimation, grid photometry and
+# detection on it straight away, so the detection strength can be followed
+# at the telescope while there is still time to change exposure or filters.
+# ============================================================================ #
+
+LIVE_COLUMNS = ['image', 'path', 'time', 'exposure', 'filter1', 'filter2',
+                'skyval', 'sigma', 'skyerr', 'grid', 'cell_area',
+                'min_counts', 'max_counts', 'threshold', 'max_snr',
+                'threshold_multiple', 'ndetected', 'latency']
+
+
+def is_complete(path, size):
+    """
+    :param path: FITS file that may still be being written
+    :param size: its current size in bytes
+
+    :returns True once the file holds its whole header and data
+    """
+
+    from inventory import fits_size
+
+    try:
+        return size >= fits_size(path)
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+
+
+def process_frame(path, grids=('64x64',), nsigma=3.0, calibration=None,
+                  cache=None):
+    """
+    Sky, photometry and detection for one frame.
+
+    :param path: FITS file
+    :param grids: grid size strings to measure, e.g. ('10x10', '64x64')
+    :param nsigma: detection level, see detection.detection_threshold
+    :param calibration: optional calibration.Calibration to apply first
+    :param cache: optional result_cache.ResultCache, see
+                  detection.detect_frame
+
+    :returns list of dictionaries with the LIVE_COLUMNS (without latency),
+             one per grid size
+    """
+
+    import os
+    from detection import detect_frame
+    from frames import get_frame
+    from inventory import directory_params
+    from tidy_stats import parse_time
+
+    dirpath, image = os.path.split(path)
+    exposure, filter1, filter2, date = directory_params(dirpath)
+
+    def load():
+        data = get_frame(path)
+        if calibration is not None:
+            data = calibration.apply(data, path, exposure)
+        return data
+
+    params = None
+    if calibration is not None:
+        params = {'calibration': calibration.fingerprint(path, exposure)}
+    sky, detections = detect_frame(load, grids=grids, nsigma=nsigma,
+                                   itime=exposure if exposure > 0 else 1.0,
+                                   cache=cache, path=path, params=params)
+
+    rows = []
+    for grid in grids:
+        row = {'image': image, 'path': dirpath + '/',
+               'time': parse_time(image) or '', 'exposure': exposure,
+               'filter1': filter1, 'filter2': filter2, 'grid': grid}
+        row.update((k, sky[k]) for k in ('skyval', 'sigma', 'skyerr'))
+        row.update(detections[grid][1])
+        rows.append(row)
+
+    return rows
+
+
+class LiveSummary(object):
+    """
+    Rolling summary of a live session: every processed frame is appended to
+    a tab separated table (and optionally the session catalog) and the most
+    recent rows are kept in memory.
+
+    :param filename: table to append to, or None
+    :param catalog: session catalog ('.db' or '.sqlite') to add the images
+                    and their summaries to, or None
+    :param keep: number of recent rows kept in memory
+    """
+
+    def __init__(self, filename='live_summary.txt', catalog=None, keep=100):
+        import os
+        from collections import deque
+
+        self.rows = deque(maxlen=keep)
+        self._file = None
+        self._conn = None
+
+        if filename is not None:
+            new = not os.path.exists(filename)
+            self._file = open(filename, 'a')
+            if new:
+                self._file.write('# ' + ' \t '.join(c.upper() for c in
+                                                    LIVE_COLUMNS) + '\n')
+                self._file.flush()
+        if catalog is not None:
+            from catalog import connect
+            self._conn = connect(catalog)
+
+    def add(self, rows):
+        """
+        :param rows: the rows of one frame, as from process_frame plus
+                     latency
+        """
+
+        for row in rows:
+            self.rows.append(row)
+            if self._file is not None:
+                self._file.write('\t'.join(str(row[c]) for c in LIVE_COLUMNS)
+                                 + '\n')
+        if self._file is not None:
+            self._file.flush()
+
+        if self._conn is not None:
+            from catalog import add_images, add_summaries, image_row
+
+            first = rows[0]
+            add_images(self._conn, [image_row(
+                [first[c] for c in ('image', 'skyval', 'sigma', 'skyerr',
+                                    'exposure', 'filter1', 'filter2',
+                                    'path')])])
+            for row in rows:
+                add_summaries(self._conn, row['grid'], [row])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._conn is not None:
+            self._conn.close()
+
+
+def _report(rows):
+    """
+    One line per frame for the terminal.
+    """
+
+    first = rows[0]
+    snrs = '  '.join('{} SNR {:.1f} ({} cells)'.format(
+        row['grid'], row['max_snr'], row['ndetected']) for row in rows)
+    print('{}  {}-{} {}s  sky {:.1f}  {}  [{:.2f} s]'.format(
+        first['image'], first['filter1'], first['filter2'],
+        first['exposure'], first['skyval'], snrs, first['latency']))
+
+
+def watch(session, grids=('64x64',), nsigma=3.0, poll=0.25,
+          summary='live_summary.txt', catalog=None, existing=False,
+          idle=None, calibration=None, cache=None):
+    """
+    Watch a session directory and process every new frame as soon as it is
+    completely written. Runs until interrupted with Ctrl-C, or until no new
+    frame has arrived for idle seconds.
+
+    :param session: directory the frames are written to, laid out as
+                    <filters>/<exposure>/<image>.FIT
+    :param grids: grid size strings to measure
+    :param nsigma: detection level, see detection.detection_threshold
+    :param poll: seconds between scans of the directory
+    :param summary: table the rows are appended to, see LiveSummary
+    :param catalog: optional session catalog to add the results to
+    :param existing: if True, frames already there when watching starts are
+                     processed too
+    :param idle: stop after this many seconds without a new frame, or None
+                 to keep watching
+    :param calibration: optional calibration.Calibration to apply to every
+                        frame
+    :param cache: optional result_cache.ResultCache, so frames processed in
+                  an earlier watch (with existing=True) aren't measured again
+
+    :returns the LiveSummary with the most recent rows
+    """
+
+    import time
+    from inventory import find_fits
+
+    table = LiveSummary(summary, catalog=catalog)
+
+    done = set()
+    if not existing:
+        done = set(f[0] for f in find_fits(session))
+    sizes = {}
+    last_new = time.time()
+
+    print('Watching {} for new frames (Ctrl-C to stop)...'.format(session))
+    try:
+        while idle is None or time.time() - last_new < idle:
+            start = time.time()
+            for path, name, size, mtime in sorted(find_fits(session)):
+                if path in done:
+                    continue
+
+                # a file is ready once it holds everything its header says it
+                # should. Files that don't reach that size (e.g. unpadded)
+                # are taken once their size has stopped changing for a while.
+                if not is_complete(path, size):
+                    if sizes.get(path) != size or start - mtime < 2 * poll:
+                        sizes[path] = size
+                        continue
+
+                done.add(path)
+                sizes.pop(path, None)
+                last_new = time.time()
+                try:
+                    rows = process_frame(path, grids=grids, nsigma=nsigma,
+                                         calibration=calibration, cache=cache)
+                except Exception as e:
+                    print('Could not process {}: {}'.format(path, e))
+                    continue
+                latency = time.time() - mtime
+                for row in rows:
+                    row['latency'] = latency
+                table.add(rows)
+                _report(rows)
+
+            time.sleep(max(0., poll - (time.time() - start)))
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
+    finally:
+        table.close()
+        if cache is not None:
+            cache.save()
+
+    return table
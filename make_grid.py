@@ -1,76 +1,353 @@
-def make_grid(nx, ny, size, vertices=False):
+# ============================================================================ #
+# Grid geometry. A Grid holds the centers, vertices, areas and pixel boxes of
+# an nx by ny grid of rectangles as arrays, built once per grid and image
+# size (and optionally kept on disk), so nothing has to be read back from
+# text files to do photometry or to draw detected cells. make_grid still
+# writes the centers and polygons files iraf.polyphot needs.
+# ============================================================================ #
+
+GRID_CACHE_DIR = 'grid_cache'
+
+# grids already built in this process, keyed by (nx, ny, (width, height))
+_grids = {}
+
+# arrays kept in the on-disk cache; the pixel maps are quicker to build than
+# to read
+_STORED = ('centers', 'corners', 'vertices', 'bounds', 'areas')
+
+
+class Grid(object):
+    """
+    An nx by ny grid of equal rectangles covering an image. Cells are ordered
+    like the centers make_grid writes: x varies fastest, from the bottom row.
+
+    The arrays are built the first time they are asked for and kept; don't
+    modify them, get_grid hands the same Grid to every caller.
+
+    :param nx: number of boxes in x direction
+    :param ny: number of boxes in y direction
+    :param size: image size given as tuple: (x, y) i.e. (width, height). The
+                 grid has to divide it exactly.
+    """
+
+    def __init__(self, nx, ny, size):
+        from grid_photometry import grid_cell_size
+
+        self.nx = nx
+        self.ny = ny
+        self.size = (int(size[0]), int(size[1]))
+        self.shape = (self.size[1], self.size[0])
+        self.dx, self.dy = grid_cell_size(nx, ny, self.shape)
+        self._arrays = {}
+
+    def __repr__(self):
+        return 'Grid({}, {}, {})'.format(self.nx, self.ny, self.size)
+
+    @property
+    def name(self):
+        """
+        Prefix of the grid files, e.g. '64x64grid'
+        """
+
+        return '{}x{}grid'.format(self.nx, self.ny)
+
+    @property
+    def ncells(self):
+        return self.nx * self.ny
+
+    def _array(self, name, build):
+        if name not in self._arrays:
+            self._arrays[name] = build()
+        return self._arrays[name]
+
+    @property
+    def bounds(self):
+        """
+        (ncells, 4) int array of the pixel box of each cell, x0, y0, x1, y1;
+        the cell covers data[y0:y1, x0:x1]
+        """
+
+        def build():
+            import numpy as np
+            x0 = np.tile(np.arange(self.nx) * self.dx, self.ny)
+            y0 = np.repeat(np.arange(self.ny) * self.dy, self.nx)
+            return np.column_stack((x0, y0, x0 + self.dx, y0 + self.dy))
+
+        return self._array('bounds', build)
+
+    @property
+    def centers(self):
+        """
+        (ncells, 2) array of the cell centers (x, y), same values make_grid
+        writes to <name>_centers.txt
+        """
+
+        def build():
+            b = self.bounds
+            return 0.5 * (b[:, :2] + b[:, 2:])
+
+        return self._array('centers', build)
+
+    @property
+    def corners(self):
+        """
+        ((nx + 1) * (ny + 1), 2) array of the grid's corner points, written
+        to <name>_real_vertices.txt
+        """
+
+        def build():
+            import numpy as np
+            xx = np.tile(np.arange(self.nx + 1) * self.dx, self.ny + 1)
+            yy = np.repeat(np.arange(self.ny + 1) * self.dy, self.nx + 1)
+            return np.column_stack((xx, yy)).astype(np.float64)
+
+        return self._array('corners', build)
+
+    @property
+    def vertices(self):
+        """
+        (ncells, 4, 2) array of the counter-clockwise vertices of each cell,
+        as pixel_weights.rect_grid_polygons and polyphot_io.read_polyphot
+        give them
+        """
+
+        def build():
+            import numpy as np
+            b = self.bounds.astype(np.float64)
+            return np.stack([b[:, [0, 1]], b[:, [2, 1]], b[:, [2, 3]],
+                             b[:, [0, 3]]], axis=1)
+
+        return self._array('vertices', build)
+
+    @property
+    def polygon(self):
+        """
+        (4, 2) array of the vertices of a cell relative to its lower corner,
+        the contents of <name>_polygons.txt
+        """
+
+        import numpy as np
+
+        return np.array([[0, 0], [self.dx, 0], [self.dx, self.dy],
+                         [0, self.dy]])
+
+    @property
+    def areas(self):
+        """
+        (ncells,) array of the cell areas in pixels
+        """
+
+        def build():
+            import numpy as np
+            return np.full(self.ncells, float(self.dx * self.dy))
+
+        return self._array('areas', build)
+
+    def pixel_cells(self):
+        """
+        :returns (height, width) int32 array of the cell each pixel is in
+        """
+
+        def build():
+            import numpy as np
+            col = np.arange(self.size[0], dtype=np.int32) // self.dx
+            row = np.arange(self.size[1], dtype=np.int32) // self.dy
+            return row[:, None] * np.int32(self.nx) + col[None, :]
+
+        return self._array('pixel_cells', build)
+
+    def cell_pixels(self):
+        """
+        :returns (ncells, dx * dy) array of the flat indices into the image
+                 of the pixels in each cell, e.g. data.ravel()[index[k]]
+        """
+
+        def build():
+            import numpy as np
+            ys, xs = np.mgrid[0:self.dy, 0:self.dx]
+            offsets = (ys * self.size[0] + xs).ravel()
+            b = self.bounds
+            return (b[:, 1] * self.size[0] + b[:, 0])[:, None] + offsets
+
+        return self._array('cell_pixels', build)
+
+    def cell_slices(self, cell):
+        """
+        :returns (row slice, column slice) of a cell, to index the image with
+        """
+
+        x0, y0, x1, y1 = self.bounds[cell]
+
+        return slice(y0, y1), slice(x0, x1)
+
+    def _cells(self, detected):
+        """
+        :returns cell indices from a boolean mask (flat or (ny, nx), e.g. an
+                 SNR map compared with the threshold) or indices
+        """
+
+        import numpy as np
+
+        detected = np.asarray(detected)
+        if detected.dtype == bool:
+            return np.flatnonzero(detected.ravel())
+
+        return detected.ravel()
+
+    def boxes(self, detected):
+        """
+        :param detected: boolean mask of cells or cell indices
+
+        :returns (n, 4) array of the pixel boxes x0, y0, x1, y1 of the cells
+        """
+
+        return self.bounds[self._cells(detected)]
+
+    def mask(self, detected):
+        """
+        :param detected: boolean mask of cells or cell indices
+
+        :returns (height, width) boolean image of the pixels in the cells
+        """
+
+        import numpy as np
+
+        flags = np.zeros(self.ncells, dtype=bool)
+        flags[self._cells(detected)] = True
+
+        return flags[self.pixel_cells()]
+
+    def write_files(self, directory='.', vertices=False):
+        """
+        Write the grid files iraf.polyphot reads (and optionally the corner
+        points, for checking the grid with a plot).
+
+        :param directory: directory to write them to
+        :param vertices: also write <name>_real_vertices.txt
+
+        :returns list of the files written
+        """
+
+        import os
+        import numpy as np
+
+        name = os.path.join(directory, self.name)
+        written = []
+
+        if vertices:
+            np.savetxt(name + '_real_vertices.txt', self.corners,
+                       fmt=('%4.0f', '%4.0f'))
+            written.append(name + '_real_vertices.txt')
+
+        np.savetxt(name + '_centers.txt', self.centers,
+                   fmt=('%4.0f', '%4.0f'))
+        written.append(name + '_centers.txt')
+
+        # polyphot's polygons file: 4 vertices relative to the centers
+        with open(name + '_polygons.txt', 'w') as f:
+            for x, y in self.polygon:
+                f.write('{} {}\n'.format(x, y))
+            f.write(';\n')
+        written.append(name + '_polygons.txt')
+
+        return written
+
+    def save(self, filename):
+        """
+        Store the arrays of the grid in an '.npz', see get_grid.
+        """
+
+        import os
+        import numpy as np
+
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **dict((k, getattr(self, k)) for k in _STORED))
+        os.replace(tmp, filename)
+
+    def load(self, filename):
+        """
+        Take the arrays of the grid from an '.npz' written by save.
+        """
+
+        import numpy as np
+
+        with np.load(filename) as npz:
+            self._arrays.update((k, npz[k]) for k in _STORED)
+
+
+def get_grid(nx, ny, size, cache_dir=None):
+    """
+    :param nx: number of boxes in x direction
+    :param ny: number of boxes in y direction
+    :param size: image size given as tuple: (x, y) i.e. (width, height)
+    :param cache_dir: optional directory to keep the grid arrays in between
+                      runs, e.g. GRID_CACHE_DIR
+
+    :returns the Grid, built once per process
+    """
+
+    import os
+
+    key = (nx, ny, (int(size[0]), int(size[1])))
+    grid = _grids.get(key)
+    if grid is not None:
+        return grid
+
+    grid = Grid(nx, ny, size)
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, '{}x{}_{}x{}.npz'.format(
+            nx, ny, *grid.size))
+        try:
+            grid.load(filename)
+        except (IOError, OSError, KeyError, ValueError):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            grid.save(filename)
+    _grids[key] = grid
+
+    return grid
+
+
+def make_grid(nx, ny, size, vertices=False, directory='.'):
     """
     Generate grid coordinates for an image as well as coordinates of polygon
     centers. Originally by Dr. Elsa Johnson. Modified by Eryn Cangi May 2016.
+    Only needed for iraf.polyphot; everything else takes the geometry from
+    get_grid without any files.
     ---INPUTS---
         nx: number of boxes in x direction
         ny: " " " " y "
         size: image size given as tuple: (x, y) i.e. (width, height)
         vertices: boolean value determining whether to make a file of vertices
+        directory: where to write the files
     ---OUTPUTS---
-        <name>vertices.txt: file containing polygon vertices in relative lengths
-        <name>centers.txt: file containing polygon centers
+        <name>_real_vertices.txt: file containing the grid vertices
+        <name>_centers.txt: file containing polygon centers
+        <name>_polygons.txt: polygon vertices relative to the centers
+        Returns the Grid.
     """
 
-    import numpy as np
-
-    x_beg = 0             #x and y start pixels
-    y_beg = 0
-    x_end = size[0]       # x and y end pixels
-    y_end = size[1]
-    dx = x_end // nx     # set x-dimension of rectangles
-    dy = y_end // ny     # " y-dimension " "
-    name = '{}x{}grid'.format(nx, ny) # name for output files
+    grid = get_grid(nx, ny, size)
 
     print('Creating files for grid with cell size {}x{} px\n'
-          'Grid size: {}x{}'.format(dx, dy, nx, ny))
+          'Grid size: {}x{}'.format(grid.dx, grid.dy, nx, ny))
 
-    if vertices:
-        # Creates list showing actual grid vertices. Not required for polyphot
-        # --used for vertification with plotting
-        xx = np.tile(np.arange(x_beg, x_end+dx, dx), ny+1)
-        yy = np.repeat(np.arange(y_beg, y_end + dy, dy), nx + 1)
-        try:
-            big = np.column_stack((xx, yy))
-        except:
-            raise ValueError('It is required to choose a grid size such that '
-                             'the number of rectangles in each direction '
-                             'exactly divides the image dimensions!')
-        np.savetxt(name+"_real_vertices.txt", big, fmt=('%4.0f', '%4.0f'))
-
-    # Create list of polygon centers
-    cx = np.tile(np.arange(x_beg + dx/2, x_end + dx/2, dx), ny)
-    cy = np.repeat(np.arange(y_beg + dy / 2, y_end + dy / 2, dy), nx)
-    try:
-        bigc = np.column_stack((cx, cy))
-    except:
-        raise ValueError('Bad grid size: you must choose a grid size such that'
-                         ' the number of rectangles in each direction exactly '
-                         'divides the image dimensions.')
-    np.savetxt(name+"_centers.txt", bigc, fmt=('%4.0f', '%4.0f'))
-               #newline='\n;\n')
-
-
-    # Create polyphot's required file 'polygons'. Given in format of 4
-    # vertices RELATIVE to the centers.
-    f = open(name+'_polygons.txt', 'w')
-    f.write('0 0\n')
-    f.write('{} 0\n'.format(dx))
-    f.write('{} {}\n'.format(dx, dy))
-    f.write('0 {}\n'.format(dy))
-    f.write(';\n')
-    f.close()
+    grid.write_files(directory, vertices=vertices)
 
     print('...Files created sucessfully!')
 
-make_grid(10, 10, (1280, 960))
-make_grid(5, 4, (1280, 960))
-make_grid(8, 6, (1280, 960))
-make_grid(16, 12, (1280, 960))
-make_grid(32, 24, (1280, 960))
-make_grid(80, 64, (1280, 960))
-make_grid(80, 80, (1280, 960))
-make_grid(64, 64, (1280, 960))
-make_grid(20, 20, (1280, 960))
+    return grid
 
 
+if __name__ == '__main__':
+    # the grid files used so far for the 1280x960 frames
+    make_grid(10, 10, (1280, 960))
+    make_grid(5, 4, (1280, 960))
+    make_grid(8, 6, (1280, 960))
+    make_grid(16, 12, (1280, 960))
+    make_grid(32, 24, (1280, 960))
+    make_grid(80, 64, (1280, 960))
+    make_grid(80, 80, (1280, 960))
+    make_grid(64, 64, (1280, 960))
+    make_grid(20, 20, (1280, 960))
@@ -0,0 +1,176 @@
+# ============================================================================ #
+# Processing manifest for a session. Records the content hash of every input
+# file and which stages have been run on it with which parameters, so a rerun
+# only has to process files that are new or have changed. Stages may also
+# keep their (small) results in the manifest so they can be written out
+# again without recomputing them.
+# ============================================================================ #
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_hash(path, blocksize=1 << 20):
+    """
+    :param path: file to hash
+    :param blocksize: bytes read at a time
+
+    :returns SHA-1 hex digest of the file's contents
+    """
+
+    import hashlib
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            h.update(block)
+            block = f.read(blocksize)
+
+    return h.hexdigest()
+
+
+def _normalize(params):
+    """
+    Parameters as they are stored in the manifest: a JSON round trip, so
+    tuples, numpy floats etc. compare equal to what is read back.
+    """
+
+    import json
+
+    if params is None:
+        return None
+
+    return json.loads(json.dumps(params, sort_keys=True, default=float))
+
+
+class Manifest(object):
+    """
+    Per-session record of input files and completed stages, kept as JSON.
+
+    :param path: the manifest file, or a session directory in which case
+                 'manifest.json' in that directory is used
+    """
+
+    def __init__(self, path):
+        import json
+        import os
+
+        if os.path.isdir(path):
+            path = os.path.join(path, MANIFEST_NAME)
+        self.path = path
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                contents = json.load(f)
+        else:
+            contents = {}
+        self.files = contents.get('files', {})
+        self.stages = contents.get('stages', {})
+
+    def fingerprint(self, path):
+        """
+        Content hash of a file. The file is only read again if its size or
+        modification time differ from what was recorded last time.
+
+        :param path: input file
+
+        :returns SHA-1 hex digest of the file
+        """
+
+        import os
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.files.get(path)
+        if entry is not None and entry['size'] == st.st_size \
+                and entry['mtime'] == st.st_mtime:
+            return entry['sha1']
+
+        digest = file_hash(path)
+        self.files[path] = {'sha1': digest, 'size': st.st_size,
+                            'mtime': st.st_mtime}
+
+        return digest
+
+    def is_done(self, stage, path, params=None):
+        """
+        :param stage: name of the stage, e.g. 'sky' or 'photometry 64x64'
+        :param path: input file
+        :param params: parameters the stage is run with (anything JSON can
+                       store)
+
+        :returns True if the stage already ran on this exact file content
+                 with the same parameters
+        """
+
+        import os
+
+        entry = self.stages.get(stage, {}).get(os.path.abspath(path))
+        if entry is None or not os.path.exists(path):
+            return False
+
+        return entry['sha1'] == self.fingerprint(path) \
+            and entry['params'] == _normalize(params)
+
+    def result(self, stage, path):
+        """
+        :returns the result stored with mark_done for a stage and file, or
+                 None
+        """
+
+        import os
+
+        entry = self.stages.get(stage, {}).get(os.path.abspath(path))
+        if entry is None:
+            return None
+
+        return entry.get('result')
+
+    def mark_done(self, stage, path, params=None, result=None):
+        """
+        Record that a stage finished on a file.
+
+        :param stage: name of the stage
+        :param path: input file
+        :param params: parameters the stage was run with
+        :param result: optional small result to keep (anything JSON can
+                       store), returned later by result()
+        """
+
+        import os
+        import time
+
+        entry = {'sha1': self.fingerprint(path),
+                 'params': _normalize(params),
+                 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        if result is not None:
+            entry['result'] = _normalize(result)
+
+        self.stages.setdefault(stage, {})[os.path.abspath(path)] = entry
+
+    def pending(self, stage, paths, params=None):
+        """
+        :param stage: name of the stage
+        :param paths: input files
+        :param params: parameters the stage will be run with
+
+        :returns the paths that are new, changed or were processed with
+                 different parameters
+        """
+
+        return [p for p in paths if not self.is_done(stage, p, params)]
+
+    def save(self):
+        """
+        Write the manifest. The file is replaced in one step, so an
+        interrupted run never leaves a half-written manifest behind.
+        """
+
+        import json
+        import os
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'files': self.files, 'stages': self.stages}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
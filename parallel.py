@@ -0,0 +1,239 @@
+# ============================================================================ #
+# Helpers for spreading per-image work over a pool of worker processes.
+# Work is submitted a bounded number of items at a time and results come back
+# in input order. An exception in one item is caught in the worker and handed
+# back instead of bringing down the whole run.
+# ============================================================================ #
+
+
+def _guarded_call(func, item):
+    """
+    Runs func(item) inside a worker and traps any exception, so one bad image
+    doesn't kill the pool.
+
+    :returns (True, result) on success, (False, formatted traceback) on error
+    """
+
+    import traceback
+
+    try:
+        return True, func(item)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _instrumented_call(func, item, settings):
+    """
+    _guarded_call in a worker process, handing back the stage records (see
+    instrument.py) made while running it.
+
+    :param settings: instrument.Recorder.settings() of the parent process
+
+    :returns (ok, value, records taken from the worker's recorder)
+    """
+
+    from instrument import recorder
+
+    rec = recorder()
+    if rec.settings() != settings:
+        rec.configure(*settings)
+    ok, value = _guarded_call(func, item)
+
+    return ok, value, rec.take() if rec.enabled else None
+
+
+def _init_worker():
+    """
+    Runs once in every worker process: jobs there read each frame once, so
+    keep only a few frames in its cache (see frames.WORKER_CACHE_BYTES).
+    """
+
+    from frames import WORKER_CACHE_BYTES, set_cache_size
+
+    set_cache_size(WORKER_CACHE_BYTES)
+
+
+def _start_pool(processes):
+    """
+    :returns a ProcessPoolExecutor with the given number of worker
+             processes, set up with _init_worker
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=processes,
+                               initializer=_init_worker)
+
+
+def default_processes():
+    """
+    :returns the number of worker processes to use when none is given: the
+             number of CPUs available to this process.
+    """
+
+    import os
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def parallel_map(func, items, processes=None, max_pending=None,
+                 frame_path=None):
+    """
+    Apply func to every item using a pool of worker processes.
+
+    :param func: a picklable (module level) function of one argument
+    :param items: iterable of arguments. It is consumed lazily, so it may be a
+                  generator.
+    :param processes: number of worker processes. Defaults to the number of
+                      CPUs; 1 runs everything in this process.
+    :param max_pending: most items submitted but not yet collected at any
+                        time. Defaults to twice the number of processes.
+                        Keeps memory bounded when results are large.
+    :param frame_path: optional function giving the FITS file an item works
+                       on. When everything runs in this process the frames
+                       are read ahead on background threads (see
+                       frames.prefetch) while the current item is computed.
+                       A pool of processes overlaps reading and computing
+                       by itself, so it is not used there.
+
+    :returns generator of (item, ok, value) tuples in the same order as items.
+             ok is True and value is the result if func succeeded, otherwise
+             ok is False and value is the traceback as a string.
+             Stages recorded in the workers (see instrument.py) are added
+             to this process's recorder as the results come back. A worker
+             process that dies only fails the item it was running; the pool
+             is started again for the rest.
+    """
+
+    from collections import deque
+    from instrument import recorder
+
+    if processes is None:
+        processes = default_processes()
+    if max_pending is None:
+        max_pending = 2 * processes
+    max_pending = max(1, max_pending)
+
+    # no point starting a pool just for one worker
+    if processes <= 1:
+        if frame_path is not None:
+            from frames import prefetch
+            items = prefetch(items, path=frame_path)
+        for item in items:
+            ok, value = _guarded_call(func, item)
+            yield item, ok, value
+        return
+
+    settings = recorder().settings()
+    pending = deque()
+    pool = _start_pool(processes)
+    try:
+        for item in items:
+            pending.append((item, _submit(pool, _instrumented_call, func,
+                                          item, settings)))
+
+            # wait for the oldest item before submitting more; results are
+            # handed back in order anyway so there's nothing to gain from
+            # running further ahead
+            if len(pending) >= max_pending:
+                pool, result = _collect(pool, processes, pending, func,
+                                        settings)
+                yield result
+
+        while pending:
+            pool, result = _collect(pool, processes, pending, func, settings)
+            yield result
+    finally:
+        pool.shutdown()
+
+
+def _pool_died(future):
+    """
+    :returns whether a future failed because a worker process of its pool
+             died, which breaks the whole pool
+    """
+
+    from concurrent.futures.process import BrokenProcessPool
+
+    return isinstance(future.exception(), BrokenProcessPool)
+
+
+def _submit(pool, func, *args):
+    """
+    pool.submit that doesn't raise once a worker has died: the future it
+    returns fails with BrokenProcessPool instead, like those of the calls
+    that were in flight, so they can all be handled in one place.
+    """
+
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+
+    try:
+        return pool.submit(func, *args)
+    except BrokenProcessPool as e:
+        future = Future()
+        future.set_exception(e)
+        return future
+
+
+def _retry_alone(pool, processes, func, *args):
+    """
+    Run a call that was in flight when a worker process died again, on its
+    own in a new pool, to tell whether it is the one killing workers (e.g.
+    running out of memory) or was only sharing the pool with it.
+
+    :param pool: the broken pool (or the one left by the previous retry),
+                 shut down first
+    :param processes: number of workers of the new pool
+
+    :returns (pool to carry on with, finished future of the call). The
+             future fails with BrokenProcessPool if the worker died again,
+             and the pool handed back is then a fresh one.
+    """
+
+    from concurrent.futures import wait
+
+    pool.shutdown()
+    pool = _start_pool(processes)
+    future = pool.submit(func, *args)
+    wait([future])
+    if _pool_died(future):
+        pool.shutdown()
+        pool = _start_pool(processes)
+
+    return pool, future
+
+
+def _collect(pool, processes, pending, func, settings):
+    """
+    Wait for the oldest item of parallel_map. A worker that dies outright
+    (e.g. killed for running out of memory) takes the whole pool with it:
+    the item is then run again on its own in a new pool and only reported
+    as failed if its worker dies again, and the other items in flight are
+    submitted again to the new pool.
+
+    :returns (pool to carry on with, (item, ok, value))
+    """
+
+    from concurrent.futures.process import BrokenProcessPool
+    from instrument import recorder
+
+    item, future = pending.popleft()
+    if _pool_died(future):
+        pool, future = _retry_alone(pool, processes, _instrumented_call,
+                                    func, item, settings)
+        for k, (other, f) in enumerate(pending):
+            if _pool_died(f):
+                pending[k] = (other, _submit(pool, _instrumented_call, func,
+                                             other, settings))
+
+    try:
+        ok, value, records = future.result()
+        recorder().merge(records)
+    except BrokenProcessPool as e:
+        ok, value = False, 'Worker process died: {}'.format(e)
+
+    return pool, (item, ok, value)
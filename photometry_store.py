@@ -0,0 +1,355 @@
+# ============================================================================ #
+# Columnar store for the results of the batch photometry stage. One store
+# holds every image, grid size and cell of a session, so downstream scripts
+# open a single store instead of re-parsing a text log per image.
+#
+# Two formats are supported:
+#   <name>/        a directory with a small index of images (images.npy) and
+#                  one raw binary file per cell column. Columns are read with
+#                  np.memmap, and selections on filter/exposure/grid are made
+#                  on the index first so only the matching cells are touched.
+#   <name>.parquet a Parquet file (needs pyarrow), filtered with row group
+#                  statistics when read.
+# ============================================================================ #
+
+# per-cell columns and their types. Everything else is per image.
+CELL_COLUMNS = [('cell', 'int32'), ('counts', 'float64'), ('area', 'float64'),
+                ('flux', 'float64'), ('flux_err', 'float64'),
+                ('mag', 'float64'), ('merr', 'float64'),
+                ('count_err', 'float64')]
+
+IMAGE_COLUMNS = ['image', 'path', 'grid', 'nx', 'ny', 'skyval', 'sigma',
+                 'skyerr', 'exposure', 'filter1', 'filter2']
+
+
+def image_meta(image):
+    """
+    :param image: one entry of the image_data list from
+                  polyphot_batch.read_params, i.e. [IMAGE, SKYVAL, SIGMA,
+                  SKYVAL ERR, EXPOSURE, FILTER 1, FILTER 2, PATH]
+
+    :returns dictionary of the per-image columns of the store (without grid)
+    """
+
+    return {'image': image[0], 'skyval': float(image[1]),
+            'sigma': float(image[2]), 'skyerr': float(image[3]),
+            'exposure': float(image[4]), 'filter1': image[5],
+            'filter2': image[6], 'path': image[7]}
+
+
+class StoreWriter(object):
+    """
+    Writes a photometry store one image at a time, so a whole session never
+    has to be held in memory. Use as a context manager, or call close() once
+    everything is added and abort() if the run fails.
+
+    Everything is written next to the store first and only takes the place
+    of an existing store at path in close(), so readers never see a store
+    that is half written, and a run that fails or is interrupted keeps the
+    previous one.
+
+    :param path: where to write the store. Paths ending in '.parquet' are
+                 written as Parquet, anything else as a directory store.
+    :param rows_per_group: for Parquet, number of cells buffered per row group
+    """
+
+    def __init__(self, path, rows_per_group=1000000):
+        import os
+        import shutil
+
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self._tmp = '{}.{}.tmp'.format(path.rstrip(os.sep), os.getpid())
+        self._closed = False
+        self.rows_per_group = rows_per_group
+        self.nrows = 0
+        self._index = []
+        self._buffer = []
+        self._writer = None
+
+        if not self.parquet:
+            if os.path.isdir(self._tmp):
+                shutil.rmtree(self._tmp)
+            os.makedirs(self._tmp)
+            self._files = dict((name, open(os.path.join(self._tmp,
+                                                        name + '.bin'), 'wb'))
+                               for name, dtype in CELL_COLUMNS)
+
+    def add(self, meta, nx, ny, results):
+        """
+        Add the photometry of one image on one grid.
+
+        :param meta: per-image values, see image_meta
+        :param nx, ny: grid size
+        :param results: dictionary of per-cell arrays, as returned by
+                        grid_photometry.grid_photometry
+        """
+
+        import numpy as np
+
+        ncells = len(results['counts'])
+        columns = {}
+        for name, dtype in CELL_COLUMNS:
+            if name == 'cell':
+                col = np.arange(ncells, dtype=dtype)
+            elif name in results:
+                col = np.asarray(results[name], dtype=dtype)
+            else:
+                col = np.full(ncells, np.nan, dtype=dtype)
+            columns[name] = col
+
+        row = dict(meta)
+        row.update({'grid': '{}x{}'.format(nx, ny), 'nx': nx, 'ny': ny,
+                    'start': self.nrows, 'stop': self.nrows + ncells})
+        self._index.append(row)
+        self.nrows += ncells
+
+        if self.parquet:
+            self._buffer.append((row, columns))
+            if sum(len(c['cell']) for r, c in self._buffer) \
+                    >= self.rows_per_group:
+                self._flush_parquet()
+        else:
+            for name, dtype in CELL_COLUMNS:
+                columns[name].astype('<' + np.dtype(dtype).str[1:]).tofile(
+                    self._files[name])
+
+    def _flush_parquet(self):
+        """
+        Write the buffered images out as one Parquet row group.
+        """
+
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._buffer:
+            return
+
+        table = {}
+        for name in IMAGE_COLUMNS:
+            table[name] = np.concatenate([np.repeat(row[name],
+                                                    len(c['cell']))
+                                          for row, c in self._buffer])
+        for name, dtype in CELL_COLUMNS:
+            table[name] = np.concatenate([c[name] for row, c in self._buffer])
+        table = pa.table(table)
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._tmp, table.schema)
+        self._writer.write_table(table)
+        self._buffer = []
+
+    def close(self):
+        """
+        Finish writing and put the store in place. For a directory store
+        this writes the image index that readers use to find the cells of
+        each image. Calling it again, or after abort(), does nothing.
+        """
+
+        import os
+        import shutil
+        import numpy as np
+
+        if self._closed:
+            return
+        self._closed = True
+
+        if self.parquet:
+            self._flush_parquet()
+            if self._writer is not None:
+                self._writer.close()
+                os.replace(self._tmp, self.path)
+            return
+
+        for f in self._files.values():
+            f.close()
+
+        dtype = []
+        for name in IMAGE_COLUMNS + ['start', 'stop']:
+            values = [row[name] for row in self._index]
+            if name in ('image', 'path', 'grid', 'filter1', 'filter2'):
+                width = max([len(v) for v in values] + [1])
+                dtype.append((name, 'U{}'.format(width)))
+            elif name in ('nx', 'ny', 'start', 'stop'):
+                dtype.append((name, 'int64'))
+            else:
+                dtype.append((name, 'float64'))
+
+        index = np.array([tuple(row[name] for name, t in dtype)
+                          for row in self._index], dtype=dtype)
+        np.save(os.path.join(self._tmp, 'images.npy'), index)
+
+        # a directory can't be replaced in one step: move the old store out
+        # of the way first and only delete it once the new one is in place
+        old = None
+        if os.path.isdir(self.path):
+            old = '{}.{}.old'.format(self.path.rstrip(os.sep), os.getpid())
+            os.rename(self.path, old)
+        os.rename(self._tmp, self.path)
+        if old is not None:
+            shutil.rmtree(old)
+
+    def abort(self):
+        """
+        Throw away what was written and leave any existing store at path as
+        it is. Does nothing once the store is closed.
+        """
+
+        import os
+        import shutil
+
+        if self._closed:
+            return
+        self._closed = True
+
+        if self.parquet:
+            if self._writer is not None:
+                self._writer.close()
+        else:
+            for f in self._files.values():
+                f.close()
+
+        if os.path.isdir(self._tmp):
+            shutil.rmtree(self._tmp)
+        elif os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _select(index, images, grid, filter1, filter2, exposure, min_exposure,
+            max_exposure):
+    """
+    Boolean mask over the per-image index for the read_store selections.
+    """
+
+    import numpy as np
+
+    keep = np.ones(len(index), dtype=bool)
+    if images is not None:
+        keep &= np.isin(index['image'], list(images))
+    if grid is not None:
+        keep &= index['grid'] == grid
+    if filter1 is not None:
+        keep &= index['filter1'] == filter1
+    if filter2 is not None:
+        keep &= index['filter2'] == filter2
+    if exposure is not None:
+        keep &= np.isclose(index['exposure'], exposure)
+    if min_exposure is not None:
+        keep &= index['exposure'] >= min_exposure
+    if max_exposure is not None:
+        keep &= index['exposure'] <= max_exposure
+
+    return keep
+
+
+def read_index(path):
+    """
+    :param path: directory store written by StoreWriter
+
+    :returns the per-image index: a structured array with the image columns
+             and the start/stop rows of each image's cells
+    """
+
+    import os
+    import numpy as np
+
+    return np.load(os.path.join(path, 'images.npy'))
+
+
+def read_store(path, columns=None, images=None, grid=None, filter1=None,
+               filter2=None, exposure=None, min_exposure=None,
+               max_exposure=None):
+    """
+    Load (part of) a photometry store.
+
+    :param path: store written by StoreWriter
+    :param columns: list of columns to return. Defaults to all of them.
+    :param images: only return these image names
+    :param grid: only return this grid size, e.g. '64x64'
+    :param filter1, filter2: only return images taken with these filters
+    :param exposure: only return images with this exposure time (s)
+    :param min_exposure, max_exposure: only return images with exposure times
+                                       in this range (s)
+
+    :returns dictionary of arrays, one entry per column, one element per
+             cell. For a directory store with no selection the cell columns
+             are read-only memory maps of the files on disk.
+    """
+
+    import os
+    import numpy as np
+
+    if columns is None:
+        columns = IMAGE_COLUMNS + [name for name, dtype in CELL_COLUMNS]
+
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        filters = []
+        for name, op, value in [('image', 'in', images), ('grid', '==', grid),
+                                ('filter1', '==', filter1),
+                                ('filter2', '==', filter2),
+                                ('exposure', '==', exposure),
+                                ('exposure', '>=', min_exposure),
+                                ('exposure', '<=', max_exposure)]:
+            if value is not None:
+                filters.append((name, op, list(value) if op == 'in'
+                                else value))
+
+        table = pq.read_table(path, columns=columns, filters=filters or None)
+        return dict((name, table.column(name).to_numpy())
+                    for name in columns)
+
+    index = read_index(path)
+    if not len(index):
+        return dict((name, np.array([])) for name in columns)
+
+    keep = _select(index, images, grid, filter1, filter2, exposure,
+                   min_exposure, max_exposure)
+    nrows = int(index['stop'][-1])
+    selected = index[keep]
+    counts = selected['stop'] - selected['start']
+
+    # rows of the selected cells. Contiguous runs of images come out as one
+    # slice of the memory map, so nothing is copied if everything is kept.
+    if keep.all():
+        rows = slice(0, nrows)
+    else:
+        offsets = np.repeat(selected['start'] - np.cumsum(counts) + counts,
+                            counts)
+        rows = offsets + np.arange(counts.sum())
+
+    results = {}
+    for name in columns:
+        if name in IMAGE_COLUMNS:
+            results[name] = np.repeat(selected[name], counts)
+        else:
+            dtype = dict(CELL_COLUMNS)[name]
+            mm = np.memmap(os.path.join(path, name + '.bin'),
+                           dtype='<' + np.dtype(dtype).str[1:], mode='r',
+                           shape=(nrows,))
+            results[name] = mm[rows]
+
+    return results
+
+
+def store_dataframe(results):
+    """
+    :param results: dictionary returned by read_store
+
+    :returns the same data as a pandas DataFrame
+    """
+
+    from pandas import DataFrame
+
+    return DataFrame(results)
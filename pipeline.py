@@ -0,0 +1,447 @@
+# ============================================================================ #
+# Unattended reduction of a session, driven by a JSON config instead of
+# prompts. The stages form a dependency graph:
+#
+#     scan -> sky -> tidy
+#                 -> photometry -> detection -> render
+#
+# Asking for a stage brings in everything it needs. The per-image stages run
+# one after the other on each frame (read once) in a pool of worker
+# processes, many images at a time, and their records stream straight into
+# the tidy output, the photometry store and the detection summary as they
+# come back, with no text files handed from one stage to the next. With a
+# 'report' file in the config every stage is timed on every image (see
+# instrument.py) and the slowest stages and images are listed at the end.
+#
+# Run with: python pipeline.py session.json
+# ============================================================================ #
+
+from collections import OrderedDict
+
+# stage -> the stages it needs
+PIPELINE_STAGES = OrderedDict([('scan', ()),
+                               ('sky', ('scan',)),
+                               ('tidy', ('sky',)),
+                               ('photometry', ('sky',)),
+                               ('detection', ('photometry',)),
+                               ('render', ('detection',))])
+
+# stages run on every frame in the workers, in this order
+IMAGE_STAGES = ('sky', 'photometry', 'detection', 'render')
+
+DEFAULT_CONFIG = {
+    # top level directory of the images, <filters>/<exposure>/<image>.FIT
+    'top': None,
+    # existing files_and_params.txt or catalog to take the images and their
+    # sky from instead of running the sky stage
+    'params': None,
+    'stages': list(PIPELINE_STAGES),
+    'grids': ['64x64'],
+    'nsigma': 3.0,
+    'processes': None,
+    'max_pending': None,
+    # tidy output, a files_and_params.txt style file or a catalog
+    'output': 'files_and_params.txt',
+    # photometry store to write, or None
+    'store': None,
+    # table of per-image detection summaries, and optional session catalog
+    # to add the images and summaries to
+    'summary': 'detection_summary.txt',
+    'catalog': None,
+    # directory of master bias and darks (see calibration.py), or None
+    'calibration': None,
+    # directory of the result cache (see result_cache.py), or None
+    'cache': None,
+    'max_size': 1024,
+    # JSON or CSV report of the time, I/O and memory of every stage on every
+    # image (see instrument.py), or None to not record them; and None,
+    # 'cprofile' or 'sample' to profile the functions called in the stages
+    'report': None,
+    'profile': None,
+}
+
+SUMMARY_COLUMNS = ['image', 'path', 'grid', 'skyval', 'sigma', 'cell_area',
+                   'min_counts', 'max_counts', 'threshold', 'max_snr',
+                   'threshold_multiple', 'ndetected']
+
+
+def load_config(filename=None, **overrides):
+    """
+    :param filename: JSON file with any of the DEFAULT_CONFIG keys, or None
+    :param overrides: values that replace those of the file
+
+    :returns the full config dictionary
+    """
+
+    import json
+
+    config = dict(DEFAULT_CONFIG)
+    given = {}
+    if filename is not None:
+        with open(filename, 'r') as f:
+            given = json.load(f)
+    given.update((k, v) for k, v in overrides.items() if v is not None)
+
+    unknown = set(given) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError('Unknown config keys: {}'.format(
+            ', '.join(sorted(unknown))))
+    config.update(given)
+
+    return config
+
+
+def write_config(filename, **values):
+    """
+    Write a config file with every key, to edit for a session.
+
+    :param filename: JSON file to write
+    :param values: values to use instead of the defaults
+    """
+
+    import json
+
+    with open(filename, 'w') as f:
+        json.dump(load_config(**values), f, indent=1, sort_keys=True)
+
+
+def resolve_stages(stages, provided=()):
+    """
+    :param stages: names of the stages asked for
+    :param provided: stages whose output is already available, e.g. 'sky'
+                     from an existing parameter file. They are not brought in
+                     as requirements.
+
+    :returns the stages to run, requirements included, in dependency order
+    """
+
+    for stage in stages:
+        if stage not in PIPELINE_STAGES:
+            raise ValueError('Unknown stage {}; the stages are {}'.format(
+                stage, ', '.join(PIPELINE_STAGES)))
+
+    wanted = set()
+
+    def add(stage):
+        if stage in wanted:
+            return
+        wanted.add(stage)
+        for required in PIPELINE_STAGES[stage]:
+            if required not in provided:
+                add(required)
+
+    for stage in stages:
+        add(stage)
+
+    return [stage for stage in PIPELINE_STAGES if stage in wanted]
+
+
+def _scan(config, stages):
+    """
+    :returns generator of one record per image: image, path (with trailing
+             slash), exposure, filters and, if the sky comes from a
+             parameter file, skyval, sigma and skyerr
+    """
+
+    import os
+
+    if 'sky' not in stages:
+        from polyphot_batch import read_params
+
+        for image in read_params(config['params'])[0]:
+            yield {'image': image[0], 'skyval': float(image[1]),
+                   'sigma': float(image[2]), 'skyerr': float(image[3]),
+                   'exposure': float(image[4]), 'filter1': image[5],
+                   'filter2': image[6], 'path': image[7]}
+        return
+
+    from instrument import stage
+    from inventory import build_inventory
+
+    if config['top'] is None:
+        raise ValueError("The config needs 'top', the image directory, or "
+                         "'params' to run without the sky stage")
+
+    with stage('scan', config['top']):
+        inventory = build_inventory(config['top'])
+    for row in inventory:
+        dirpath, image = os.path.split(str(row['path']))
+        yield {'image': image, 'path': dirpath + '/',
+               'exposure': float(row['exposure']),
+               'filter1': str(row['filter1']) or 'unknown',
+               'filter2': str(row['filter2']) or 'none'}
+
+
+def _image_job(job):
+    """
+    Worker for run_pipeline: the per-image stages of one frame. job is
+    (record, stages, settings).
+
+    :returns dictionary with the record (with the sky filled in), the
+             photometry keyed by grid if it is to be stored, the detection
+             summaries keyed by grid and the PNGs rendered
+    """
+
+    from detection import detect_grids, measure_grids, measure_sky
+    from frames import get_frame
+    from instrument import stage
+    from make_grid import get_grid
+    from polyphot_batch import parse_gsize
+    from render import render_overlay
+
+    record, stages, settings = job
+    path = record['path'] + record['image']
+    exposure = record['exposure']
+    itime = exposure if exposure > 0 else 1.0
+    calibration = settings['calibration']
+    cache = settings['cache']
+
+    frame = []
+
+    def load():
+        if not frame:
+            data = get_frame(path)
+            if calibration is not None:
+                data = calibration.apply(data, path, exposure)
+            frame.append(data)
+        return frame[0]
+
+    params = None
+    if calibration is not None:
+        params = {'calibration': calibration.fingerprint(path, exposure)}
+
+    result = {'record': record, 'photometry': None, 'detection': None,
+              'renders': []}
+
+    if 'sky' in stages:
+        with stage('sky', path):
+            sky = measure_sky(load, cache=cache, path=path, params=params)
+        record.update((k, sky[k]) for k in ('skyval', 'sigma', 'skyerr'))
+    sky = dict((k, record[k]) for k in ('skyval', 'sigma', 'skyerr'))
+
+    if 'photometry' not in stages:
+        return result
+    with stage('photometry', path):
+        phot = measure_grids(load, settings['grids'], sky, itime=itime,
+                             cache=cache, path=path, params=params)
+    if settings['keep_photometry']:
+        result['photometry'] = phot
+
+    if 'detection' not in stages:
+        return result
+    with stage('detection', path):
+        detections = detect_grids(phot, sky, nsigma=settings['nsigma'])
+    result['detection'] = dict((grid, detections[grid][1])
+                               for grid in settings['grids'])
+
+    if 'render' not in stages:
+        return result
+    data = load()
+    with stage('render', path):
+        for grid in settings['grids']:
+            nx, ny = parse_gsize(grid)
+            snr, summary = detections[grid]
+            outlines = get_grid(nx, ny,
+                                (data.shape[1], data.shape[0])).vertices
+            filename = '{}{}_detect_{}.png'.format(record['path'],
+                                                   record['image'][:-4], grid)
+            render_overlay(data, outlines[snr.ravel() >= settings['nsigma']],
+                           filename, title='{}  {}  max SNR {:.1f}'.format(
+                               record['image'], grid, summary['max_snr']),
+                           max_size=settings['max_size'])
+            result['renders'].append(filename)
+
+    return result
+
+
+def _params_record(record):
+    """
+    :returns a record as a line of files_and_params.txt
+    """
+
+    return [record[k] for k in ('image', 'skyval', 'sigma', 'skyerr',
+                                'exposure', 'filter1', 'filter2', 'path')]
+
+
+def run_pipeline(config):
+    """
+    Run the stages of a config on every image.
+
+    :param config: dictionary as from load_config, or the name of a JSON
+                   config file
+
+    :returns dictionary with the stages run and the numbers of images done
+             and failed
+    """
+
+    import os
+    import time
+    import instrument
+    from parallel import parallel_map
+
+    if not isinstance(config, dict):
+        config = load_config(config)
+
+    if config['report'] is not None:
+        instrument.recorder().clear()
+        instrument.enable(profile=config['profile'])
+
+    provided = ()
+    if config['params'] is not None and 'sky' not in config['stages']:
+        provided = ('sky',)
+    stages = resolve_stages(config['stages'], provided=provided)
+    image_stages = tuple(s for s in IMAGE_STAGES if s in stages)
+
+    calibration = None
+    if config['calibration'] is not None:
+        from calibration import Calibration
+        calibration = Calibration(config['calibration'])
+    cache = None
+    if config['cache'] is not None:
+        from result_cache import ResultCache
+        cache = ResultCache(config['cache'])
+
+    settings = {'grids': list(config['grids']), 'nsigma': config['nsigma'],
+                'calibration': calibration, 'cache': cache,
+                'max_size': config['max_size'],
+                'keep_photometry': config['store'] is not None}
+
+    print('Running stages {}'.format(' -> '.join(stages)))
+    start = time.time()
+
+    writer = None
+    if config['store'] is not None and 'photometry' in stages:
+        from photometry_store import StoreWriter
+        writer = StoreWriter(config['store'])
+    table = None
+    if config['summary'] is not None and 'detection' in stages:
+        table = open(config['summary'], 'w')
+        table.write('# ' + ' \t '.join(c.upper() for c in SUMMARY_COLUMNS)
+                    + '\n')
+    conn = None
+    if config['catalog'] is not None:
+        from catalog import connect
+        conn = connect(config['catalog'])
+
+    counts = {'done': 0, 'failed': 0}
+
+    def write(record, value):
+        from catalog import add_images, add_summaries, image_row
+        from photometry_store import image_meta
+        from polyphot_batch import parse_gsize
+
+        if writer is not None:
+            meta = image_meta(_params_record(record))
+            for grid, phot in value['photometry'].items():
+                nx, ny = parse_gsize(grid)
+                writer.add(meta, nx, ny, phot)
+        if conn is not None:
+            add_images(conn, [image_row(_params_record(record))])
+        if value['detection'] is not None:
+            for grid, summary in value['detection'].items():
+                row = dict(summary, image=record['image'],
+                           path=record['path'], grid=grid,
+                           skyval=record['skyval'],
+                           sigma=record['sigma'])
+                if table is not None:
+                    table.write('\t'.join(str(row[c]) for c in
+                                          SUMMARY_COLUMNS) + '\n')
+                if conn is not None:
+                    add_summaries(conn, grid, [row])
+            if table is not None:
+                table.flush()
+
+    def stream():
+        # every record that comes back goes to the store, summary table and
+        # catalog straight away, and is then handed on to the tidy output
+        jobs = ((record, image_stages, settings)
+                for record in _scan(config, stages))
+        for job, ok, value in parallel_map(
+                _image_job, jobs, processes=config['processes'],
+                max_pending=config['max_pending'],
+                frame_path=lambda job: job[0]['path'] + job[0]['image']):
+            record = job[0]
+            if not ok:
+                print('Failed on image {}{}:\n{}'.format(
+                    record['path'], record['image'], value))
+                counts['failed'] += 1
+                continue
+
+            counts['done'] += 1
+            record = value['record']
+            with instrument.stage('write', record['path'] + record['image']):
+                write(record, value)
+            yield record
+
+    try:
+        records = stream()
+        output = config['output']
+        if 'tidy' in stages and not (
+                conn is not None and os.path.abspath(output) ==
+                os.path.abspath(config['catalog'])):
+            from catalog import write_params
+            write_params(output, (_params_record(r) for r in records))
+        else:
+            for record in records:
+                pass
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    else:
+        if writer is not None:
+            writer.close()
+    finally:
+        if table is not None:
+            table.close()
+        if conn is not None:
+            conn.close()
+        if cache is not None:
+            cache.save()
+        if config['report'] is not None:
+            instrument.disable()
+
+    print('Pipeline finished in {:.1f} s: {} images done, {} failed'.format(
+        time.time() - start, counts['done'], counts['failed']))
+
+    if config['report'] is not None:
+        instrument.recorder().write_report(config['report'])
+        instrument.recorder().print_summary()
+        print('Stage report saved to {}'.format(config['report']))
+
+    return {'stages': stages, 'done': counts['done'],
+            'failed': counts['failed']}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Run the reduction of a session without prompts.')
+    parser.add_argument('config', nargs='?', default=None,
+                        help='JSON config file, see DEFAULT_CONFIG')
+    parser.add_argument('--top', default=None)
+    parser.add_argument('--params', default=None)
+    parser.add_argument('--stages', nargs='+', default=None,
+                        choices=list(PIPELINE_STAGES))
+    parser.add_argument('--grids', nargs='+', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--report', default=None,
+                        help='JSON or CSV file to report the time of every '
+                             'stage to')
+    parser.add_argument('--profile', default=None,
+                        choices=['cprofile', 'sample'])
+    parser.add_argument('--write-config', default=None, metavar='FILE',
+                        help='write a config with every key and exit')
+    args = parser.parse_args()
+
+    overrides = {'top': args.top, 'params': args.params,
+                 'stages': args.stages, 'grids': args.grids,
+                 'processes': args.processes, 'report': args.report,
+                 'profile': args.profile}
+    if args.write_config is not None:
+        write_config(args.write_config,
+                     **dict((k, v) for k, v in overrides.items()
+                            if v is not None))
+    else:
+        run_pipeline(load_config(args.config, **overrides))
@@ -0,0 +1,293 @@
+# ============================================================================ #
+# Sparse pixel-overlap weight matrices for arbitrary polygon grids. Entry
+# [cell, pixel] is the exact fraction of the pixel covered by the cell's
+# polygon, so grids no longer have to divide the image evenly or be axis
+# aligned. Multiplying the matrix with a stack of flattened frames gives the
+# photometry for the whole stack in one call.
+# ============================================================================ #
+
+# matrices already built in this process, keyed by image shape, polygons and
+# mask so the same grid is only ever computed once
+_matrix_cache = {}
+
+
+def rect_grid_polygons(nx, ny, size):
+    """
+    Polygons for an nx by ny grid of rectangles covering the whole image. The
+    cell edges are spread evenly, so they fall between pixels when the grid
+    doesn't divide the image exactly.
+
+    :param nx: number of cells in the x direction
+    :param ny: number of cells in the y direction
+    :param size: image size given as tuple: (x, y) i.e. (width, height)
+
+    :returns array of shape (nx * ny, 4, 2) of counter-clockwise vertices in
+             pixel coordinates, ordered like make_grid (x varies fastest)
+    """
+
+    import numpy as np
+
+    xe = np.linspace(0., size[0], nx + 1)
+    ye = np.linspace(0., size[1], ny + 1)
+
+    x0, y0 = np.meshgrid(xe[:-1], ye[:-1])
+    x1, y1 = np.meshgrid(xe[1:], ye[1:])
+    x0, y0, x1, y1 = x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel()
+
+    return np.stack([np.column_stack((x0, y0)), np.column_stack((x1, y0)),
+                     np.column_stack((x1, y1)), np.column_stack((x0, y1))],
+                    axis=1)
+
+
+def rotate_polygons(polygons, angle, center):
+    """
+    :param polygons: array of shape (ncells, nvertices, 2)
+    :param angle: rotation angle in degrees, counter-clockwise
+    :param center: (x, y) point to rotate about
+
+    :returns rotated copy of polygons
+    """
+
+    import numpy as np
+
+    theta = np.radians(angle)
+    rot = np.array([[np.cos(theta), -np.sin(theta)],
+                    [np.sin(theta), np.cos(theta)]])
+    center = np.asarray(center, dtype=np.float64)
+
+    return (np.asarray(polygons, dtype=np.float64) - center).dot(rot.T) \
+        + center
+
+
+def _antiderivative(t):
+    """
+    Antiderivative of clip(t, 0, 1): 0 below 0, t^2/2 between 0 and 1 and
+    t - 1/2 above 1.
+    """
+
+    import numpy as np
+
+    c = np.clip(t, 0., 1.)
+    return 0.5 * c * c + np.maximum(t - 1., 0.)
+
+
+def _group_weights(polygons, c0, r0, ncols, nrows):
+    """
+    Exact overlap of a group of polygons (same vertex count, same bounding
+    box size) with the pixels of their bounding boxes.
+
+    Uses Green's theorem: summing the integral of clip(y - r, 0, 1) dx along
+    every edge, restricted to pixel column c, gives minus the signed area of
+    the polygon inside pixel (r, c). Works for any simple polygon, convex or
+    not.
+
+    :returns array of shape (npolygons, nrows, ncols) of overlap areas
+    """
+
+    import numpy as np
+
+    xa = polygons[:, :, 0]
+    ya = polygons[:, :, 1]
+    xb = np.roll(xa, -1, axis=1)
+    yb = np.roll(ya, -1, axis=1)
+
+    # (P, E, 1, C): x range of each edge inside each pixel column
+    cols = (c0[:, None] + np.arange(ncols))[:, None, None, :]
+    lo = np.minimum(xa, xb)[:, :, None, None]
+    hi = np.maximum(xa, xb)[:, :, None, None]
+    u0 = np.maximum(lo, cols)
+    u1 = np.minimum(hi, cols + 1.)
+    width = np.maximum(u1 - u0, 0.)
+
+    # edge height at both ends of that range; vertical edges have no width
+    # so their slope never matters
+    dxe = (xb - xa)[:, :, None, None]
+    slope = np.divide((yb - ya)[:, :, None, None], dxe,
+                      out=np.zeros_like(dxe), where=dxe != 0)
+    ya4 = ya[:, :, None, None]
+    xa4 = xa[:, :, None, None]
+
+    # (P, E, R, C): heights relative to the bottom of each pixel row
+    rows = (r0[:, None] + np.arange(nrows))[:, None, :, None]
+    t0 = ya4 + slope * (u0 - xa4) - rows
+    t1 = ya4 + slope * (u1 - xa4) - rows
+
+    dt = t1 - t0
+    flat = np.abs(dt) < 1e-12
+    mean = np.where(flat, np.clip(0.5 * (t0 + t1), 0., 1.),
+                    (_antiderivative(t1) - _antiderivative(t0))
+                    / np.where(flat, 1., dt))
+    integral = np.sign(dxe) * width * mean
+
+    # shoelace formula gives the orientation of each polygon
+    orient = np.sign(np.sum(xa * yb - xb * ya, axis=1))
+
+    return -orient[:, None, None] * integral.sum(axis=1)
+
+
+def overlap_matrix(polygons, shape, mask=None, max_block=4000000):
+    """
+    Build the sparse overlap matrix for a set of polygons on an image.
+
+    :param polygons: array of shape (ncells, nvertices, 2) of polygon vertices
+                     in pixel coordinates (x, y). Pixel [j, i] of the image
+                     covers x in [i, i+1] and y in [j, j+1].
+    :param shape: shape of the image array, (height, width)
+    :param mask: optional boolean array of the image shape. Pixels where it is
+                 True (bad pixels, stars, the horizon...) get zero weight.
+    :param max_block: rough cap on the number of elements in the temporary
+                      arrays, to bound memory for big grids
+
+    :returns scipy.sparse CSR matrix of shape (ncells, height * width)
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    polygons = np.asarray(polygons, dtype=np.float64)
+    height, width = shape[0], shape[1]
+    ncells, nvert = polygons.shape[0], polygons.shape[1]
+
+    # bounding box of every polygon in whole pixels
+    c0 = np.floor(polygons[:, :, 0].min(axis=1)).astype(np.intp)
+    c1 = np.ceil(polygons[:, :, 0].max(axis=1)).astype(np.intp)
+    r0 = np.floor(polygons[:, :, 1].min(axis=1)).astype(np.intp)
+    r1 = np.ceil(polygons[:, :, 1].max(axis=1)).astype(np.intp)
+    ncols = np.maximum(c1 - c0, 1)
+    nrows = np.maximum(r1 - r0, 1)
+
+    cell_idx = []
+    pix_idx = []
+    weights = []
+
+    # polygons with the same bounding box size are done together, which for a
+    # regular grid means all of them at once
+    keys = np.column_stack((nrows, ncols))
+    for nr, nc in np.unique(keys, axis=0):
+        members = np.nonzero((nrows == nr) & (ncols == nc))[0]
+        step = max(1, max_block // (nvert * nr * nc))
+        for start in range(0, len(members), step):
+            idx = members[start:start + step]
+            w = _group_weights(polygons[idx], c0[idx].astype(np.float64),
+                               r0[idx].astype(np.float64), nc, nr)
+
+            rr = r0[idx][:, None, None] + np.arange(nr)[None, :, None]
+            cc = c0[idx][:, None, None] + np.arange(nc)[None, None, :]
+            keep = (w > 1e-12) & (rr >= 0) & (rr < height) & (cc >= 0) \
+                & (cc < width)
+
+            cell_idx.append(np.broadcast_to(idx[:, None, None],
+                                            w.shape)[keep])
+            pix_idx.append((rr * width + cc)[keep])
+            weights.append(w[keep])
+
+    if cell_idx:
+        cell_idx = np.concatenate(cell_idx)
+        pix_idx = np.concatenate(pix_idx)
+        weights = np.concatenate(weights)
+
+    matrix = sparse.csr_matrix((weights, (cell_idx, pix_idx)),
+                               shape=(ncells, height * width))
+
+    if mask is not None:
+        keep = ~np.asarray(mask, dtype=bool).ravel()
+        matrix = matrix.multiply(keep[None, :].astype(np.float64)).tocsr()
+        matrix.eliminate_zeros()
+
+    return matrix
+
+
+def get_overlap_matrix(polygons, shape, mask=None):
+    """
+    Cached version of overlap_matrix: the matrix for a given image shape,
+    set of polygons and mask is only built once per process.
+    """
+
+    import hashlib
+    import numpy as np
+
+    polygons = np.ascontiguousarray(polygons, dtype=np.float64)
+    key = [tuple(shape[:2]), polygons.shape,
+           hashlib.sha1(polygons.tobytes()).hexdigest()]
+    if mask is not None:
+        mask = np.ascontiguousarray(mask, dtype=bool)
+        key.append(hashlib.sha1(mask.tobytes()).hexdigest())
+    key = tuple(key)
+
+    if key not in _matrix_cache:
+        _matrix_cache[key] = overlap_matrix(polygons, shape, mask=mask)
+
+    return _matrix_cache[key]
+
+
+def cell_areas(matrix):
+    """
+    :param matrix: overlap matrix from overlap_matrix
+
+    :returns the area in pixels of each cell that falls on (unmasked) pixels
+    """
+
+    import numpy as np
+
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def apply_weights(matrix, frames):
+    """
+    Cell sums for a whole stack of frames with one sparse-dense product.
+
+    :param matrix: overlap matrix from overlap_matrix
+    :param frames: a single 2D image or a stack of shape (nframes, height,
+                   width)
+
+    :returns float64 array of shape (nframes, ncells), or (ncells,) for a
+             single image
+    """
+
+    import numpy as np
+
+    frames = np.asarray(frames)
+    single = frames.ndim == 2
+    stack = frames.reshape(1 if single else frames.shape[0], -1)
+
+    # scipy upcasts to the matrix dtype on the fly, so integer or float32
+    # frames don't need a float64 copy first
+    sums = np.asarray(matrix.dot(stack.T).T, dtype=np.float64)
+
+    return sums[0] if single else sums
+
+
+def batch_polygon_photometry(frames, polygons, skyvals, sigmas, itimes=None,
+                             skyerrs=None, mask=None, zmag=25.0):
+    """
+    Polygon photometry for a stack of frames taken with the same camera.
+
+    :param frames: array of shape (nframes, height, width)
+    :param polygons: array of shape (ncells, nvertices, 2), e.g. from
+                     rect_grid_polygons or rotate_polygons
+    :param skyvals: sky value per pixel for each frame
+    :param sigmas: sky sigma for each frame
+    :param itimes: exposure time for each frame (default 1 s)
+    :param skyerrs: error in the sky value for each frame (optional)
+    :param mask: optional boolean array of bad pixels, see overlap_matrix
+    :param zmag: zero point of the magnitude scale
+
+    :returns list with one results dictionary per frame, see
+             grid_photometry.cell_photometry
+    """
+
+    from grid_photometry import cell_photometry
+
+    matrix = get_overlap_matrix(polygons, frames.shape[1:], mask=mask)
+    areas = cell_areas(matrix)
+    sums = apply_weights(matrix, frames)
+
+    nframes = sums.shape[0]
+    if itimes is None:
+        itimes = [1.0] * nframes
+    if skyerrs is None:
+        skyerrs = [None] * nframes
+
+    return [cell_photometry(sums[k], areas, skyvals[k], sigmas[k],
+                            itime=itimes[k], zmag=zmag, skyerr=skyerrs[k])
+            for k in range(nframes)]
@@ -34,30 +34,55 @@ def prepare_params():
                        'the default path)\n'
                        'Your choice: ')
 
+    while choice not in ('1', '2'):
+        choice = raw_input('Please enter either 1 or 2:\n'
+                           '[1]: Enter full path to the file\n'
+                           '[2]: Enter just the working directory name ('
+                           'use the default path)\n\n')
+
     if choice == '1':
         param_file = raw_input('Please input path: ')
-    elif choice == '2':
+    else:
         d = raw_input('Please input directory name with spaces, slashes '
                       'allowed: ')
         param_file = default.format(d)
-    else:
-        while choice != 1 or choice != 2:
-            choice = raw_input('Please enter either 1 or 2:\n'
-                               '[1]: Enter full path to the file\n'
-                               '[2]: Enter just the working directory name ('
-                               'use the default path)\n\n')
+
+    return read_params(param_file)
+
+
+def read_params(param_file):
+    """
+    Non-interactive part of prepare_params: reads the image parameters out
+    of param_file and generates the logfile names.
+
+    :param param_file: path to a files_and_params.txt style file, or to a
+                       session catalog ('.db' or '.sqlite', see catalog.py)
+
+    :returns list of [IMAGE, SKYVAL, SIGMA, SKYVAL ERR, EXPOSURE, FILTER 1,
+             FILTER 2, PATH] lists (all strings) and the list of logfile
+             names for the photometry output.
+    """
+
+    from catalog import is_catalog
 
     # Read in the param_file and put values in a list. value order is:
     # IMAGE  SKYVAL  SIGMA  SKYVAL ERR  EXPOSURE  FILTER 1  FILTER 2  PATH
     image_data = []
 
-    with open(param_file, 'r') as f:
-        throwaway = f.readline()  # skip the first line which is a comment
-        for line in f:
-            ln = line.split()
-            if ln:
-                image_data.append([ln[0], ln[1], ln[2], ln[3], ln[4], ln[5],
-                                   ln[6], ln[7]])
+    if is_catalog(param_file):
+        from catalog import connect, image_data as catalog_images
+
+        conn = connect(param_file)
+        image_data = catalog_images(conn)
+        conn.close()
+    else:
+        with open(param_file, 'r') as f:
+            throwaway = f.readline()  # skip the first line which is a comment
+            for line in f:
+                ln = line.split()
+                if ln:
+                    image_data.append([ln[0], ln[1], ln[2], ln[3], ln[4],
+                                       ln[5], ln[6], ln[7]])
 
     # Generate some logfile names for photometry output
     logs = ['{}_photometry'.format(x[0][:-4]) for x in image_data]
@@ -65,19 +90,133 @@ def prepare_params():
     return image_data, logs
 
 
-def do_photometry():
+def parse_gsize(gsize):
+    """
+    :param gsize: grid size string as used in the grid file names, e.g. '10x10'
+
+    :returns the number of cells in x and y as integers
+    """
+
+    nx, ny = gsize.lower().split('x')
+    return int(nx), int(ny)
+
+
+def _open_store(store):
+    """
+    :param store: path of a photometry store, or None
+
+    :returns a photometry_store.StoreWriter for the path, or None
+    """
+
+    if store is None:
+        return None
+
+    from photometry_store import StoreWriter
+    return StoreWriter(store)
+
+
+def _phot_params(image, gsize, calibration=None):
+    """
+    Parameters a photometry result depends on, as recorded in the manifest.
+    """
+
+    params = {'gsize': gsize, 'skyval': float(image[1]),
+              'sigma': float(image[2]), 'skyerr': float(image[3]),
+              'exposure': float(image[4])}
+    if calibration is not None:
+        params['calibration'] = calibration.fingerprint(image[7] + image[0],
+                                                        float(image[4]))
+
+    return params
+
+
+def _reusable(manifest, image, gsizes, lognames, save, calibration=None,
+              stage='photometry', suffix='.npz'):
+    """
+    :param manifest: manifest.Manifest of the session, or None
+    :param image: one entry of the image_data list
+    :param gsizes: grid size strings the image is to be measured on
+    :param lognames: the matching log names
+    :param save: whether results are saved next to the images
+    :param calibration: calibration.Calibration the image is measured with
+    :param stage: manifest stage of the results, '<stage> <gsize>'
+    :param suffix: what the result files add to the log names; '' for the
+                   polyphot logs themselves
+
+    :returns list of the '.npz' files (or logs) holding up to date results
+             of the image for every grid size, or None if it has to be
+             measured
+    """
+
+    import os
+
+    if manifest is None or not save:
+        return None
+
+    npzs = []
+    for gsize, logname in zip(gsizes, lognames):
+        npz = image[7] + logname + suffix
+        if not os.path.exists(npz) or not manifest.is_done(
+                stage + ' ' + gsize, image[7] + image[0],
+                _phot_params(image, gsize, calibration)):
+            return None
+        npzs.append(npz)
+
+    return npzs
+
+
+def _job_frame(job):
+    """
+    :returns the FITS file a photometry job works on
+    """
+
+    return job[0][7] + job[0][0]
+
+
+def _run_or_reuse(worker, jobs, reused, processes, max_pending):
+    """
+    Runs worker on the jobs that have no reusable results and yields
+    (job, ok, value, reused) for every job in order. For reused jobs reused
+    is True and value is the list of results loaded back from their '.npz'
+    files.
+    """
+
+    import numpy as np
+    from parallel import parallel_map
+
+    computed = parallel_map(worker, (job for job, npzs in zip(jobs, reused)
+                                     if npzs is None),
+                            processes=processes, max_pending=max_pending,
+                            frame_path=_job_frame)
+    for job, npzs in zip(jobs, reused):
+        if npzs is None:
+            job, ok, value = next(computed)
+            yield job, ok, value, False
+        else:
+            yield job, True, [dict(np.load(npz)) for npz in npzs], True
+
+
+def do_photometry(manifest=None):
     """
     Do photometry in batch mode.
     Script will prompt for the locations of the grid files and the location
-    of the parameter file.
+    of the parameter file. For unattended runs see pipeline.py.
+
+    :param manifest: optional manifest.Manifest of the session. Images
+                     whose log is there and was made from the same file
+                     contents, sky, sigma and exposure are not run again.
 
     Output:
     Files for each image with extension '_photometry' and data inside,
     which are placed in the same directory as their parent image.
     """
 
-    from pyraf import iraf
-    from os import walk
+    import os
+    from instrument import stage
+
+    # starting IRAF takes seconds; timed on its own, see instrument.py
+    with stage('iraf_startup'):
+        from pyraf import iraf
 
     # Retrieves image parameters from a stored file ----------------------------
     image_data, lognames = prepare_params()
@@ -88,17 +227,17 @@ def do_photometry():
 
     print('Default path for coordinate and polygon files: \n{}'.format(default))
     use_default = raw_input('Use base path? (y/n): ')
+    while use_default not in ('y', 'n'):
+        use_default = raw_input('Please enter y or n: ')
+
     if use_default == 'n':
         path = raw_input('Enter new path to coordinate and polygon files: ')
-    elif use_default == 'y':
-        path = default
     else:
-        while use_default != 'n' or use_default != 'y':
-            use_default = raw_input('Please enter y or n: ')
+        path = default
 
     print('Available grid files: ')
 
-    for (dirpath, dirnames, gfile) in walk(path):
+    for (dirpath, dirnames, gfile) in os.walk(path):
         print(gfile)
 
     gsize = raw_input('Enter the grid size to use (ex: 10x10): ')
@@ -111,10 +250,26 @@ def do_photometry():
     coordfile = gsize + 'grid_centers.txt'
     polygonfile = gsize + 'grid_polygons.txt'
 
+    # grid files that aren't there yet are written from the grid itself
+    if not (os.path.exists(path+coordfile) and
+            os.path.exists(path+polygonfile)):
+        from inventory import read_fits_header
+        from make_grid import get_grid
+        header = read_fits_header(image_data[0][7] + image_data[0][0])
+        nx, ny = parse_gsize(gsize)
+        print('Writing the grid files for {} to {}'.format(gsize, path))
+        get_grid(nx, ny, (header['NAXIS1'], header['NAXIS2'])).write_files(
+            path)
+
     # Loops through images and call polyphot for each --------------------------
     print('\nNow doing photometry. Please wait...\n')
 
     for image, logname in zip(image_data, lognames):
+        if _reusable(manifest, image, [gsize], [logname], True,
+                     stage='polyphot', suffix='') is not None:
+            print('Already done: {}'.format(image[0]))
+            continue
+
         filename = image[0]
         sky = image[1]
         sig = image[2]
@@ -135,12 +290,383 @@ def do_photometry():
         dumb.close()
 
         # call the task, then write the error to the logfile at the end.
-        iraf.polyphot(im_path+filename, coords=path+coordfile,
-                      output=im_path+logname, polygons=path+polygonfile,
-                      interactive='no', skyvalue=sky, sigma=sig, itime=exp,
-                      ifilter=', '.join([filter1, filter2]),
-                      verify='no')
+        with stage('polyphot', im_path+filename):
+            iraf.polyphot(im_path+filename, coords=path+coordfile,
+                          output=im_path+logname, polygons=path+polygonfile,
+                          interactive='no', skyvalue=sky, sigma=sig,
+                          itime=exp, ifilter=', '.join([filter1, filter2]),
+                          verify='no')
+        if manifest is not None:
+            manifest.mark_done('polyphot ' + gsize, im_path+filename,
+                               _phot_params(image, gsize))
+
+    if manifest is not None:
+        manifest.save()
 
     print('Photometry complete!')
 
     return None
+
+
+def photometer_image(image, nx, ny, zmag=25.0, calibration=None, cache=None):
+    """
+    Native replacement for a single iraf.polyphot call.
+
+    :param image: one entry of the image_data list returned by read_params
+    :param nx: number of grid cells in the x direction
+    :param ny: number of grid cells in the y direction
+    :param zmag: zero point of the magnitude scale
+    :param calibration: optional calibration.Calibration whose bias and dark
+                        are subtracted from the frame in memory first. The
+                        sky values should then be measured on calibrated
+                        frames too (see sky_estimate.auto_skystats).
+    :param cache: optional result_cache.ResultCache. An image measured before
+                  with the same grid, sky, sigma, exposure and calibration is
+                  loaded from it instead.
+
+    :returns dictionary of per-cell photometry arrays, see
+             grid_photometry.grid_photometry
+    """
+
+    from frames import get_frame
+    from grid_photometry import grid_photometry
+
+    filename, sky, sig, err, exp = image[:5]
+    im_path = image[7]
+
+    if cache is not None:
+        params = _phot_params(image, '{}x{}'.format(nx, ny), calibration)
+        if zmag != 25.0:
+            params['zmag'] = zmag
+        return cache.memoize('photometry', im_path + filename, params,
+                             photometer_image, image, nx, ny, zmag=zmag,
+                             calibration=calibration)
+
+    data = get_frame(im_path + filename)
+    if calibration is not None:
+        data = calibration.apply(data, im_path + filename, float(exp))
+
+    return grid_photometry(data, nx, ny, float(sky), float(sig),
+                           itime=float(exp), zmag=zmag, skyerr=float(err))
+
+
+def do_native_photometry(param_file, gsize, save=True, store=None,
+                         manifest=None, calibration=None, cache=None):
+    """
+    Do photometry in batch mode without PyRAF. Every cell of the grid is
+    summed straight from the FITS array in one vectorized pass, using the
+    sky, sigma and exposure stored in the parameter file.
+
+    :param param_file: path to the files_and_params.txt file
+    :param gsize: grid size string, e.g. '64x64'
+    :param save: if True, write the results for each image to
+                 '<log>.npz' in the same directory as the image
+    :param store: optional path of a photometry store (see
+                  photometry_store) to write all results of the run to
+    :param manifest: optional manifest.Manifest of the session. Images whose
+                     results are saved and up to date are loaded instead of
+                     measured again. Needs save=True.
+    :param calibration: optional calibration.Calibration to apply to every
+                        frame, see photometer_image
+    :param cache: optional result_cache.ResultCache, see photometer_image
+
+    Output:
+    List of (image name, results dictionary) tuples in parameter file order.
+    """
+
+    import numpy as np
+    from frames import prefetch
+    from photometry_store import image_meta
+
+    image_data, lognames = read_params(param_file)
+    nx, ny = parse_gsize(gsize)
+
+    # adjust lognames if grid size is not 10x10 to avoid overwriting files
+    if gsize != '10x10':
+        lognames = [i+'_'+gsize for i in lognames]
+
+    reused = [_reusable(manifest, image, [gsize], [logname], save,
+                        calibration)
+              for image, logname in zip(image_data, lognames)]
+
+    # the next few images are read from disk while one is being measured
+    ahead = prefetch([image for image, npzs in zip(image_data, reused)
+                      if npzs is None], path=lambda image: image[7] + image[0])
+
+    writer = _open_store(store)
+
+    print('\nNow doing photometry. Please wait...\n')
+
+    results = []
+    try:
+        for image, logname, npzs in zip(image_data, lognames, reused):
+            if npzs is not None:
+                phot = dict(np.load(npzs[0]))
+            else:
+                print('Processing image {}'.format(image[0]))
+                next(ahead)
+                phot = photometer_image(image, nx, ny,
+                                        calibration=calibration, cache=cache)
+                if save:
+                    np.savez(image[7] + logname + '.npz', **phot)
+                if manifest is not None:
+                    manifest.mark_done('photometry ' + gsize,
+                                       image[7] + image[0],
+                                       _phot_params(image, gsize, calibration))
+            if writer is not None:
+                writer.add(image_meta(image), nx, ny, phot)
+            results.append((image[0], phot))
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    else:
+        if writer is not None:
+            writer.close()
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if cache is not None:
+            cache.save()
+
+    print('Photometry complete!')
+
+    return results
+
+
+def _photometer_job(job):
+    """
+    Worker for do_parallel_photometry. job is (image, logname, nx, ny, save,
+    calibration, cache). Lives at module level so it can be sent to worker
+    processes.
+    """
+
+    import numpy as np
+
+    image, logname, nx, ny, save, calibration, cache = job
+    phot = photometer_image(image, nx, ny, calibration=calibration,
+                            cache=cache)
+    if save:
+        np.savez(image[7] + logname + '.npz', **phot)
+
+    return phot
+
+
+def do_parallel_photometry(param_file, gsize, processes=None,
+                           max_pending=None, save=True, store=None,
+                           manifest=None, calibration=None, cache=None):
+    """
+    Same as do_native_photometry, but the images are spread over a pool of
+    worker processes. A failure on one image is reported and the run carries
+    on with the rest.
+
+    :param param_file: path to the files_and_params.txt file
+    :param gsize: grid size string, e.g. '64x64'
+    :param processes: number of worker processes, defaults to the CPU count
+    :param max_pending: most images in flight at once, defaults to twice the
+                        number of processes
+    :param save: if True, write '<log>.npz' next to each image
+    :param store: optional path of a photometry store to write all results
+                  of the run to. Written from this process, in order.
+    :param manifest: optional manifest.Manifest of the session, see
+                     do_native_photometry
+    :param calibration: optional calibration.Calibration to apply to every
+                        frame, see photometer_image
+    :param cache: optional result_cache.ResultCache, see photometer_image
+
+    Output:
+    List of (image name, results dictionary) tuples in parameter file order,
+    and a list of (image name, error message) tuples for images that failed.
+    """
+
+    from photometry_store import image_meta
+
+    image_data, lognames = read_params(param_file)
+    nx, ny = parse_gsize(gsize)
+
+    # adjust lognames if grid size is not 10x10 to avoid overwriting files
+    if gsize != '10x10':
+        lognames = [i+'_'+gsize for i in lognames]
+
+    print('\nNow doing photometry. Please wait...\n')
+
+    jobs = [(image, logname, nx, ny, save, calibration, cache)
+            for image, logname in zip(image_data, lognames)]
+    reused = [_reusable(manifest, image, [gsize], [logname], save,
+                        calibration)
+              for image, logname in zip(image_data, lognames)]
+
+    writer = _open_store(store)
+
+    results = []
+    failed = []
+    try:
+        for job, ok, value, loaded in _run_or_reuse(
+                _photometer_job, jobs, reused, processes, max_pending):
+            filename = job[0][0]
+            if ok:
+                if loaded:
+                    value = value[0]
+                elif manifest is not None:
+                    manifest.mark_done('photometry ' + gsize,
+                                       job[0][7] + filename,
+                                       _phot_params(job[0], gsize,
+                                                    calibration))
+                if writer is not None:
+                    writer.add(image_meta(job[0]), nx, ny, value)
+                results.append((filename, value))
+            else:
+                print('Photometry failed for image {}:\n{}'.format(
+                    filename, value))
+                failed.append((filename, value))
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    else:
+        if writer is not None:
+            writer.close()
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if cache is not None:
+            cache.save()
+
+    print('Photometry complete! {} images done, {} failed'.format(
+        len(results), len(failed)))
+
+    return results, failed
+
+
+def _multigrid_job(job):
+    """
+    Worker for do_multigrid_photometry. job is (image, lognames, sizes, save,
+    calibration, cache) where lognames holds one logfile name per grid
+    size. With a cache only the grid sizes not measured before are measured.
+    """
+
+    import numpy as np
+    from frames import get_frame
+    from grid_photometry import multi_grid_photometry
+
+    image, lognames, sizes, save, calibration, cache = job
+    filename, sky, sig, err, exp = image[:5]
+    im_path = image[7]
+
+    results = {}
+    if cache is not None:
+        for size in sizes:
+            phot = cache.get('photometry', im_path + filename,
+                             _phot_params(image, '{}x{}'.format(*size),
+                                          calibration))
+            if phot is not None:
+                results[size] = phot
+
+    missing = [size for size in sizes if size not in results]
+    if missing:
+        data = get_frame(im_path + filename)
+        if calibration is not None:
+            data = calibration.apply(data, im_path + filename, float(exp))
+        measured = multi_grid_photometry(data, missing, float(sky),
+                                         float(sig), itime=float(exp),
+                                         skyerr=float(err))
+        if cache is not None:
+            for size in missing:
+                cache.put('photometry', im_path + filename,
+                          _phot_params(image, '{}x{}'.format(*size),
+                                       calibration), measured[size])
+        results.update(measured)
+
+    if save:
+        for size, logname in zip(sizes, lognames):
+            np.savez(im_path + logname + '.npz', **results[size])
+
+    return results
+
+
+def do_multigrid_photometry(param_file, gsizes, processes=1,
+                            max_pending=None, save=True, store=None,
+                            manifest=None, calibration=None, cache=None):
+    """
+    Photometry for several grid sizes at once. Each image is read once and
+    turned into a summed-area table, from which the cell sums of every
+    requested grid are looked up.
+
+    :param param_file: path to the files_and_params.txt file
+    :param gsizes: list of grid size strings, e.g. ['10x10', '64x64']
+    :param processes: number of worker processes (1 = run in this process)
+    :param max_pending: most images in flight at once
+    :param save: if True, write '<log>.npz' next to each image for each grid
+                 size, named the same way as do_native_photometry
+    :param store: optional path of a photometry store to write all results
+                  of the run to, every grid size in the same store
+    :param manifest: optional manifest.Manifest of the session. An image is
+                     only skipped if it is up to date for every grid size.
+    :param calibration: optional calibration.Calibration to apply to every
+                        frame, see photometer_image
+    :param cache: optional result_cache.ResultCache, see photometer_image
+
+    Output:
+    List of (image name, {gsize: results dictionary}) tuples in parameter
+    file order, and a list of (image name, error message) tuples for images
+    that failed.
+    """
+
+    from photometry_store import image_meta
+
+    image_data, lognames = read_params(param_file)
+    sizes = [parse_gsize(g) for g in gsizes]
+
+    jobs = [(image, [log if g == '10x10' else log + '_' + g for g in gsizes],
+             sizes, save, calibration, cache)
+            for image, log in zip(image_data, lognames)]
+    reused = [_reusable(manifest, job[0], gsizes, job[1], save, calibration)
+              for job in jobs]
+
+    print('\nNow doing photometry for grid sizes {}. Please '
+          'wait...\n'.format(', '.join(gsizes)))
+
+    writer = _open_store(store)
+
+    results = []
+    failed = []
+    try:
+        for job, ok, value, loaded in _run_or_reuse(
+                _multigrid_job, jobs, reused, processes, max_pending):
+            filename = job[0][0]
+            if ok:
+                if loaded:
+                    value = dict(zip(sizes, value))
+                elif manifest is not None:
+                    for g in gsizes:
+                        manifest.mark_done('photometry ' + g,
+                                           job[0][7] + filename,
+                                           _phot_params(job[0], g,
+                                                        calibration))
+                if writer is not None:
+                    for size in sizes:
+                        writer.add(image_meta(job[0]), size[0], size[1],
+                                   value[size])
+                results.append((filename, dict((g, value[size]) for g, size
+                                               in zip(gsizes, sizes))))
+            else:
+                print('Photometry failed for image {}:\n{}'.format(
+                    filename, value))
+                failed.append((filename, value))
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    else:
+        if writer is not None:
+            writer.close()
+    finally:
+        if manifest is not None:
+            manifest.save()
+        if cache is not None:
+            cache.save()
+
+    print('Photometry complete! {} images done, {} failed'.format(
+        len(results), len(failed)))
+
+    return results, failed
@@ -0,0 +1,211 @@
+# ============================================================================ #
+# Reader for the text logs written by iraf.polyphot. The header is used to
+# work out the layout of a record, then all records are pulled into NumPy
+# arrays in a single pass over the file, no temporary files or line counting.
+# ============================================================================ #
+
+
+def _header_groups(header):
+    """
+    :param header: list of the '#' lines at the top of a polyphot log (bytes)
+
+    :returns list of lists of column names, one list per line of a record, in
+             the order they appear. The last group is the vertex line, which
+             is repeated NVERTICES times in each record.
+    """
+
+    groups = []
+    for line in header:
+        if line.startswith(b'#N'):
+            names = line[2:].replace(b'\\', b' ').split()
+            groups.append([n.decode().lower() for n in names])
+
+    return groups
+
+
+def _columns(lines, ncols):
+    """
+    Split a list of record lines into a (nlines, ncols) array of byte
+    strings, or return None if the lines don't all have ncols tokens (which
+    happens for string fields with spaces in them, like IFILTER).
+    """
+
+    import numpy as np
+
+    tokens = b' '.join(lines).replace(b'\\', b' ').split()
+    if len(tokens) != len(lines) * ncols:
+        return None
+
+    return np.array(tokens).reshape(len(lines), ncols)
+
+
+def _to_float(column):
+    """
+    Converts a column of byte strings to float64, with INDEF as nan.
+    """
+
+    import numpy as np
+
+    column = np.where(column == b'INDEF', b'nan', column)
+    return column.astype(np.float64)
+
+
+def read_polyphot(path, columns=None, cache=None, vertices=True):
+    """
+    Parse a polyphot output file.
+
+    :param path: path to the polyphot log (e.g. '<image>_photometry_64x64')
+    :param columns: optional list of lowercase column names to keep. Record
+                    lines holding none of them are not parsed at all, which
+                    roughly halves the time for big grids.
+    :param cache: optional result_cache.ResultCache. A log that was parsed
+                  before (same contents, same columns) is loaded from it.
+    :param vertices: if False the polygon vertices are not parsed; for grids
+                     made by make_grid they are the vertices of its Grid.
+
+    :returns dictionary with one entry per column in the log, keyed by the
+             lowercase IRAF column name (sum, area, flux, mag, merr, msky,
+             stdev, itime, xcenter, ...). Numeric columns are float64 arrays
+             with INDEF as nan, text columns (image, ifilter, perror, ...)
+             are arrays of str. The polygon vertices are collected into
+             'vertices', an array of shape (ncells, nvertices, 2), unless
+             vertices is False.
+    """
+
+    from instrument import stage
+
+    if cache is not None:
+        params = {'columns': sorted(columns) if columns else None}
+        if not vertices:
+            params['vertices'] = False
+        return cache.memoize('polyphot', path, params, read_polyphot, path,
+                             columns, vertices=vertices)
+
+    with stage('read_polyphot', path):
+        return _parse_polyphot(path, columns, vertices)
+
+
+def _parse_polyphot(path, columns=None, vertices=True):
+    """
+    read_polyphot without the cache.
+    """
+
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        lines = f.read().splitlines()
+
+    # header length is however many comment lines there are
+    nheader = 0
+    while nheader < len(lines) and lines[nheader].startswith(b'#'):
+        nheader += 1
+    groups = _header_groups(lines[:nheader])
+    body = lines[nheader:]
+    while body and not body[-1].strip():
+        body.pop()
+
+    if not groups:
+        raise ValueError('{} does not look like a polyphot log: no column '
+                         'names in its header'.format(path))
+
+    vertex_group = groups[-1]
+    fixed = groups[:-1]
+
+    # number of vertices is given in the first record, and fixes the number
+    # of lines per record for the whole file (all cells in a grid have the
+    # same shape)
+    nvertices = 0
+    if body:
+        for g, names in enumerate(fixed):
+            if 'nvertices' in names:
+                first = body[g].replace(b'\\', b' ').split()
+                nvertices = int(first[names.index('nvertices')])
+    reclen = len(fixed) + nvertices
+
+    if body and (len(body) % reclen or body[reclen - 1].endswith(b'\\')):
+        raise ValueError('{}: records are not all {} lines long; mixed '
+                         'polygon shapes are not supported'.format(path,
+                                                                   reclen))
+    nrec = len(body) // reclen
+
+    results = {}
+    for g, names in enumerate(fixed):
+        if columns is not None and not set(names) & set(columns):
+            continue
+
+        group_lines = body[g::reclen]
+        table = _columns(group_lines, len(names))
+
+        if table is None:
+            # some text field has spaces in it. Numeric fields never do, so
+            # take those from either end and give the rest to the text field
+            t = names.index(_text_field(names))
+            n_after = len(names) - t - 1
+            rows = [ln.replace(b'\\', b' ').split() for ln in group_lines]
+            rows = [r[:t] + [b' '.join(r[t:len(r) - n_after])]
+                    + r[len(r) - n_after:] for r in rows]
+            table = np.array(rows)
+
+        for k, name in enumerate(names):
+            if columns is None or name in columns:
+                results[name] = _convert(table[:, k])
+
+    if not vertices:
+        return results
+
+    # vertex lines: nvertices per record, xvertex and yvertex in each
+    corners = np.zeros((nrec, nvertices, 2))
+    for v in range(nvertices):
+        vtable = _columns(body[len(fixed) + v::reclen], len(vertex_group))
+        corners[:, v] = _to_float(vtable[:, :2])
+    results['vertices'] = corners
+
+    return results
+
+
+def _text_field(names):
+    """
+    The one column of a record line that may contain spaces.
+    """
+
+    for name in ('ifilter', 'image', 'coords', 'polygons', 'otime'):
+        if name in names:
+            return name
+
+    return names[0]
+
+
+def _convert(column):
+    """
+    Turn a column of byte strings into floats if every entry is a number (or
+    INDEF), otherwise into str.
+    """
+
+    try:
+        return _to_float(column)
+    except ValueError:
+        return column.astype(str)
+
+
+def polyphot_dataframe(results):
+    """
+    :param results: dictionary returned by read_polyphot
+
+    :returns pandas DataFrame with the columns the summary scripts use:
+             Counts, Area(pixels), Flux, Mag, MERR and one column per vertex
+             (v1, v2, ...) holding [x, y] pairs
+    """
+
+    from pandas import DataFrame
+
+    df = DataFrame({'Counts': results['sum'],
+                    'Area(pixels)': results['area'],
+                    'Flux': results['flux'],
+                    'Mag': results['mag'],
+                    'MERR': results['merr']})
+
+    vertices = results['vertices']
+    for v in range(vertices.shape[1]):
+        df['v{}'.format(v + 1)] = list(vertices[:, v])
+
+    return df
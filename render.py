@@ -0,0 +1,156 @@
+# ============================================================================ #
+# Headless rendering of detection grids over their images, for quality checks
+# of a whole night. Figures are drawn with the Agg canvas directly (no pyplot
+# and no display needed), the image is block averaged down before it is
+# drawn, all the detected cells go in as one LineCollection, and the PNGs are
+# written from a pool of worker processes.
+# ============================================================================ #
+
+
+def downsample(data, factor):
+    """
+    Block average an image. Rows and columns that don't fill a whole block
+    at the far edges are dropped.
+
+    :param data: 2D image array
+    :param factor: side of the blocks in pixels
+
+    :returns float32 array of shape (height // factor, width // factor)
+    """
+
+    import numpy as np
+
+    if factor <= 1:
+        return np.asarray(data, dtype=np.float32)
+
+    h = data.shape[0] // factor
+    w = data.shape[1] // factor
+    blocks = data[:h * factor, :w * factor].reshape(h, factor, w, factor)
+
+    return blocks.mean(axis=(1, 3), dtype=np.float64).astype(np.float32)
+
+
+def closed_outlines(vertices):
+    """
+    :param vertices: array of shape (ncells, nvertices, 2)
+
+    :returns array of shape (ncells, nvertices + 1, 2) with the first vertex
+             of every cell repeated at the end, so the outlines close
+    """
+
+    import numpy as np
+
+    vertices = np.asarray(vertices, dtype=np.float64)
+
+    return np.concatenate([vertices, vertices[:, :1]], axis=1)
+
+
+def render_overlay(data, vertices, filename, title=None, max_size=1024,
+                   color='purple', dpi=100):
+    """
+    Draw cell outlines over an image and save it as a PNG.
+
+    :param data: 2D image array
+    :param vertices: array of shape (ncells, nvertices, 2) of the cells to
+                     outline, in pixel coordinates where pixel (i, j) covers
+                     [i, i + 1) x [j, j + 1)
+    :param filename: PNG file to write
+    :param title: optional text written in the top left corner
+    :param max_size: the image is block averaged until its longest side is
+                     at most this many pixels
+    :param color: color of the outlines
+    :param dpi: resolution of the figure. The PNG has one pixel per pixel of
+                the downsampled image.
+    """
+
+    import numpy as np
+    from matplotlib.collections import LineCollection
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from instrument import stage
+
+    with stage('draw', filename):
+        factor = max(1, int(np.ceil(max(data.shape) / float(max_size))))
+        small = downsample(data, factor)
+        h, w = small.shape
+
+        fig = Figure(figsize=(w / float(dpi), h / float(dpi)), dpi=dpi)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.imshow(small, cmap='gray', extent=(0, w * factor, h * factor, 0),
+                  interpolation='nearest')
+        ax.set_autoscale_on(False)
+        if len(vertices):
+            ax.add_collection(LineCollection(closed_outlines(vertices),
+                                             colors=color, linewidths=0.8))
+        if title is not None:
+            ax.text(0.01, 0.99, title, transform=ax.transAxes, color='white',
+                    va='top', fontsize=10)
+        ax.set_axis_off()
+
+        fig.savefig(filename, dpi=dpi)
+
+
+def _render_job(job):
+    """
+    Worker for render_store: draw the detected cells of one image.
+    """
+
+    from frames import get_frame
+
+    filename, image, outlines, title, max_size = job
+    render_overlay(get_frame(image), outlines, filename, title=title,
+                   max_size=max_size)
+
+    return filename
+
+
+def render_store(store, grid, nsigma=3.0, processes=None, max_size=1024,
+                 **selection):
+    """
+    Write a QA image of the detected cells of every image in a photometry
+    store, '<image>_detect_<grid>.png' next to each image.
+
+    :param store: photometry store written by the batch photometry stage
+    :param grid: grid size string, e.g. '64x64'
+    :param nsigma: detection level, see detection.detection_threshold
+    :param processes: number of worker processes, defaults to the number of
+                      CPUs
+    :param max_size: longest side of the PNGs in pixels, see render_overlay
+    :param selection: image selections of photometry_store.read_store
+
+    :returns list of the PNG files written
+    """
+
+    from detection import detect_store
+    from inventory import read_fits_header
+    from make_grid import get_grid
+    from parallel import parallel_map
+    from polyphot_batch import parse_gsize
+
+    nx, ny = parse_gsize(grid)
+    summary, snr_maps = detect_store(store, grid, nsigma=nsigma, maps=None,
+                                     **selection)
+
+    def jobs():
+        for row in summary:
+            path, image = str(row['path']), str(row['image'])
+            header = read_fits_header(path + image)
+            outlines = get_grid(nx, ny, (header['NAXIS1'],
+                                         header['NAXIS2'])).vertices
+            detected = snr_maps[(path, image)].ravel() >= nsigma
+            title = '{}  {}  max SNR {:.1f}'.format(image, grid,
+                                                    row['max_snr'])
+            yield ('{}{}_detect_{}.png'.format(path, image[:-4], grid),
+                   path + image, outlines[detected], title, max_size)
+
+    written = []
+    for job, ok, value in parallel_map(_render_job, jobs(),
+                                       processes=processes,
+                                       frame_path=lambda job: job[1]):
+        if not ok:
+            print('Could not render {}:\n{}'.format(job[1], value))
+            continue
+        written.append(value)
+
+    return written
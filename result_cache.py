@@ -0,0 +1,229 @@
+# ============================================================================ #
+# Persistent cache of stage results. A result is stored as a small '.npz'
+# keyed by the content hash of its input file (a frame or a polyphot log),
+# the name of the stage and the parameters it was run with, so any earlier
+# combination of image, grid size, sky and sigma is loaded instead of being
+# measured again. The cache is bounded in size; the least recently used
+# results are evicted first.
+# ============================================================================ #
+
+RESULT_CACHE_DIR = 'result_cache'
+DEFAULT_RESULT_BYTES = 1024 * 2 ** 20
+HASHES_NAME = 'hashes.json'
+
+
+def _pack(result):
+    """
+    :returns the values of a result dictionary as arrays, for np.savez
+    """
+
+    import numpy as np
+
+    return dict((k, np.asarray(v)) for k, v in result.items())
+
+
+def _unpack(npz):
+    """
+    :returns the result dictionary stored in an '.npz'. Values stored from
+             plain numbers or strings come back as them.
+    """
+
+    return dict((k, npz[k].item() if npz[k].ndim == 0 else npz[k])
+                for k in npz.files)
+
+
+class ResultCache(object):
+    """
+    Disk-backed cache of stage results with a size cap and least recently
+    used eviction.
+
+    Results are dictionaries of arrays and numbers, e.g. the photometry of
+    grid_photometry or the sky of sky_estimate.estimate_sky. Input files are
+    identified by their contents, so a file that is copied or moved keeps its
+    results and one that changes loses them. The content hashes are kept
+    next to the results (see manifest.Manifest.fingerprint).
+
+    Can be sent to worker processes; each counts its own hits and misses.
+
+    :param directory: directory the results are kept in
+    :param max_bytes: most bytes of results to keep
+    """
+
+    def __init__(self, directory=RESULT_CACHE_DIR,
+                 max_bytes=DEFAULT_RESULT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._setup()
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.directory = state['directory']
+        self.max_bytes = state['max_bytes']
+        self._setup()
+
+    def _setup(self):
+        import os
+        from manifest import Manifest
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hashes = Manifest(os.path.join(self.directory, HASHES_NAME))
+        self.nbytes = sum(size for path, mtime, size in self._entries())
+
+    def _entries(self):
+        """
+        :returns list of (file, last use, size) of every stored result
+        """
+
+        import os
+
+        entries = []
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.npz'):
+                    st = entry.stat()
+                    entries.append((entry.path, st.st_mtime, st.st_size))
+
+        return entries
+
+    def key(self, stage, path, params=None):
+        """
+        :param stage: name of the stage, e.g. 'photometry'
+        :param path: input file of the stage
+        :param params: parameters the result depends on (anything JSON can
+                       store)
+
+        :returns hex digest identifying the result
+        """
+
+        import hashlib
+        import json
+        from manifest import _normalize
+
+        text = json.dumps([stage, self._hashes.fingerprint(path),
+                           _normalize(params)], sort_keys=True)
+
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _filename(self, key):
+        import os
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def get(self, stage, path, params=None):
+        """
+        :returns the stored result of a stage on a file with the given
+                 parameters, or None
+        """
+
+        import os
+        import numpy as np
+
+        filename = self._filename(self.key(stage, path, params))
+        try:
+            with np.load(filename) as npz:
+                result = _unpack(npz)
+            # the modification time marks the last use, for eviction
+            os.utime(filename)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    def put(self, stage, path, params, result):
+        """
+        Store the result of a stage, then evict old results if the cache is
+        over its size.
+
+        :param stage, path, params: see key
+        :param result: dictionary of arrays and numbers
+        """
+
+        import os
+        import numpy as np
+
+        filename = self._filename(self.key(stage, path, params))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        old = os.path.getsize(filename) if os.path.exists(filename) else 0
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **_pack(result))
+        os.replace(tmp, filename)
+
+        self.nbytes += os.path.getsize(filename) - old
+        if self.nbytes > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def memoize(self, stage, path, params, func, *args, **kwargs):
+        """
+        :returns the stored result of a stage, or func(*args, **kwargs)
+                 which is then stored
+        """
+
+        result = self.get(stage, path, params)
+        if result is None:
+            result = func(*args, **kwargs)
+            self.put(stage, path, params, result)
+
+        return result
+
+    def evict(self, max_bytes):
+        """
+        Delete the least recently used results until the cache fits.
+
+        :param max_bytes: most bytes of results to keep
+        """
+
+        import os
+
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.nbytes = sum(e[2] for e in entries)
+        for filename, mtime, size in entries:
+            if self.nbytes <= max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.nbytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Delete every stored result (the counters are kept).
+        """
+
+        self.evict(0)
+
+    def save(self):
+        """
+        Write the content hashes worked out this run, so the files don't
+        have to be read again next time.
+        """
+
+        self._hashes.save()
+
+    def info(self):
+        """
+        :returns dictionary with the hits, misses and hit rate of this
+                 process, the evictions, the size of the stored results in
+                 bytes and the size limit
+        """
+
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.,
+                'evictions': self.evictions, 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
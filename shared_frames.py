@@ -0,0 +1,400 @@
+# ============================================================================ #
+# Fan-out of many tasks on the same frame. Each frame is read and decoded
+# once in this process into a multiprocessing.shared_memory block, and the
+# tasks on it (sky, photometry and detection for every grid size, or any
+# other function of the image) run in worker processes on zero-copy views of
+# that block. The block is released as soon as the last task on the frame
+# has finished, so memory grows with the number of frames in flight and not
+# with the number of tasks or grid sizes.
+# ============================================================================ #
+
+
+class SharedFrame(object):
+    """
+    A frame copied into a block of shared memory owned by this process.
+
+    :param data: 2D image array
+    """
+
+    def __init__(self, data):
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        self.shape = data.shape
+        self.dtype = data.dtype.str
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=max(1, data.nbytes))
+        view = np.ndarray(data.shape, dtype=data.dtype, buffer=self._shm.buf)
+        view[...] = data
+        del view
+
+    def spec(self):
+        """
+        :returns picklable (block name, shape, dtype) for attach_frame
+        """
+
+        return self._shm.name, self.shape, self.dtype
+
+    def release(self):
+        """
+        Free the block. Workers still attached keep their mapping until they
+        close it.
+        """
+
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def attach_frame(spec):
+    """
+    :param spec: SharedFrame.spec() of a frame
+
+    :returns (SharedMemory handle, read-only array view of the frame). Close
+             the handle once done with the view.
+    """
+
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    data.flags.writeable = False
+
+    return shm, data
+
+
+def _shared_call(spec, func, kwargs):
+    """
+    Worker side of fan_out: run func on a view of a shared frame. Any
+    exception is trapped, see parallel._guarded_call.
+    """
+
+    import traceback
+
+    try:
+        shm, data = attach_frame(spec)
+    except Exception:
+        return False, traceback.format_exc()
+
+    try:
+        return True, func(data, **kwargs)
+    except Exception:
+        return False, traceback.format_exc()
+    finally:
+        del data
+        try:
+            shm.close()
+        except BufferError:
+            # the result still refers to the block; the mapping goes when
+            # the result does
+            pass
+
+
+def _ready(tasks, done):
+    """
+    :returns the tasks not yet run whose inputs have all finished
+    """
+
+    return [task for task in tasks if task[0] not in done
+            and all(key in done for key in task[3].values())]
+
+
+def _task_kwargs(task, done):
+    """
+    :returns the keyword arguments of a task with the results of its inputs
+             filled in, or None if one of its inputs failed
+    """
+
+    kwargs = dict(task[2])
+    for name, key in task[3].items():
+        ok, value = done[key]
+        if not ok:
+            return None
+        kwargs[name] = value
+
+    return kwargs
+
+
+def _run_inline(data, tasks):
+    """
+    Run the tasks on one frame in this process, inputs first.
+
+    :returns dictionary of (ok, value) keyed by task
+    """
+
+    from functools import partial
+    from parallel import _guarded_call
+
+    done = {}
+    while len(done) < len(tasks):
+        for task in _ready(tasks, done):
+            kwargs = _task_kwargs(task, done)
+            if kwargs is None:
+                done[task[0]] = (False, 'An input of {} failed'.format(
+                    task[0]))
+            else:
+                done[task[0]] = _guarded_call(partial(task[1], **kwargs),
+                                              data)
+
+    return done
+
+
+def fan_out(paths, tasks, processes=None, max_frames=2, calibration=None):
+    """
+    Run a set of tasks on every frame, each frame read from disk and decoded
+    only once.
+
+    A task is (key, func, kwargs, inputs): func(data, **kwargs) is called on
+    the frame, plus one keyword argument per entry of the inputs dictionary
+    {argument name: key of another task} holding that task's result. Tasks
+    run as soon as their inputs are done, so e.g. photometry for every grid
+    size runs side by side once the sky is known.
+
+    :param paths: FITS files. Consumed lazily.
+    :param tasks: list of tasks, or a function giving the list for a path
+                  (e.g. to pass the frame's exposure time on). The functions
+                  must be picklable (module level), and shouldn't return
+                  views of the frame.
+    :param processes: number of worker processes, defaults to the number of
+                      CPUs. 1 runs everything in this process, without
+                      shared memory.
+    :param max_frames: most frames held in shared memory at once
+    :param calibration: optional calibration.Calibration applied to every
+                        frame before it is shared
+
+    :returns generator of (path, {key: (ok, value)}) in the order of paths.
+             ok is False and value a traceback (or note) for tasks that
+             failed or whose inputs failed. A frame that can't be read has
+             every task failed with the read error.
+    """
+
+    import os
+    import traceback
+    from collections import deque
+    from concurrent.futures import FIRST_COMPLETED, wait
+    from frames import get_frame, prefetch
+    from inventory import directory_params
+    from parallel import (_pool_died, _retry_alone, _start_pool, _submit,
+                          default_processes)
+
+    if processes is None:
+        processes = default_processes()
+
+    def load(path):
+        data = get_frame(path)
+        if calibration is not None:
+            exposure = directory_params(os.path.dirname(path))[0]
+            data = calibration.apply(data, path, exposure)
+        return data
+
+    def frame_tasks(path):
+        return tasks(path) if callable(tasks) else tasks
+
+    if processes <= 1:
+        for path in prefetch(paths):
+            try:
+                data = load(path)
+            except Exception:
+                error = traceback.format_exc()
+                yield path, dict((t[0], (False, error))
+                                 for t in frame_tasks(path))
+                continue
+            yield path, _run_inline(data, frame_tasks(path))
+        return
+
+    # frames in flight, in input order: [path, tasks, block, done]
+    frames = deque()
+    running = {}
+
+    def submit(frame):
+        path, todo, block, done = frame
+        for task in _ready(todo, done):
+            if any(task[0] == key for f, key, args in running.values()
+                   if f is frame):
+                continue
+            kwargs = _task_kwargs(task, done)
+            if kwargs is None:
+                done[task[0]] = (False, 'An input of {} failed'.format(
+                    task[0]))
+                continue
+            args = (block.spec(), task[1], kwargs)
+            running[_submit(pool, _shared_call, *args)] = (frame, task[0],
+                                                           args)
+
+    def settle(frame):
+        # keep going until nothing more can start; skipping a task whose
+        # input failed may let others be skipped in turn
+        while True:
+            count = len(frame[3])
+            submit(frame)
+            if len(frame[3]) == count:
+                break
+        if len(frame[3]) == len(frame[1]) and frame[2] is not None:
+            frame[2].release()
+            frame[2] = None
+
+    def collect(timeout=None):
+        nonlocal pool
+        finished, not_done = wait(list(running), timeout=timeout,
+                                  return_when=FIRST_COMPLETED)
+        if any(_pool_died(future) for future in finished):
+            # a worker died and took the pool with it. Every task that was
+            # in flight is run again on its own (see parallel_map), so only
+            # the one killing workers fails; nothing new is submitted until
+            # they are through.
+            pool.shutdown()
+            finished = list(running)
+        touched = []
+        for future in finished:
+            frame, key, args = running.pop(future)
+            if _pool_died(future):
+                pool, future = _retry_alone(pool, processes, _shared_call,
+                                            *args)
+            try:
+                frame[3][key] = future.result()
+            except Exception:
+                frame[3][key] = (False, traceback.format_exc())
+            if not any(f is frame for f in touched):
+                touched.append(frame)
+        for frame in touched:
+            settle(frame)
+
+    def finished(frame):
+        return len(frame[3]) == len(frame[1])
+
+    pool = _start_pool(processes)
+    try:
+        for path in prefetch(paths):
+            # frames that are done but wait on an earlier one don't hold
+            # a block any more, so they don't count against max_frames
+            while len([f for f in frames if f[2] is not None]) \
+                    >= max_frames and running:
+                collect()
+
+            todo = frame_tasks(path)
+            try:
+                block = SharedFrame(load(path))
+            except Exception:
+                error = traceback.format_exc()
+                frames.append([path, todo, None,
+                               dict((t[0], (False, error))
+                                    for t in todo)])
+                continue
+            frame = [path, todo, block, {}]
+            frames.append(frame)
+            settle(frame)
+
+            while frames and finished(frames[0]):
+                frame = frames.popleft()
+                yield frame[0], frame[3]
+
+        while running:
+            collect()
+            while frames and finished(frames[0]):
+                frame = frames.popleft()
+                yield frame[0], frame[3]
+        while frames:
+            frame = frames.popleft()
+            yield frame[0], frame[3]
+    finally:
+        for frame in frames:
+            if frame[2] is not None:
+                frame[2].release()
+        pool.shutdown()
+
+
+def sky_task(data):
+    """
+    :returns the sky of a frame, see sky_estimate.estimate_sky
+    """
+
+    from sky_estimate import estimate_sky
+
+    return estimate_sky(data)
+
+
+def photometry_task(data, grid, sky, itime=1.0, zmag=25.0):
+    """
+    :param grid: grid size string, e.g. '64x64'
+    :param sky: result of sky_task
+
+    :returns grid photometry of a frame, see grid_photometry.grid_photometry
+    """
+
+    from grid_photometry import grid_photometry
+    from polyphot_batch import parse_gsize
+
+    nx, ny = parse_gsize(grid)
+
+    return grid_photometry(data, nx, ny, sky['skyval'], sky['sigma'],
+                           itime=itime, zmag=zmag, skyerr=sky['skyerr'])
+
+
+def detection_task(data, grid, sky, phot, nsigma=3.0):
+    """
+    :param grid: grid size string
+    :param sky: result of sky_task
+    :param phot: result of photometry_task for the grid
+
+    :returns ((ny, nx) SNR map, summary dictionary), as detection.detect_frame
+             gives for each grid
+    """
+
+    from detection import detect_grids
+
+    return detect_grids({grid: phot}, sky, nsigma=nsigma)[grid]
+
+
+def grid_tasks(grids, nsigma=3.0, itime=1.0, detect=True):
+    """
+    :param grids: grid size strings
+    :param nsigma: detection level, see detection.detection_threshold
+    :param itime: exposure time in seconds, for the magnitudes
+    :param detect: if False only the sky and photometry are run
+
+    :returns fan_out tasks for the sky of a frame and its photometry and
+             detection for every grid size. The keys are 'sky',
+             'photometry <grid>' and 'detection <grid>'.
+    """
+
+    tasks = [('sky', sky_task, {}, {})]
+    for grid in grids:
+        tasks.append(('photometry ' + grid, photometry_task,
+                      {'grid': grid, 'itime': itime}, {'sky': 'sky'}))
+        if detect:
+            tasks.append(('detection ' + grid, detection_task,
+                          {'grid': grid, 'nsigma': nsigma},
+                          {'sky': 'sky', 'phot': 'photometry ' + grid}))
+
+    return tasks
+
+
+def compare_grids(paths, grids, nsigma=3.0, processes=None, max_frames=2,
+                  calibration=None):
+    """
+    Sky, photometry and detection of frames at several grid sizes, with
+    every grid size of a frame measured at the same time in its own worker.
+
+    :param paths: FITS files laid out as <filters>/<exposure>/<image>
+    :param grids: grid size strings, e.g. the sizes of
+                  grid_making_examples.py
+    :param nsigma: detection level, see detection.detection_threshold
+    :param processes, max_frames, calibration: see fan_out
+
+    :returns generator of (path, {key: (ok, value)}) with the keys of
+             grid_tasks
+    """
+
+    import os
+    from inventory import directory_params
+
+    def tasks(path):
+        exposure = directory_params(os.path.dirname(path))[0]
+        return grid_tasks(grids, nsigma=nsigma,
+                          itime=exposure if exposure > 0 else 1.0)
+
+    return fan_out(paths, tasks, processes=processes, max_frames=max_frames,
+                   calibration=calibration)
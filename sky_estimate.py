@@ -0,0 +1,254 @@
+# ============================================================================ #
+# Automatic sky background estimation. Replaces hovering over four spots of
+# clear sky in DS9 for every image: many boxes are laid over the frame, their
+# sigma-clipped statistics are computed all at once, boxes contaminated by
+# cloud are rejected and the rest give SKYVAL, SIGMA and SKYVAL ERR just like
+# tidy_stats.get_bg does from the imexam results.
+# ============================================================================ #
+
+
+def candidate_boxes(shape, size=25, spacing=None, border=0):
+    """
+    Lower left corners of a regular lattice of square boxes over an image.
+
+    :param shape: shape of the image array, (height, width)
+    :param size: side of each box in pixels (imexam stats used 25 px boxes)
+    :param spacing: distance between box corners, defaults to size (boxes
+                    tile the image without overlapping)
+    :param border: pixels to leave out along every edge of the frame
+
+    :returns arrays x0, y0 of box corners
+    """
+
+    import numpy as np
+
+    if spacing is None:
+        spacing = size
+
+    xs = np.arange(border, shape[1] - border - size + 1, spacing)
+    ys = np.arange(border, shape[0] - border - size + 1, spacing)
+    x0, y0 = np.meshgrid(xs, ys)
+
+    return x0.ravel(), y0.ravel()
+
+
+def box_pixels(data, x0, y0, size):
+    """
+    :param data: 2D image array
+    :param x0, y0: arrays of box corners
+    :param size: side of the boxes
+
+    :returns float64 array of shape (nboxes, size * size) with the pixels of
+             every box
+    """
+
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    windows = sliding_window_view(data, (size, size))
+    return windows[y0, x0].reshape(len(x0), -1).astype(np.float64)
+
+
+def clipped_stats(pixels, nsigma=3.0, iters=5):
+    """
+    Sigma-clipped mean and standard deviation of many boxes at once.
+
+    :param pixels: array of shape (nboxes, npix) as from box_pixels
+    :param nsigma: clip pixels further than this many sigma from the mean
+    :param iters: most clipping iterations to do
+
+    :returns arrays of the clipped mean, standard deviation and number of
+             pixels kept, one entry per box
+    """
+
+    import numpy as np
+
+    keep = np.ones(pixels.shape, dtype=bool)
+    for i in range(iters):
+        n = keep.sum(axis=1)
+        mean = np.where(keep, pixels, 0.).sum(axis=1) / n
+        dev = np.where(keep, pixels - mean[:, None], 0.)
+        std = np.sqrt((dev ** 2).sum(axis=1) / n)
+
+        new = np.abs(pixels - mean[:, None]) <= nsigma * std[:, None]
+        if (new == keep).all():
+            break
+        keep = new
+
+    n = keep.sum(axis=1)
+    mean = np.where(keep, pixels, 0.).sum(axis=1) / n
+    dev = np.where(keep, pixels - mean[:, None], 0.)
+    std = np.sqrt((dev ** 2).sum(axis=1) / n)
+
+    return mean, std, n
+
+
+def reject_cloudy(means, stds, nsigma=3.0, iters=10):
+    """
+    Flag boxes that look contaminated by cloud. Cirrus is brighter than clear
+    sky and adds structure, so a box is rejected if its mean or its standard
+    deviation sits too far above the rest. The spread is measured with the
+    median absolute deviation so the clouds themselves don't inflate it.
+
+    :param means: clipped mean of each box
+    :param stds: clipped standard deviation of each box
+    :param nsigma: how many (robust) sigma above the median is too bright or
+                   too structured
+    :param iters: most rejection iterations to do
+
+    :returns boolean array, True for boxes of clear sky
+    """
+
+    import numpy as np
+
+    good = np.isfinite(means) & np.isfinite(stds)
+    for i in range(iters):
+        new = good.copy()
+        for values in (means, stds):
+            med = np.median(values[good])
+            spread = 1.4826 * np.median(np.abs(values[good] - med))
+            if spread > 0:
+                new &= values <= med + nsigma * spread
+        if (new == good).all() or not new.any():
+            break
+        good = new
+
+    return good
+
+
+def estimate_sky(data, size=25, spacing=None, border=0, nsigma=3.0,
+                 cloud_nsigma=3.0):
+    """
+    Estimate the sky background of a frame without any interaction.
+
+    :param data: 2D image array
+    :param size: side of the sky boxes in pixels
+    :param spacing: distance between boxes, defaults to size
+    :param border: pixels to leave out along the edges of the frame
+    :param nsigma: sigma clipping level for the pixels within a box
+    :param cloud_nsigma: rejection level for cloudy boxes, see reject_cloudy
+
+    :returns dictionary with skyval, sigma and skyerr (the SKYVAL, SIGMA and
+             SKYVAL ERR columns of files_and_params.txt) and the number of
+             boxes tried and used
+    """
+
+    import numpy as np
+
+    x0, y0 = candidate_boxes(data.shape, size=size, spacing=spacing,
+                             border=border)
+    means, stds, npix = clipped_stats(box_pixels(data, x0, y0, size),
+                                      nsigma=nsigma)
+    clear = reject_cloudy(means, stds, nsigma=cloud_nsigma)
+
+    # same summary get_bg makes from the imexam boxes: the median of the box
+    # means, the sigma that goes with it and sigma/sqrt(25)
+    skyval = np.median(means[clear])
+    order = np.argsort(means[clear])
+    mid = len(order) // 2
+    if len(order) % 2:
+        sigma = stds[clear][order[mid]]
+    else:
+        sigma = 0.5 * (stds[clear][order[mid - 1]] + stds[clear][order[mid]])
+    bgerr = sigma / np.sqrt(25)
+
+    return {'skyval': float(skyval), 'sigma': float(sigma),
+            'skyerr': float(bgerr), 'nboxes': len(means),
+            'nused': int(clear.sum())}
+
+
+def _sky_job(path, calibration=None):
+    """
+    Worker for auto_skystats: estimate the sky of one FITS file, after
+    calibrating it if a calibration.Calibration is given.
+    """
+
+    import os
+    from frames import get_frame
+    from inventory import directory_params
+
+    data = get_frame(path)
+    if calibration is not None:
+        exposure = directory_params(os.path.dirname(path))[0]
+        data = calibration.apply(data, path, exposure)
+
+    return estimate_sky(data)
+
+
+def auto_skystats(mypath, output='files_and_params.txt', processes=1,
+                  manifest=None, calibration=None):
+    """
+    Non-interactive replacement for collect_skystats.py + tidy_list_skyvals.
+
+    :param mypath: top level directory of the images, laid out as
+                   <filters>/<exposure>/<image>.FIT
+    :param output: file to write, same format as tidy_list_skyvals, or a
+                   session catalog ('.db' or '.sqlite')
+    :param processes: number of worker processes
+    :param manifest: optional manifest.Manifest of the session. Images whose
+                     sky was already estimated from the same file contents
+                     are written from the manifest instead of measured again.
+    :param calibration: optional calibration.Calibration. The sky is then
+                        measured on bias and dark subtracted frames, to go
+                        with photometry run with the same calibration.
+
+    output: a single tidy file named files_and_params.txt summarizing the
+    values for each image. file has column headers:
+    IMAGE   SKYVAL   SIGMA   SKYVAL ERR   EXPOSURE   FILTER 1   FILTER 2   PATH
+    """
+
+    from functools import partial
+    from catalog import write_params
+    from inventory import build_inventory
+    from parallel import parallel_map
+
+    inv = build_inventory(mypath)
+    paths = inv['path'].tolist()
+    frames = dict(zip(paths, inv))
+
+    def params(path):
+        if calibration is None:
+            return None
+        return {'calibration': calibration.fingerprint(
+            path, float(frames[path]['exposure']))}
+
+    skies = {}
+    todo = paths
+    if manifest is not None:
+        todo = [p for p in paths if not manifest.is_done('sky', p,
+                                                         params(p))]
+        pending = set(todo)
+        skies = dict((p, manifest.result('sky', p)) for p in paths
+                     if p not in pending)
+
+    print('Estimating the sky in {} images ({} already done)...'.format(
+        len(todo), len(skies)))
+
+    job = partial(_sky_job, calibration=calibration)
+    try:
+        for path, ok, sky in parallel_map(job, todo, processes=processes,
+                                          frame_path=str):
+            if not ok:
+                print('Could not estimate the sky for {}:\n{}'.format(path,
+                                                                      sky))
+                continue
+            skies[path] = sky
+            if manifest is not None:
+                manifest.mark_done('sky', path, params(path), result=sky)
+    finally:
+        # an interrupted run keeps the images it got through
+        if manifest is not None:
+            manifest.save()
+
+    records = []
+    for path in paths:
+        if path not in skies:
+            continue
+
+        sky = skies[path]
+        frame = frames[path]
+        records.append((frame['image'], sky['skyval'], sky['sigma'],
+                        sky['skyerr'], frame['exposure'], frame['filter1'],
+                        frame['filter2'], path[:-len(frame['image'])]))
+
+    write_params(output, records)
@@ -0,0 +1,262 @@
+# ============================================================================ #
+# Stacking of exposure series. Frames taken one after another with the same
+# filters and exposure are repeated shots of the same sky, so they are grouped
+# by (filter pair, exposure, time window), copied one frame at a time into a
+# memory-mapped (N, height, width) cube, and co-added strip by strip with
+# bounded memory. Photometry and detection on the co-add reach fainter cirrus
+# than any single frame.
+# ============================================================================ #
+
+COADD_METHODS = ('mean', 'median', 'clipped')
+
+
+def group_frames(paths, filter1, filter2, exposure, timestamps, window=60.0):
+    """
+    Split frames into series taken with the same filters and exposure within
+    a window of time.
+
+    :param paths: FITS files
+    :param filter1, filter2: filter names of every frame
+    :param exposure: exposure time of every frame in seconds
+    :param timestamps: datetime64 time of every frame (NaT if unknown)
+    :param window: longest time span of a series in seconds, measured from
+                   its first frame. Frames with no time are grouped on
+                   filters and exposure alone.
+
+    :returns list of lists of paths, each list one series in time order
+    """
+
+    import numpy as np
+
+    timestamps = np.asarray(timestamps, dtype='datetime64[ms]')
+    seconds = (timestamps - np.datetime64(0, 'ms')).astype(np.float64) / 1e3
+    seconds[np.isnat(timestamps)] = np.nan
+
+    keys = [(f1, f2, round(float(e), 9)) for f1, f2, e in
+            zip(filter1, filter2, exposure)]
+    order = sorted(range(len(keys)),
+                   key=lambda k: (keys[k], np.nan_to_num(seconds[k]),
+                                  paths[k]))
+
+    groups = []
+    for k in order:
+        if groups:
+            first = groups[-1][0]
+            same = keys[first] == keys[k]
+            if same and not np.isnan(seconds[k]):
+                same = seconds[k] - seconds[first] <= window
+            if same:
+                groups[-1].append(k)
+                continue
+        groups.append([k])
+
+    return [[paths[k] for k in group] for group in groups]
+
+
+def groups_from_inventory(inv, window=60.0):
+    """
+    :param inv: inventory from inventory.build_inventory
+    :param window: see group_frames
+
+    :returns the series of the inventory, see group_frames
+    """
+
+    return group_frames(inv['path'].tolist(), inv['filter1'].tolist(),
+                        inv['filter2'].tolist(), inv['exposure'],
+                        inv['timestamp'], window=window)
+
+
+def groups_from_catalog(conn, window=60.0, **selection):
+    """
+    :param conn: connection from catalog.connect
+    :param window: see group_frames
+    :param selection: any of the selections of catalog.query_images
+
+    :returns the series of the (selected) catalog images, see group_frames
+    """
+
+    import numpy as np
+    from catalog import query_images
+
+    rows = query_images(conn, as_frame=False, **selection)
+    timestamps = [np.datetime64('{}T{}'.format(d, t)) if d and t
+                  else np.datetime64('NaT')
+                  for d, t in zip(rows['date'], rows['time'])]
+
+    return group_frames([p + i for p, i in zip(rows['path'], rows['image'])],
+                        rows['filter1'].tolist(), rows['filter2'].tolist(),
+                        rows['exposure'], timestamps, window=window)
+
+
+def build_cube(paths, filename):
+    """
+    Copy frames one at a time into a memory-mapped cube on disk.
+
+    :param paths: FITS files of the same shape
+    :param filename: '.npy' file for the cube
+
+    :returns the cube, memory-mapped read-only, shape (N, height, width) in
+             the frames' own type
+    """
+
+    import numpy as np
+    from frames import read_frame
+
+    first = read_frame(paths[0])
+    cube = np.lib.format.open_memmap(filename, mode='w+', dtype=first.dtype,
+                                     shape=(len(paths),) + first.shape)
+    for k, path in enumerate(paths):
+        frame = first if k == 0 else read_frame(path)
+        if frame.shape != first.shape:
+            raise ValueError('{} has shape {}, expected {}'.format(
+                path, frame.shape, first.shape))
+        cube[k] = frame
+    cube.flush()
+    del cube
+
+    return np.load(filename, mmap_mode='r')
+
+
+def _clipped_mean(stack, nsigma=3.0, iters=5):
+    """
+    Sigma-clipped mean along the first axis of a stack.
+    """
+
+    import numpy as np
+
+    keep = np.ones(stack.shape, dtype=bool)
+    for i in range(iters):
+        n = np.maximum(keep.sum(axis=0), 1)
+        mean = np.where(keep, stack, 0.).sum(axis=0) / n
+        dev = np.where(keep, stack - mean, 0.)
+        std = np.sqrt((dev ** 2).sum(axis=0) / n)
+
+        new = np.abs(stack - mean) <= nsigma * std
+        if (new == keep).all():
+            break
+        keep = new
+
+    n = np.maximum(keep.sum(axis=0), 1)
+    return np.where(keep, stack, 0.).sum(axis=0) / n
+
+
+def coadd(cube, methods=COADD_METHODS, nsigma=3.0, max_bytes=256 * 2 ** 20):
+    """
+    Co-add the frames of a cube, a strip of rows at a time.
+
+    :param cube: (N, height, width) array, e.g. from build_cube
+    :param methods: any of 'mean', 'median' and 'clipped' (sigma-clipped
+                    mean, rejecting satellites, planes and hot pixels)
+    :param nsigma: clipping level of the 'clipped' co-add
+    :param max_bytes: most memory for a strip of the cube as float64. The
+                      clipped co-add needs a few times this.
+
+    :returns dictionary of float64 (height, width) co-adds keyed by method
+    """
+
+    import numpy as np
+
+    for method in methods:
+        if method not in COADD_METHODS:
+            raise ValueError('Unknown co-add method {}'.format(method))
+
+    n, height, width = cube.shape
+    rows = max(1, int(max_bytes // (8 * n * width)))
+    results = dict((m, np.empty((height, width), dtype=np.float64))
+                   for m in methods)
+
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        strip = np.asarray(cube[:, start:stop], dtype=np.float64)
+        if 'mean' in results:
+            results['mean'][start:stop] = strip.mean(axis=0)
+        if 'median' in results:
+            results['median'][start:stop] = np.median(strip, axis=0)
+        if 'clipped' in results:
+            results['clipped'][start:stop] = _clipped_mean(strip, nsigma)
+
+    return results
+
+
+def stack_series(paths, outdir, methods=COADD_METHODS, grids=('64x64',),
+                 nsigma=3.0, keep_cube=True):
+    """
+    Stack one series and run detection on its co-adds.
+
+    :param paths: FITS files of the series, see group_frames
+    :param outdir: directory for the cube and the co-adds
+    :param methods: co-adds to make, see coadd
+    :param grids: grid size strings to run detection on
+    :param nsigma: detection level, see detection.detection_threshold
+    :param keep_cube: if False the cube is deleted once co-added
+
+    :returns dictionary with the series name, number of frames, the files
+             written and, per method, the sky and the detection summary of
+             every grid (see detection.detect_frame)
+    """
+
+    import os
+    from astropy.io import fits
+    from detection import detect_frame
+    from inventory import directory_params
+
+    dirpath = os.path.dirname(paths[0])
+    exposure, filter1, filter2, date = directory_params(dirpath)
+    name = '{}-{}_{}_{}'.format(filter1 or 'unknown', filter2 or 'none',
+                                os.path.basename(dirpath),
+                                os.path.basename(paths[0])[:-4])
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    cube_file = os.path.join(outdir, name + '_cube.npy')
+    cube = build_cube(paths, cube_file)
+
+    series = {'name': name, 'nframes': len(paths), 'cube': cube_file,
+              'files': {}, 'detections': {}}
+    for method, image in coadd(cube, methods=methods).items():
+        filename = os.path.join(outdir, '{}_{}.fits'.format(name, method))
+        fits.PrimaryHDU(image.astype('float32')).writeto(filename,
+                                                        overwrite=True)
+        series['files'][method] = filename
+        series['detections'][method] = detect_frame(
+            image, grids=grids, nsigma=nsigma,
+            itime=exposure if exposure > 0 else 1.0)
+
+    del cube
+    if not keep_cube:
+        os.remove(cube_file)
+        series['cube'] = None
+
+    return series
+
+
+def stack_session(top, outdir, window=60.0, min_frames=2,
+                  methods=COADD_METHODS, grids=('64x64',), nsigma=3.0,
+                  keep_cube=True):
+    """
+    Stack every series of frames below a directory.
+
+    :param top: top level directory of the images
+    :param outdir: directory for the cubes and co-adds
+    :param window: longest time span of a series in seconds
+    :param min_frames: series with fewer frames are left alone
+    :param methods, grids, nsigma, keep_cube: see stack_series
+
+    :returns list of the stack_series results
+    """
+
+    from inventory import build_inventory
+
+    results = []
+    for paths in groups_from_inventory(build_inventory(top), window=window):
+        if len(paths) < min_frames:
+            continue
+        series = stack_series(paths, outdir, methods=methods, grids=grids,
+                              nsigma=nsigma, keep_cube=keep_cube)
+        best = max(series['detections'][m][1][g][1]['max_snr']
+                   for m in series['detections'] for g in grids)
+        print('Stacked {} frames into {} (largest SNR {:.1f})'.format(
+            series['nframes'], series['name'], best))
+        results.append(series)
+
+    return results
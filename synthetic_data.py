@@ -0,0 +1,281 @@
+# ============================================================================ #
+# Synthetic data for benchmarking the pipeline without a night at the
+# telescope. Writes 1280x960 uint16 FITS frames like the camera's (sky with
+# noise, stars and wisps of cirrus) into the <date>/<filters>/<exposure>
+# layout of the procedure, plus imexam results files in the format
+# collect_skystats.py leaves behind and polyphot logs in the format
+# iraf.polyphot writes.
+# ============================================================================ #
+
+FRAME_SHAPE = (960, 1280)
+
+
+def cirrus_field(shape=FRAME_SHAPE, scale=150.0, rng=None):
+    """
+    Smooth random structure that looks like cirrus: noise filtered in
+    Fourier space to a steep power law, stretched along one direction and
+    clipped to leave clear sky between the wisps.
+
+    :param shape: (height, width) of the frame
+    :param scale: typical size of the structure in pixels
+    :param rng: numpy random Generator
+
+    :returns float64 array scaled to 0..1
+    """
+
+    import numpy as np
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    ky = np.fft.fftfreq(shape[0])[:, None]
+    kx = np.fft.rfftfreq(shape[1])[None, :]
+    # wisps are longer than they are wide
+    k = np.sqrt((kx * scale / 3.) ** 2 + (ky * scale) ** 2)
+    spectrum = (rng.normal(size=k.shape) + 1j * rng.normal(size=k.shape)) \
+        / (1. + k ** 2) ** 1.5
+    field = np.fft.irfft2(spectrum, s=shape)
+
+    field = (field - field.mean()) / field.std()
+    field = np.clip(field - 0.5, 0., None)
+
+    return field / max(field.max(), 1e-12)
+
+
+def synthetic_frame(shape=FRAME_SHAPE, sky=1000.0, noise=20.0, nstars=40,
+                    cirrus=300.0, rng=None):
+    """
+    :param shape: (height, width) of the frame
+    :param sky: sky level in counts
+    :param noise: standard deviation of the sky in counts
+    :param nstars: number of stars
+    :param cirrus: peak brightness of the cirrus above the sky in counts
+                   (0 for clear sky)
+    :param rng: numpy random Generator
+
+    :returns uint16 frame
+    """
+
+    import numpy as np
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    data = rng.normal(sky, noise, size=shape)
+    if cirrus:
+        data += cirrus * cirrus_field(shape, rng=rng)
+
+    # stars as small gaussians, drawn on a patch around each one
+    y, x = np.mgrid[-7:8, -7:8]
+    for i in range(nstars):
+        cy = rng.integers(7, shape[0] - 8)
+        cx = rng.integers(7, shape[1] - 8)
+        width = rng.uniform(1.0, 2.5)
+        peak = rng.uniform(500., 30000.)
+        data[cy - 7:cy + 8, cx - 7:cx + 8] += peak * np.exp(
+            -(x ** 2 + y ** 2) / (2 * width ** 2))
+
+    return np.clip(data, 0, 65535).astype(np.uint16)
+
+
+def write_frame(path, data):
+    """
+    Write a frame as FITS the way the camera does, 16 bit unsigned (BITPIX
+    16 with BZERO 32768).
+    """
+
+    from astropy.io import fits
+
+    fits.PrimaryHDU(data).writeto(path, overwrite=True)
+
+
+def make_session(top, nframes=10, date='9October2016',
+                 filters=(('Orion82aBlue', 'Celestron47Purple'),
+                          ('15', 'none')),
+                 exposures=('300microsec', '1millisec'), start='13-41-00',
+                 cirrus=300.0, seed=0):
+    """
+    Write a session of synthetic frames laid out like a real one,
+    <top>/<date>/<filters>/<exposure>/<HH-MM-SS-mmm>.FIT.
+
+    :param top: directory to write into
+    :param nframes: frames per filter and exposure combination
+    :param date: name of the dated directory
+    :param filters: (first, second) filter pairs. 'none' as second filter
+                    gives a single filter directory.
+    :param exposures: exposure directory names
+    :param start: time of the first frame, 'HH-MM-SS'
+    :param cirrus: peak brightness of the cirrus, see synthetic_frame
+    :param seed: random seed, the same seed gives the same frames
+
+    :returns sorted list of the frames written
+    """
+
+    import os
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    hh, mm, ss = [int(t) for t in start.split('-')]
+    t0 = (hh * 60 + mm) * 60 + ss
+
+    paths = []
+    for f1, f2 in filters:
+        for exposure in exposures:
+            folder = f1 if f2 == 'none' else '{}-{}'.format(f1, f2)
+            dirpath = os.path.join(top, date, folder, exposure)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            for k in range(nframes):
+                t = t0 + len(paths) * 0.25
+                name = '{:02d}-{:02d}-{:02d}-{:03d}.FIT'.format(
+                    int(t // 3600) % 24, int(t // 60) % 60, int(t) % 60,
+                    int(round((t % 1) * 1000)))
+                path = os.path.join(dirpath, name)
+                write_frame(path, synthetic_frame(
+                    sky=rng.uniform(900., 1100.), cirrus=cirrus, rng=rng))
+                paths.append(path)
+
+    return sorted(paths)
+
+
+def write_imexam_results(paths, output, nboxes=4, region_size=25, seed=0):
+    """
+    Write the imexam results file collect_skystats.py produces for one
+    filter and exposure combination: for every image, nboxes real_m_stats
+    reports of boxes placed on the frame.
+
+    :param paths: frames of one filter and exposure combination
+    :param output: file to write, named like
+                   '<filter>-<filter>-XXX<unit>.txt' for tidy_list_skyvals
+    :param nboxes: boxes per image (the procedure uses 4)
+    :param region_size: side of the boxes
+    :param seed: random seed for the box positions
+    """
+
+    import numpy as np
+    from box_stats import batch_box_stats
+    from frames import read_frame
+
+    rng = np.random.default_rng(seed)
+    lines = ['_run_imexam \n', '\n']
+    for path in paths:
+        data = read_frame(path)
+        lines.append('Current image {}\n'.format(path))
+        x = rng.integers(region_size, data.shape[1] - region_size, nboxes)
+        y = rng.integers(region_size, data.shape[0] - region_size, nboxes)
+        for s in batch_box_stats(data, x, y, region_size):
+            lines.append('real_m_stats \n')
+            lines.append('SLICE   NPIX   MEAN   STD   MEDIAN   MIN   MAX\n')
+            lines.append('[{}:{},{}:{}]  {}   {}  {}  {}  {}  {}\n'.format(
+                s['XMIN'], s['XMAX'], s['YMIN'], s['YMAX'], s['NPIX'],
+                s['MEAN'], s['STD'], s['MEDIAN'], s['MIN'], s['MAX']))
+            lines.append('\n')
+
+    with open(output, 'w') as f:
+        f.writelines(lines)
+
+
+def write_imexam_session(paths, outdir, nboxes=4, region_size=25, seed=0):
+    """
+    Write one imexam results file per filter and exposure combination of a
+    session, the folder tidy_stats.tidy_list_skyvals reads.
+
+    :param paths: frames laid out as <filters>/<exposure>/<image>, e.g. from
+                  make_session
+    :param outdir: directory to write the results files into
+    :param nboxes, region_size, seed: see write_imexam_results
+
+    :returns list of the results files written
+    """
+
+    import os
+    from tidy_stats import parse_filters
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    combos = {}
+    for path in sorted(paths):
+        combos.setdefault(os.path.dirname(path), []).append(path)
+
+    written = []
+    for dirpath, frames in sorted(combos.items()):
+        filter1, filter2 = parse_filters(frames[0])
+        output = os.path.join(outdir, '{}-{}-{}.txt'.format(
+            filter1, filter2, os.path.basename(dirpath)))
+        write_imexam_results(frames, output, nboxes=nboxes,
+                             region_size=region_size, seed=seed)
+        written.append(output)
+
+    return written
+
+
+def _polyphot_header():
+    """
+    The '#' lines at the top of a polyphot log, down to the column groups.
+    """
+
+    groups = ['IMAGE XINIT YINIT ID COORDS LID',
+              'XCENTER YCENTER XSHIFT YSHIFT XERR YERR CIER CERROR',
+              'MSKY STDEV SSKEW NSKY NSREJ SIER SERROR',
+              'ITIME XAIRMASS IFILTER OTIME',
+              'SUM AREA FLUX MAG MERR PIER PERROR',
+              'POLYGONS PID OLDXMEAN OLDYMEAN XMEAN YMEAN MINRAD NVERTICES',
+              'XVERTEX YVERTEX']
+
+    lines = ['#K IRAF       = NOAO/IRAFV2.16          version    %-23s',
+             '#K TASK       = polyphot                name       %-23s',
+             '#']
+    for group in groups:
+        lines += ['#N {} \\'.format(group), '#U {} \\'.format(
+            ' '.join('##' for name in group.split())), '#F {} \\'.format(
+            ' '.join('%-12s' for name in group.split())), '#']
+
+    return lines
+
+
+def write_polyphot_log(output, image, phot, nx, ny, skyval, sigma, itime,
+                       filter1, filter2, shape=FRAME_SHAPE):
+    """
+    Write grid photometry results as the log iraf.polyphot writes for a grid
+    made by make_grid, so polyphot_io can be exercised without PyRAF.
+
+    :param output: log file to write, e.g. '<image>_photometry_64x64'
+    :param image: image name
+    :param phot: results of grid_photometry.grid_photometry for the image
+    :param nx, ny: grid size
+    :param skyval, sigma, itime: the polyphot parameters
+    :param filter1, filter2: the filters, written to IFILTER
+    :param shape: (height, width) of the image
+    """
+
+    from grid_photometry import grid_cell_size
+
+    dx, dy = grid_cell_size(nx, ny, shape)
+    grid = '{}x{}grid'.format(nx, ny)
+
+    lines = _polyphot_header()
+    for k in range(len(phot['counts'])):
+        cx, cy = phot['xcenter'][k], phot['ycenter'][k]
+        mag, merr = phot['mag'][k], phot['merr'][k]
+        lines += [
+            '{}  {:.3f} {:.3f} {} {}_centers.txt 1 \\'.format(
+                image, cx, cy, k + 1, grid),
+            '   {:.3f} {:.3f} 0.000 0.000 INDEF INDEF 0 NoError \\'.format(
+                cx, cy),
+            '   {:.7g} {:.7g} INDEF 0 0 0 NoError \\'.format(skyval, sigma),
+            '   {:.7g} INDEF {}, {} INDEF \\'.format(itime, filter1,
+                                                   filter2),
+            '   {:.7g} {:.7g} {:.7g} {} {} 0 NoError \\'.format(
+                phot['counts'][k], phot['area'][k], phot['flux'][k],
+                'INDEF' if mag != mag else '{:.3f}'.format(mag),
+                'INDEF' if merr != merr else '{:.3f}'.format(merr)),
+            '   {}_polygons.txt 1 INDEF INDEF {:.2f} {:.2f} {:.2f} 4 \\'
+            .format(grid, cx, cy, min(dx, dy) / 2.),
+            '   {:.3f} {:.3f} \\'.format(cx - dx / 2., cy - dy / 2.),
+            '   {:.3f} {:.3f} \\'.format(cx + dx / 2., cy - dy / 2.),
+            '   {:.3f} {:.3f} \\'.format(cx + dx / 2., cy + dy / 2.),
+            '   {:.3f} {:.3f}'.format(cx - dx / 2., cy + dy / 2.)]
+
+    with open(output, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
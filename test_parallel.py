@@ -0,0 +1,24 @@
+import os
+
+from parallel import parallel_map
+
+
+def _square_or_die(x):
+    # a worker killed outright, as the kernel does when memory runs out
+    if x == 3:
+        os._exit(1)
+    return x * x
+
+
+def test_dead_worker_fails_only_its_item():
+    results = list(parallel_map(_square_or_die, range(20), processes=2,
+                                max_pending=4))
+
+    assert [item for item, ok, value in results] == list(range(20))
+    for item, ok, value in results:
+        if item == 3:
+            assert not ok
+            assert 'Worker process died' in value
+        else:
+            assert ok
+            assert value == item * item
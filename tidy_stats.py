@@ -7,6 +7,30 @@
 # Script 2 of 3 to run
 # ============================================================================ #
 
+import re
+
+# lines created by pyRAF in the imexam results that carry no statistics
+JUNK_LINES = frozenset(['\n', '_run_imexam \n', 'real_m_stats \n',
+                        'SLICE   NPIX   MEAN   STD   MEDIAN   MIN   MAX\n'])
+
+# pattern to match for finding filenames, and the filters in the name of an
+# imexam results file
+FNAME_RE = re.compile(r'[0-2][0-9]\-[0-9]{1,2}\-[0-9]{1,2}\-[0-9]{1,3}.FIT$')
+FILTER1_RE = re.compile(r'\w+(?=-)')
+FILTER2_RE = re.compile(r'(?<=-)\w+')
+
+# exposure folders are named like XXX<unit>, e.g. 300microsec
+EXPOSURE_RE = re.compile(r'(\d+)(\D{0,5}sec)')
+UNIT_KEY = {'sec': 1, 'millisec': 1*10**(-3),
+            'microsec': 1*10**(-6), 'nanosec': 1*10**(-9),
+            'picosec': 1*10**(-12), 'femtosec': 1*10**(-15)}
+
+# dated session directories (9October2016) and AstroCap file names, which
+# are the time of the exposure (13-41-23-838.FIT)
+DATE_RE = re.compile(r'(?<![0-9])[0-3]?[0-9][A-Z][a-z]+[0-9]{4}')
+TIME_RE = re.compile(r'([0-2]?[0-9])-([0-9]{1,2})-([0-9]{1,2})-([0-9]{1,3})'
+                     r'\.FIT$')
+
 
 def get_bg(means, stds, image, thepath):
     """
@@ -23,7 +47,8 @@ def get_bg(means, stds, image, thepath):
     note that if the median of the sky value means appears more than once,
     this will just find the first appearance and take the sigma of that line.
     This is fine because there shouldn't be very much deviation between
-    different data.
+    different data. For an even number of means the sigmas of the two middle
+    values are averaged.
     """
 
     from math import sqrt
@@ -37,29 +62,193 @@ def get_bg(means, stds, image, thepath):
 
     stds = [float(y) for y in stds]
 
-    # find sky value, associated sigma and error in the sky value. NOTE: this
-    #  will fail if there are an even number of data points for the sky
-    # background.
+    # find sky value, associated sigma and error in the sky value. With an
+    # even number of data points the median falls between the two middle
+    # means, so the sigma is the average of their two sigmas.
     skyval = median(means)
-    try:
+    if len(means) % 2:
         sigma = stds[means.index(skyval)]
-    except ValueError:
-        print('Image {} probably has an even number of sky background data '
-              'points in its imexam results file. Please re-run '
-              'collect_skystats.py on this file, use results to replace the '
-              'content of its imexam results file, delete any partially '
-              'damaged files_and_params from the working directory and re-run '
-              'this script.')
+    else:
+        order = sorted(range(len(means)), key=means.__getitem__)
+        mid = len(means) // 2
+        sigma = 0.5 * (stds[order[mid - 1]] + stds[order[mid]])
     bgerr = sigma/sqrt(25)
 
     return skyval, sigma, bgerr, imgpath
 
 
-def tidy_list_skyvals(mypath):
+def parse_exposure(thepath):
+    """
+    :param thepath: a path containing an exposure folder named like
+                    XXX<unit>, e.g. .../Orion82aBlue/300microsec/...
+
+    :returns the exposure time in seconds, rounded to 6 decimal places
+    """
+
+    e = EXPOSURE_RE.search(thepath)
+    val = int(e.group(1))
+    unit = e.group(2)
+
+    return round(val * UNIT_KEY[unit], 6)
+
+
+def parse_filters(thepath):
+    """
+    :param thepath: path to an image stored following the procedure, i.e.
+                    .../<Brand><Number><Color>-<Brand><Number><Color>/
+                    XXX<unit>/<image>
+
+    :returns the first and second filter names. The second filter is 'none'
+             if only one filter was used.
+    """
+
+    parts = [p for p in thepath.split('/') if p]
+    for i, part in enumerate(parts):
+        if EXPOSURE_RE.fullmatch(part) and i > 0:
+            filters = parts[i - 1].split('-')
+            if len(filters) == 1:
+                filters.append('none')
+            return filters[0], filters[1]
+
+    raise ValueError('Could not find a <filters>/<exposure> pair of folders '
+                     'in {}'.format(thepath))
+
+
+def iter_skyval_records(filename):
+    """
+    :param filename: full path to an imexam results file for one filter and
+                     exposure combination, named like
+                     '[filtername]-[filtername]-XXX[unit]sec.txt'
+
+    Reads the file line by line and yields one tuple per image as soon as
+    its block of statistics ends:
+    (IMAGE, SKYVAL, SIGMA, SKYVAL ERR, EXPOSURE, FILTER 1, FILTER 2, PATH)
+
+    Raises ValueError if statistics come before the first image line.
+    """
+
+    from os.path import basename
+
+    # Extract the filter combination from the name of the results file
+    name = basename(filename)
+    first_filter = FILTER1_RE.search(name).group(0)
+    second_filter = FILTER2_RE.search(name).group(0)
+
+    image = None
+    thepath = None
+    exp = None
+    means = []
+    stds = []
+
+    with open(filename, 'r') as f:
+        for number, line in enumerate(f, 1):
+            # Skip extraneous lines created by pyRAF that we don't need
+            if line in JUNK_LINES or not line.strip():
+                continue
+
+            # recognize lines with filenames. They just happen to start
+            # with C.
+            if line[0] == 'C':
+                # we've reached the end of the previous image's stats block
+                if means:
+                    yield _skyval_record(means, stds, image, thepath, exp,
+                                         first_filter, second_filter)
+                    means = []
+                    stds = []
+
+                # identify path name and name for the new image
+                thepath = line[14:].strip()
+                image = FNAME_RE.search(thepath).group(0)
+                exp = parse_exposure(thepath)
+            else:
+                if thepath is None:
+                    raise ValueError('{}, line {}: statistics before the '
+                                     'first image line'.format(filename,
+                                                               number))
+                data = line.split()
+                means.append(data[2])
+                stds.append(data[3])
+
+    # end of file has been reached
+    if means:
+        yield _skyval_record(means, stds, image, thepath, exp, first_filter,
+                             second_filter)
+
+
+def _skyval_record(means, stds, image, thepath, exp, first_filter,
+                   second_filter):
+    """
+    Summarizes the stats block of one image into its files_and_params row.
+    """
+
+    skybg, sigma, bgerr, imgpath = get_bg(means, stds, image, thepath)
+
+    return (image, skybg, sigma, bgerr, exp, first_filter, second_filter,
+            imgpath)
+
+
+def _tidy_file(filename):
+    """
+    Worker for tidy_list_skyvals: all the records of one results file.
+    """
+
+    from instrument import stage
+
+    with stage('tidy_file', filename):
+        return list(iter_skyval_records(filename))
+
+
+def parse_date(thepath):
+    """
+    :param thepath: path containing a dated directory named like
+                    '9October2016'
+
+    :returns the date as 'YYYY-MM-DD', or None if there is no dated directory
+    """
+
+    import datetime
+
+    m = DATE_RE.search(thepath)
+    if m is None:
+        return None
+
+    try:
+        date = datetime.datetime.strptime(m.group(0), '%d%B%Y')
+    except ValueError:
+        return None
+
+    return date.strftime('%Y-%m-%d')
+
+
+def parse_time(image):
+    """
+    :param image: image name as written by AstroCap, e.g. '13-41-23-838.FIT'
+
+    :returns the time of the exposure as 'HH:MM:SS.mmm', or None if the name
+             doesn't follow that pattern
+    """
+
+    m = TIME_RE.search(image)
+    if m is None:
+        return None
+
+    return '{:02d}:{:02d}:{:02d}.{:03d}'.format(*[int(g) for g in m.groups()])
+
+
+def tidy_list_skyvals(mypath, output='files_and_params.txt', processes=None,
+                      manifest=None):
     """
     :param mypath: a variable that contains the full path to a directory
     containing analysis files which have pixel statistics found via imexam
     for each image. It should have just the txt files and no subdirectories.
+    :param output: name of the tidy file to write. If it ends in '.db' or
+                   '.sqlite' the records go into that session catalog
+                   instead (see catalog.py).
+    :param processes: number of worker processes used to read the results
+                      files, defaults to the number of CPUs
+    :param manifest: optional manifest.Manifest of the session. Results files
+                     that haven't changed since the last run are not parsed
+                     again; their records come from the manifest.
 
     output: a single tidy file named files_and_params.txt summarizing the
     values for each image, with path name attached for ease of navigation.
@@ -68,111 +257,52 @@ def tidy_list_skyvals(mypath):
     """
 
     from os import walk
-    import re
+    from os.path import join
+    from catalog import write_params
 
     # Collect a list of files which contain pixel statistics -------------------
-    for (dirpath, dirnames, file) in walk(mypath):
-        print(file)
-        filenames = file
-
-    if mypath[-1] != '/':
-        mypath += '/'
+    dirpath, dirnames, filenames = next(walk(mypath))
+    filenames = sorted(filenames)
 
     print('Using these files: {}'.format(filenames))
 
-    # Establish the output file for finalizing the sky values ------------------
-    output = open('files_and_params.txt', 'w')
-    output.write('# IMAGE \t SKY VAL \t SIGMA \t SKYVAL ERR \t EXPOSURE \t '
-                 'FILTER 1 \t FILTER 2 \t PATH\n')
-    wstr = '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'
-
     # MAIN LOOP OVER TEXT FILES ------------------------------------------------
-    # Extracts the filenames, pares down all datapoints (no matter how many),
-    # finds the sky value, sigma and error and writes to output file
-    for name in filenames:
-        print('Processing file: {}'.format(name))
-        with open(mypath+name, 'r') as f:
-            lines = f.readlines()
-
-        # Get rid of extraneous lines created by pyRAF that we don't need
-        for L in ['\n', '_run_imexam \n', 'real_m_stats \n',
-                  'SLICE   NPIX   MEAN   STD   MEDIAN   MIN   MAX\n']:
-            while L in lines:
-                lines.remove(L)
-
-        # pattern to match for finding filenames
-        fnameexp = '[0-2][0-9]\-[0-9]{1,2}\-[0-9]{1,2}\-[0-9]{1,3}.FIT$'
-        means = []
-        stds = []
-
-        # ITERATE THROUGH STATISTICS -------------------------------------------
-        # warning: this section uses regular expression black magic
-        for i in range(len(lines)):
-            # recognize lines with filenames. They just happen to start with C.
-            if lines[i][0] == 'C':
-                # start working on image designated by the current line
-
-                # identify path name for the new image
-                thepath = lines[i][14:]
-
-                # Extract the image name
-                image = re.search(fnameexp, lines[i]).group(0)
-
-                # Extract the filter combination
-                first_filter = re.search('\w+(?=-)', name).group(0)
-                second_filter = re.search('(?<=-)\w+', name).group(0)
-
-                # extract the exposure time
-                e = re.search('\d+\D{0,5}sec', thepath).group(0)
-                val = int(re.search('\d+', e).group(0))
-                unit = re.search('\D+', e).group(0)
-                unit_key = {'sec': 1, 'millisec': 1*10**(-3),
-                            'microsec': 1*10**(-6), 'nanosec': 1*10**(-9),
-                            'picosec': 1*10**(-12), 'femtosec': 1*10**(-15)}
-                exp = round(val * unit_key[unit], 6)
-
-            else: #TODO: make this more concise
-                # This block is to handle gathering statistics when we are
-                # not at the end of the file yet.
-                if i+1 < len(lines):
-                    if lines[i][0] != 'C' and lines[i+1][0] != 'C':
-                        # if not a header line AND the following line isn't a
-                        # header line, we are in the block of data for image.
-                        # grab the data.
-                        data = lines[i].strip('\n').split()
-                        means.append(data[2])
-                        stds.append(data[3])
-                    elif lines[i][0] != 'C' and lines[i+1][0] == 'C':
-                        # we've reached the end of the pixel stats block
-
-                        # gather data from this line
-                        data = lines[i].strip('\n').split()
-                        means.append(data[2])
-                        stds.append(data[3])
-
-                        # summarize the stats and write to the file
-                        skybg, sigma, bgerr, imgpath = get_bg(means, stds,
-                                                              image, thepath)
-                        output.write(wstr.format(image, skybg, sigma, bgerr,
-                                                 exp, first_filter,
-                                                 second_filter, imgpath))
-
-                        # reset means and std lists for next image
-                        means = []
-                        stds = []
-                elif i+1 >= len(lines):
-                    # end of file has been reached
-
-                    # gather data from this line
-                    data = lines[i].strip('\n').split()
-                    means.append(data[2])
-                    stds.append(data[3])
-
-                    # summarize the stats and write to the file
-                    skybg, sigma, bgerr, imgpath = get_bg(means, stds,
-                                                          image, thepath)
-                    output.write(wstr.format(image, skybg, sigma, bgerr,
-                                             exp, first_filter,
-                                             second_filter, imgpath))
-
-    output.close()
\ No newline at end of file
+    # Each file is parsed in a single pass by its own worker; the records come
+    # back in file order and are written straight to the output
+    paths = [join(mypath, name) for name in filenames]
+    try:
+        write_params(output, _tidy_records(paths, processes, manifest))
+    finally:
+        # an interrupted run keeps the files it got through
+        if manifest is not None:
+            manifest.save()
+
+
+def _tidy_records(paths, processes, manifest):
+    """
+    Records of all the imexam results files in paths, in order. Files that
+    the manifest has seen unchanged are taken from the manifest.
+    """
+
+    from parallel import parallel_map
+
+    done = set()
+    if manifest is not None:
+        done = set(paths) - set(manifest.pending('tidy', paths))
+
+    computed = parallel_map(_tidy_file, [p for p in paths if p not in done],
+                            processes=processes)
+    for path in paths:
+        if path in done:
+            records = manifest.result('tidy', path)
+        else:
+            path, ok, records = next(computed)
+            if not ok:
+                print('Could not process file {}:\n{}'.format(path, records))
+                continue
+            if manifest is not None:
+                manifest.mark_done('tidy', path, result=records)
+
+        print('Processed file: {}'.format(path))
+        for record in records:
+            yield record